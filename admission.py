@@ -0,0 +1,159 @@
+"""
+Admission control of the server: which connections it takes, and how fast a user's bytes may flow
+A connection that finds every worker busy is not left waiting in the listen queue until the client times out, it is
+turned away with a hint of when to come back (see utils.send_admission)
+Bulk transfers, the folder a new user uploads and the one a new client downloads, can take minutes: only MAX_TRANSFERS
+of them run at the same time and MAX_USER_TRANSFERS for one user, so the workers stay free for the sessions
+Every user has a token bucket of USER_RATE bytes a second, all of his connections draw from it
+A bucket no connection uses is dropped once it is full again, a new one would be the same
+A bulk transfer leaves BATCH_RESERVE in the bucket, so the small batches of his sessions never wait behind it
+"""
+import threading
+import time
+import weakref
+
+# bulk transfers running at the same time, on all the server and for one user
+MAX_TRANSFERS = 16
+MAX_USER_TRANSFERS = 2
+# bytes a second every user may send and receive, and how much he may use at once after being idle
+USER_RATE = 64 << 20
+USER_BURST = 4 * USER_RATE
+# what a bulk transfer leaves in its user's bucket for the batches of his sessions
+BATCH_RESERVE = 1 << 20
+# seconds a turned away client waits: when every worker is busy, when there is no room for a bulk transfer
+BUSY_RETRY_AFTER = 2
+TRANSFER_RETRY_AFTER = 5
+# the longest the kernel sends a file for before the bucket is charged, see ThrottledSocket.sendfile
+THROTTLE_PIECE = 1 << 20
+# the buckets are looked over for ones to drop at most this often (seconds)
+SWEEP_INTERVAL = 60
+
+# guards the transfers and the buckets
+lock = threading.Lock()
+# user -> his bulk transfers running, new users (who have no id yet) only count toward the total
+transfers = {}
+running = 0
+# user -> his bucket, and when they were last looked over
+buckets = {}
+swept = time.monotonic()
+
+
+class TokenBucket:
+    """
+    Tokens flow in at rate a second up to burst, every byte takes one
+    A taker can run the bucket into debt and then sleeps it off, so a big piece does not wait for a full bucket
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__updated = time.monotonic()
+        # the throttled sockets that draw from the bucket, guarded by the module's lock
+        self.holders = 0
+        self.__lock = threading.Lock()
+
+    def take(self, amount: int, reserve: int = 0):
+        # returns once the bucket holds at least reserve again
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate) - amount
+            self.__updated = now
+            debt = reserve - self.__tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+    def full(self, now: float) -> bool:
+        # it refilled since it was last taken from
+        with self.__lock:
+            return self.__tokens + (now - self.__updated) * self.rate >= self.burst
+
+
+class ThrottledSocket:
+    """
+    A socket whose traffic draws from a token bucket, everything else is the socket's own
+    """
+
+    def __init__(self, sock, bucket: TokenBucket, reserve: int = 0):
+        self.sock = sock
+        self.bucket = bucket
+        self.reserve = reserve
+        with lock:
+            bucket.holders += 1
+        # the bucket may be dropped once no socket draws from it, see bucket
+        weakref.finalize(self, release_bucket, bucket)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.bucket.take(len(data), self.reserve)
+
+    def sendfile(self, file, offset: int = 0, count: int = None) -> int:
+        # in pieces, a big file would get past the bucket in one go
+        sent = 0
+        while count is None or sent < count:
+            piece = THROTTLE_PIECE if count is None else min(THROTTLE_PIECE, count - sent)
+            done = self.sock.sendfile(file, offset + sent, piece)
+            if not done:
+                break
+            sent += done
+            self.bucket.take(done, self.reserve)
+        return sent
+
+    def recv(self, size: int, *flags) -> bytes:
+        data = self.sock.recv(size, *flags)
+        self.bucket.take(len(data), self.reserve)
+        return data
+
+    def recv_into(self, buffer, size: int = 0, *flags) -> int:
+        received = self.sock.recv_into(buffer, size, *flags)
+        self.bucket.take(received, self.reserve)
+        return received
+
+    def __getattr__(self, name: str):
+        return getattr(self.sock, name)
+
+
+def release_bucket(released: TokenBucket):
+    with lock:
+        released.holders -= 1
+
+
+def bucket(user_id: str) -> TokenBucket:
+    global swept
+    with lock:
+        now = time.monotonic()
+        if now - swept > SWEEP_INTERVAL:
+            # the buckets of users who left, a bucket still in debt is kept so coming back does not reset it
+            for idle in [user for user, kept in buckets.items() if not kept.holders and kept.full(now)]:
+                del buckets[idle]
+            swept = now
+        if user_id not in buckets:
+            buckets[user_id] = TokenBucket(USER_RATE, USER_BURST)
+        return buckets[user_id]
+
+
+def throttled(sock, user_id: str, bulk: bool = False) -> ThrottledSocket:
+    # the user's connection, a bulk transfer leaves room for his batches
+    return ThrottledSocket(sock, bucket(user_id), BATCH_RESERVE if bulk else 0)
+
+
+def reserve_transfer(user_id: str = None) -> bool:
+    """
+    Take a slot for a bulk transfer of user_id (None for a new user), False if there is no room for it now
+    """
+    global running
+    with lock:
+        if running >= MAX_TRANSFERS or user_id is not None and transfers.get(user_id, 0) >= MAX_USER_TRANSFERS:
+            return False
+        running += 1
+        transfers[user_id] = transfers.get(user_id, 0) + 1
+    return True
+
+
+def release_transfer(user_id: str = None):
+    global running
+    with lock:
+        running -= 1
+        transfers[user_id] -= 1
+        if not transfers[user_id]:
+            del transfers[user_id]
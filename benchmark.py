@@ -0,0 +1,959 @@
+"""
+Benchmarks of the sync pipeline, with JSON output so runs can be compared
+End to end workloads start server.py and client.py processes on loopback in a temporary directory, change the files of
+a client's folder so the real observer picks them up, and wait until every folder holds the same files. Every client
+talks to the server through a proxy that counts the bytes on the wire. Micro benchmarks call the modules directly
+    python benchmark.py [workload ...] [--clients N] [--scale X] [--output results.json] [--keep]
+--scale multiplies the sizes of all the workloads, 1 runs in a few minutes
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO)
+import chunkstore
+import compression
+import executor
+import filestate
+import metastore
+import syncignore
+import utils as u
+
+# how often the folders are compared while waiting for them to converge
+POLL_INTERVAL = 0.05
+# a workload whose folders are not the same after this long did not converge
+CONVERGE_TIMEOUT = 600
+# how long a client may take to connect and do its first transfer
+START_TIMEOUT = 300
+# the clients check on their session at least this often (seconds), changes are sent as soon as they settle
+CLIENT_FREQUENCY = 1
+PROXY_BUFFER = 1 << 20
+# worker processes of the server, see server.WORKERS
+SERVER_WORKERS = 1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 6)
+    return {'count': len(ordered), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(ordered[-1], 6)}
+
+
+def rate(amount: float, seconds: float) -> float:
+    return round(amount / seconds, 2) if seconds > 0 else None
+
+
+def write_files(folder: str, files: dict):
+    # relative path -> content
+    for relative_path, content in files.items():
+        path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+
+
+def write_big_file(path: str, size: int, seed: int):
+    # random content written in pieces, without holding it in memory
+    generator = random.Random(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        left = size
+        while left > 0:
+            piece = min(left, 1 << 22)
+            file.write(generator.randbytes(piece))
+            left -= piece
+
+
+def small_files(count: int, seed: int, prefix: str = '', folders: int = 50, low: int = 1 << 10,
+                high: int = 8 << 10) -> dict:
+    generator = random.Random(seed)
+    return {os.path.join(prefix, f'd{index % folders}', f'f{index}.bin'):
+            generator.randbytes(generator.randint(low, high)) for index in range(count)}
+
+
+def repository_checkout(count: int, seed: int) -> dict:
+    # a typical project: few sources, a lot of version control objects, dependencies and build outputs
+    generator = random.Random(seed)
+    files = {}
+    for index in range(count):
+        kind = index % 10
+        if kind < 2:
+            path = os.path.join('src', f'm{index % 20}', f'f{index}.py')
+        elif kind < 4:
+            path = os.path.join('.git', 'objects', f'{index % 256:02x}', f'o{index}')
+        elif kind < 7:
+            path = os.path.join('node_modules', f'pkg{index % 40}', 'lib', f'f{index}.js')
+        elif kind < 9:
+            path = os.path.join('build', f'm{index % 20}', f'f{index}.o')
+        else:
+            path = os.path.join('src', f'm{index % 20}', '__pycache__', f'f{index}.pyc')
+        files[path] = generator.randbytes(generator.randint(1 << 10, 8 << 10))
+    return files
+
+
+# version control, dependencies and build outputs
+REPOSITORY_RULES = '.git/\nnode_modules/\n/build/\n__pycache__/\n*.swp\n'
+
+
+def folder_signature(folder: str, with_hashes: bool = False) -> dict:
+    # relative path -> size (None for a directory), or the hash of the content
+    found = {}
+    for top, dirs, files in os.walk(folder):
+        relative_top = os.path.relpath(top, folder)
+        for name in dirs:
+            found[os.path.normpath(os.path.join(relative_top, name))] = None
+        for name in files:
+            path = os.path.join(top, name)
+            try:
+                if with_hashes:
+                    file_digest = hashlib.blake2b(digest_size=16)
+                    with open(path, 'rb') as file:
+                        for block in iter(lambda: file.read(1 << 20), b''):
+                            file_digest.update(block)
+                    value = file_digest.hexdigest()
+                else:
+                    value = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            found[os.path.normpath(os.path.join(relative_top, name))] = value
+    return found
+
+
+def tree_size(folder: str) -> int:
+    # bytes on the disk, every hard link counted once
+    seen, total = set(), 0
+    for top, _, files in os.walk(folder):
+        for name in files:
+            stat = os.lstat(os.path.join(top, name))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_blocks * 512
+    return total
+
+
+def peak_rss(pid: int):
+    # kilobytes, of the process and its children together, None where /proc is not available
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            peak = next(int(line.split()[1]) for line in file if line.startswith('VmHWM:'))
+        with open(f'/proc/{pid}/task/{pid}/children') as file:
+            children = [int(child) for child in file.read().split()]
+    except OSError:
+        return None
+    return peak + sum(peak_rss(child) or 0 for child in children)
+
+
+class CountingProxy:
+    """
+    Forwards connections to the server and counts the bytes that go each way
+    """
+
+    def __init__(self, target_port: int):
+        self.target_port = target_port
+        self.up = self.down = 0
+        self.connections = 0
+        self.__lock = threading.Lock()
+        self.__listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.__listener.getsockname()[1]
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def __accept(self):
+        while True:
+            try:
+                client, _ = self.__listener.accept()
+            except OSError:
+                return
+            try:
+                server = socket.create_connection(('127.0.0.1', self.target_port))
+            except OSError:
+                client.close()
+                continue
+            with self.__lock:
+                self.connections += 1
+            for source, target, direction in ((client, server, 'up'), (server, client, 'down')):
+                threading.Thread(target=self.__pump, args=(source, target, direction), daemon=True).start()
+
+    def __pump(self, source: socket.socket, target: socket.socket, direction: str):
+        buff = bytearray(PROXY_BUFFER)
+        view = memoryview(buff)
+        try:
+            while True:
+                received = source.recv_into(buff)
+                if not received:
+                    break
+                target.sendall(view[:received])
+                with self.__lock:
+                    if direction == 'up':
+                        self.up += received
+                    else:
+                        self.down += received
+        except OSError:
+            pass
+        for sock in (source, target):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def reset(self):
+        with self.__lock:
+            self.up = self.down = 0
+
+    def close(self):
+        self.__listener.close()
+
+
+class Cluster:
+    """
+    A server and its clients on loopback, in a temporary directory
+    Folders of clients are named c0, c1... remote folders are in remotes/ like on a real server
+    """
+
+    def __init__(self, keep: bool = False):
+        self.root = tempfile.mkdtemp(prefix='sync-bench-')
+        self.keep = keep
+        self.port = free_port()
+        self.metrics_ports = {}
+        # name -> (process, proxy, folder)
+        self.clients = {}
+        # clients may be added from several threads at once
+        self.__lock = threading.Lock()
+        self.__next_client = 0
+        self.server = self.__spawn('server', [os.path.join(REPO, 'server.py'), str(self.port), str(SERVER_WORKERS)])
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or self.server.poll() is not None:
+                    raise RuntimeError('the server did not start, see its log in ' + self.root)
+                time.sleep(0.05)
+        # the probe above was a connection too
+        time.sleep(0.1)
+
+    def __spawn(self, name: str, arguments: list) -> subprocess.Popen:
+        self.metrics_ports[name] = free_port()
+        environment = dict(os.environ, METRICS_PORT=str(self.metrics_ports[name]))
+        log = open(os.path.join(self.root, f'{name}.log'), 'wb')
+        return subprocess.Popen([sys.executable, '-u', *arguments], cwd=self.root, stdout=log,
+                                stderr=subprocess.STDOUT, env=environment)
+
+    def add_client(self, user_id: str = None, files: dict = None) -> str:
+        """
+        Start a client on a new folder that holds files, of a new user or of user_id, wait until it is synced
+        Returns its name
+        """
+        with self.__lock:
+            name = f'c{self.__next_client}'
+            self.__next_client += 1
+        folder = os.path.join(self.root, name)
+        os.makedirs(folder)
+        write_files(folder, files or {})
+        proxy = CountingProxy(self.port)
+        arguments = [os.path.join(REPO, 'client.py'), '127.0.0.1', str(proxy.port), folder, str(CLIENT_FREQUENCY)]
+        with self.__lock:
+            process = self.__spawn(name, arguments + ([user_id] if user_id else []))
+            self.clients[name] = (process, proxy, folder)
+        log_path = os.path.join(self.root, f'{name}.log')
+        deadline = time.monotonic() + START_TIMEOUT
+        while b'Finished initializing' not in open(log_path, 'rb').read():
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError(f'client {name} did not start, see {log_path}')
+            time.sleep(POLL_INTERVAL)
+        return name
+
+    def user_of(self, name: str) -> str:
+        with open(os.path.join(u.state_dir(self.folder(name)), 'identity')) as file:
+            return file.read().split()[0]
+
+    def folder(self, name: str) -> str:
+        return self.clients[name][2]
+
+    def remote_folder(self, name: str) -> str:
+        return os.path.join(self.root, 'remotes', self.user_of(name))
+
+    def wait_converged(self, names: list = None, timeout: float = CONVERGE_TIMEOUT):
+        """
+        Wait until the folders of the clients (all by default) hold the same files as the others of their user and as
+        their remote folder
+        Returns the seconds it took, None if they did not converge in time
+        """
+        started = time.monotonic()
+        groups = {}
+        for name in list(self.clients) if names is None else names:
+            groups.setdefault(self.remote_folder(name), []).append(self.folder(name))
+        waiting = [[remote, *folders] for remote, folders in groups.items()]
+        while waiting and time.monotonic() - started < timeout:
+            for folders in list(waiting):
+                signatures = [folder_signature(folder) for folder in folders]
+                if all(signature == signatures[0] for signature in signatures):
+                    # the same names and sizes, now the contents
+                    contents = [folder_signature(folder, True) for folder in folders]
+                    if all(content == contents[0] for content in contents):
+                        waiting.remove(folders)
+            if waiting:
+                time.sleep(POLL_INTERVAL)
+        return None if waiting else time.monotonic() - started
+
+    def wire(self) -> dict:
+        return {'up': sum(proxy.up for _, proxy, _ in self.clients.values()),
+                'down': sum(proxy.down for _, proxy, _ in self.clients.values())}
+
+    def reset_wire(self):
+        for _, proxy, _ in self.clients.values():
+            proxy.reset()
+
+    def scrape(self, name: str, offset: int = 0) -> dict:
+        # the metrics registry of a process, see metrics, the server's workers are at the offsets after it
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{self.metrics_ports[name] + offset}/metrics',
+                                        timeout=5) as answer:
+                lines = answer.read().decode().splitlines()
+        except OSError:
+            return {}
+        return {name: float(value) for name, value in (line.split() for line in lines)}
+
+    def scrape_server(self) -> dict:
+        # the sums of all the server's processes
+        total = {}
+        for offset in range(SERVER_WORKERS + 1 if SERVER_WORKERS > 1 else 1):
+            for key, value in self.scrape('server', offset).items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def report(self, seconds, files: int = 0, size: int = 0) -> dict:
+        """
+        What every workload reports: time to converge, throughput, propagation latency, peak memory and wire bytes
+        """
+        latencies = {}
+        for name in self.clients:
+            scraped = self.scrape(name)
+            latencies[name] = {key.rsplit('.', 1)[1]: value for key, value in scraped.items()
+                               if key.startswith('client.propagation_latency.')}
+        server = self.scrape_server()
+        result = {
+            'converged': seconds is not None,
+            'seconds': None if seconds is None else round(seconds, 3),
+            'files_per_second': rate(files, seconds) if files and seconds else None,
+            'mb_per_second': rate(size / 1e6, seconds) if size and seconds else None,
+            'client_to_server_latency': latencies,
+            'server_phases': {key[len('server.'):-len('.sum')]: round(value, 4) for key, value in server.items()
+                              if key.startswith('server.') and key.endswith('.sum')},
+            'peak_rss_kb': {'server': peak_rss(self.server.pid),
+                            **{name: peak_rss(process.pid) for name, (process, _, _) in self.clients.items()}},
+            'wire_bytes': self.wire(),
+        }
+        return result
+
+    def stop(self):
+        for process in [self.server] + [process for process, _, _ in self.clients.values()]:
+            process.terminate()
+        for process in [self.server] + [process for process, _, _ in self.clients.values()]:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for _, proxy, _ in self.clients.values():
+            proxy.close()
+        if self.keep:
+            print(f'kept {self.root}', file=sys.stderr)
+        else:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def same_user_cluster(clients: int, keep: bool, files: dict = None) -> (Cluster, list):
+    cluster = Cluster(keep)
+    first = cluster.add_client(files=files)
+    names = [first] + [cluster.add_client(cluster.user_of(first)) for _ in range(clients - 1)]
+    if cluster.wait_converged() is None:
+        raise RuntimeError('the clients did not converge before the workload')
+    cluster.reset_wire()
+    return cluster, names
+
+
+def run_end_to_end(workload, clients: int, scale: float, keep: bool, files: dict = None) -> dict:
+    cluster, names = same_user_cluster(clients, keep, files)
+    try:
+        return workload(cluster, names, scale)
+    finally:
+        cluster.stop()
+
+
+# end to end workloads: (cluster, client names, scale) -> result, the first client makes the changes
+
+def many_small_files(cluster: Cluster, names: list, scale: float) -> dict:
+    files = small_files(int(5000 * scale), 1)
+    started = time.monotonic()
+    write_files(cluster.folder(names[0]), files)
+    seconds = cluster.wait_converged()
+    return cluster.report(seconds and time.monotonic() - started, len(files), sum(map(len, files.values())))
+
+
+def few_huge_files(cluster: Cluster, names: list, scale: float) -> dict:
+    count, size = 3, int(256e6 * scale)
+    started = time.monotonic()
+    for index in range(count):
+        write_big_file(os.path.join(cluster.folder(names[0]), f'huge{index}.bin'), size, index)
+    seconds = cluster.wait_converged()
+    return cluster.report(seconds and time.monotonic() - started, count, count * size)
+
+
+def rename_storm(cluster: Cluster, names: list, scale: float) -> dict:
+    folder = cluster.folder(names[0])
+    files = small_files(int(2000 * scale), 2, 'storm', folders=20, low=64, high=512)
+    write_files(folder, files)
+    if cluster.wait_converged() is None:
+        return cluster.report(None)
+    cluster.reset_wire()
+    started = time.monotonic()
+    # every file is renamed twice, then every folder once
+    for relative_path in files:
+        path = os.path.join(folder, relative_path)
+        os.rename(path, path + '.tmp')
+        os.rename(path + '.tmp', path.replace('.bin', '.renamed'))
+    for index in range(20):
+        os.rename(os.path.join(folder, 'storm', f'd{index}'), os.path.join(folder, 'storm', f'moved{index}'))
+    seconds = cluster.wait_converged()
+    return cluster.report(seconds and time.monotonic() - started, 2 * len(files) + 20)
+
+
+def deep_tree(cluster: Cluster, names: list, scale: float) -> dict:
+    depth, per_level = max(2, min(200, int(100 * scale))), 10
+    files, level = {}, ''
+    for index in range(depth):
+        level = os.path.join(level, f'l{index}')
+        files.update({os.path.join(level, f'f{number}'): f'{index}-{number}'.encode() for number in range(per_level)})
+    started = time.monotonic()
+    write_files(cluster.folder(names[0]), files)
+    seconds = cluster.wait_converged()
+    result = cluster.report(seconds and time.monotonic() - started, len(files))
+    result['depth'] = depth
+    return result
+
+
+def concurrent_edits(cluster: Cluster, names: list, scale: float) -> dict:
+    """
+    Every client writes files of its own, and all of them rewrite the same shared files at the same time
+    """
+    count = int(500 * scale)
+    shared = [f'shared/s{index}.txt' for index in range(max(1, count // 50))]
+    write_files(cluster.folder(names[0]), {path: b'initial' for path in shared})
+    if cluster.wait_converged() is None:
+        return cluster.report(None)
+    cluster.reset_wire()
+
+    def edit(name: str):
+        folder = cluster.folder(name)
+        write_files(folder, small_files(count, zlib.crc32(name.encode()), name, folders=10))
+        for round_number in range(5):
+            write_files(folder, {path: f'{name} round {round_number}\n'.encode() * 100 for path in shared})
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(len(names)) as pool:
+        list(pool.map(edit, names))
+    seconds = cluster.wait_converged()
+    return cluster.report(seconds and time.monotonic() - started, count * len(names) + len(shared))
+
+
+def event_burst(cluster: Cluster, names: list, scale: float) -> dict:
+    # one file saved over and over and a few files created and deleted, most of it should coalesce away
+    folder = cluster.folder(names[0])
+    saves = int(2000 * scale)
+    started = time.monotonic()
+    for index in range(saves):
+        write_files(folder, {'burst/doc.txt': f'version {index}\n'.encode() * 50})
+        if index % 10 == 0:
+            temp = os.path.join(folder, 'burst', f'tmp{index}')
+            write_files(folder, {temp: b'x'})
+            os.remove(temp)
+    seconds = cluster.wait_converged()
+    result = cluster.report(seconds and time.monotonic() - started, saves)
+    sender = cluster.scrape(names[0])
+    result['events'] = sender.get('client.queue.events_in')
+    result['commands_sent'] = sender.get('client.queue.commands_out')
+    return result
+
+
+def propagation(cluster: Cluster, names: list, scale: float) -> dict:
+    """
+    End to end latency: a small file is written every so often, and we see when it is complete in the other folders
+    """
+    count, interval = max(5, int(50 * scale)), 0.2
+    others = [cluster.folder(name) for name in names[1:]] or [cluster.remote_folder(names[0])]
+    latencies = []
+    started = time.monotonic()
+    for index in range(count):
+        content = f'probe {index} {time.time()}'.encode()
+        relative_path = os.path.join('probes', f'p{index}')
+        written = time.monotonic()
+        write_files(cluster.folder(names[0]), {relative_path: content})
+        waiting = set(others)
+        deadline = written + 60
+        while waiting and time.monotonic() < deadline:
+            for folder in list(waiting):
+                try:
+                    if os.path.getsize(os.path.join(folder, relative_path)) == len(content):
+                        latencies.append(time.monotonic() - written)
+                        waiting.discard(folder)
+                except OSError:
+                    pass
+            time.sleep(0.002)
+        time.sleep(interval)
+    seconds = cluster.wait_converged()
+    result = cluster.report(seconds and time.monotonic() - started, count)
+    result['end_to_end_latency'] = percentiles(latencies)
+    return result
+
+
+def handshake(port: int) -> (float, bool):
+    # a connection of a user the server does not know, until the server says whether it takes it
+    started = time.monotonic()
+    with socket.create_connection(('127.0.0.1', port), timeout=START_TIMEOUT) as sock:
+        sock.sendall(('z' * u.USER_ID_LENGTH + '01' + str(u.PROTOCOL_VERSION)).encode())
+        u.read_protocol_version(sock)
+        u.offer_codecs(sock)
+        taken = not u.receive_admission(sock)
+    return time.monotonic() - started, taken
+
+
+def accept_rate(port: int, count: int, concurrency: int) -> dict:
+    """
+    How fast the server accepts connections and answers their handshake, concurrency of them at a time
+    """
+    started = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as pool:
+        answers = list(pool.map(lambda _: handshake(port), range(count)))
+    seconds = time.monotonic() - started
+    return {'connections': count, 'per_second': rate(count, seconds),
+            'turned_away': sum(not taken for _, taken in answers),
+            'handshake_latency': percentiles([latency for latency, _ in answers])}
+
+
+def probe_pairs(cluster: Cluster, pairs: list, count: int) -> list:
+    """
+    End to end latency from a client through the server to another client of its user: a small file is written in
+    the first folder of a pair, and we see when it is complete in the second, the pairs take turns
+    """
+    latencies = []
+    for index in range(count):
+        sender, receiver = pairs[index % len(pairs)]
+        content = f'probe {index} {time.time()}'.encode()
+        relative_path = os.path.join('probes', f'p{index}')
+        written = time.monotonic()
+        write_files(cluster.folder(sender), {relative_path: content})
+        target = os.path.join(cluster.folder(receiver), relative_path)
+        while time.monotonic() < written + 60:
+            try:
+                if os.path.getsize(target) == len(content):
+                    latencies.append(time.monotonic() - written)
+                    break
+            except OSError:
+                pass
+            time.sleep(0.002)
+    return latencies
+
+
+def many_users(clients: int, scale: float, keep: bool) -> dict:
+    """
+    Load test: users connect at the same time, each uploads a folder and then keeps writing files
+    Every user has a second client, the latency from one to the other is probed while the others write
+    And before that, how fast the server takes connections
+    """
+    users = max(2, int(16 * scale))
+    cluster = Cluster(keep)
+    try:
+        connections = accept_rate(cluster.port, max(100, int(1000 * scale)), users)
+        with ThreadPoolExecutor(users) as pool:
+            names = list(pool.map(lambda index: cluster.add_client(files=small_files(50, index, folders=5)),
+                                  range(users)))
+            partners = list(pool.map(lambda name: cluster.add_client(cluster.user_of(name)), names))
+        cluster.reset_wire()
+        count = int(200 * scale)
+        started = time.monotonic()
+        with ThreadPoolExecutor(users + 1) as pool:
+            probes = pool.submit(probe_pairs, cluster, list(zip(names, partners)), max(100, int(200 * scale)))
+            list(pool.map(lambda name: write_files(cluster.folder(name),
+                                                   small_files(count, zlib.crc32(name.encode()), 'load')), names))
+            latencies = probes.result()
+        seconds = cluster.wait_converged()
+        result = cluster.report(seconds and time.monotonic() - started, users * count)
+        result['users'] = users
+        result['accept'] = connections
+        result['client_to_client_latency'] = percentiles(latencies)
+        return result
+    finally:
+        cluster.stop()
+
+
+def duplicated_dataset(clients: int, scale: float, keep: bool) -> dict:
+    """
+    Two users upload the same folder: the second one sends only what the store does not have
+    """
+    files = small_files(int(1000 * scale), 3, folders=10)
+    big = random.Random(4).randbytes(int(20e6 * scale))
+    files.update({'big.bin': big, 'copy/big.bin': big})
+    size = sum(map(len, files.values()))
+    cluster = Cluster(keep)
+    try:
+        uploads = []
+        for _ in range(2):
+            before = cluster.wire()['up']
+            started = time.monotonic()
+            cluster.add_client(files=files)
+            uploads.append({'seconds': round(time.monotonic() - started, 3), 'wire_up': cluster.wire()['up'] - before})
+        return {'dataset_bytes': size, 'uploads': uploads,
+                'store_bytes': tree_size(os.path.join(cluster.root, 'remotes', '.store', 'objects')),
+                'peak_rss_kb': {'server': peak_rss(cluster.server.pid)}}
+    finally:
+        cluster.stop()
+
+
+def ignore_rules(clients: int, scale: float, keep: bool) -> dict:
+    """
+    A repository checkout uploaded without and with a .syncignore, then a build in the folder that ignores its outputs
+    """
+    files = repository_checkout(int(5000 * scale), 5)
+    matcher = syncignore.Matcher(REPOSITORY_RULES)
+    kept = [path for path in files if not matcher.ignored(path)]
+    result = {'files': len(files), 'files_synced': len(kept),
+              'bytes': sum(map(len, files.values())), 'bytes_synced': sum(len(files[path]) for path in kept)}
+    cluster = Cluster(keep)
+    try:
+        for seed, (label, rules) in enumerate((('without_rules', None), ('with_rules', REPOSITORY_RULES))):
+            before = cluster.wire()['up']
+            started = time.monotonic()
+            # other contents the second time, the store would spare that upload what the first one sent
+            name = cluster.add_client(files={**repository_checkout(len(files), seed),
+                                             **({syncignore.IGNORE_FILE: rules.encode()} if rules else {})})
+            result[label] = {'seconds': round(time.monotonic() - started, 3), 'wire_up': cluster.wire()['up'] - before,
+                             'remote_files': sum(len(names) for _, _, names in os.walk(cluster.remote_folder(name)))}
+        # the build: objects and caches written over and over, and one source edited last
+        folder = cluster.folder(name)
+        outputs = [path for path in files if path.startswith('build') or '__pycache__' in path]
+        before = cluster.scrape(name)
+        started = time.monotonic()
+        for path in outputs:
+            write_files(folder, {path: b'built' * 100})
+            write_files(folder, {path + '.swp': b'editor'})
+        marker = os.path.join('src', 'edited.py')
+        write_files(folder, {marker: b'print()\n'})
+        remote_marker = os.path.join(cluster.remote_folder(name), marker)
+        while not os.path.exists(remote_marker) and time.monotonic() - started < CONVERGE_TIMEOUT:
+            time.sleep(POLL_INTERVAL)
+        after = cluster.scrape(name)
+        result['build'] = {'files_written': 2 * len(outputs) + 1, 'seconds': round(time.monotonic() - started, 3),
+                           **{key: after.get(metric, 0) - before.get(metric, 0)
+                              for key, metric in (('events_ignored', 'client.events.ignored'),
+                                                  ('commands_sent', 'client.queue.commands_out'))}}
+        paths = list(files) * 10
+        result['matches_per_second'] = rate(len(paths), timed(lambda: [matcher.ignored(path) for path in paths]))
+        return result
+    finally:
+        cluster.stop()
+
+
+# micro benchmarks: scale -> result
+
+def timed(function, *arguments) -> float:
+    started = time.perf_counter()
+    function(*arguments)
+    return time.perf_counter() - started
+
+
+def over_socketpair(send, receive):
+    # send(sock) on a thread and receive(sock) here, returns the seconds and what receive returned
+    sender_sock, receiver_sock = socket.socketpair()
+    with sender_sock, receiver_sock:
+        started = time.perf_counter()
+        sender = threading.Thread(target=send, args=(sender_sock,))
+        sender.start()
+        received = receive(receiver_sock)
+        sender.join()
+        return time.perf_counter() - started, received
+
+
+def wire_format(scale: float) -> dict:
+    """
+    Batches of commands without contents in the binary and the resumable format: bytes, encoding and the round trip
+    """
+    count = int(20000 * scale)
+    commands = []
+    for index in range(count):
+        path = f'folder{index % 100}/some file {index}.txt'
+        commands.append([u.Command(u.CREATE, path), u.Command(u.DELETE, path, True),
+                         u.Command(u.MOVE, path, new_path=path + '.moved')][index % 3])
+    result = {'commands': count}
+    with tempfile.TemporaryDirectory() as spool:
+        for name, version in (('binary', u.PROTOCOL_BINARY), ('resumable', u.PROTOCOL_RESUME)):
+            encoded = [u.encode_binary_command(command) for command in commands]
+            encoding = timed(lambda: [u.encode_binary_command(command) for command in commands])
+            seconds, received = over_socketpair(lambda sock: u.send_requests(sock, commands, version),
+                                                lambda sock: u.receive_requests(sock, spool, version))
+            assert received == commands
+            result[name] = {'bytes': sum(map(len, encoded)), 'encode_per_second': rate(count, encoding),
+                            'round_trip_per_second': rate(count, seconds)}
+    return result
+
+
+def compression_codecs(scale: float) -> dict:
+    """
+    CPU against bytes of every codec on text, on random data and on a mix of both
+    """
+    size = int(16e6 * scale)
+    sources = b''.join(open(os.path.join(REPO, name), 'rb').read() for name in sorted(os.listdir(REPO))
+                       if name.endswith('.py'))
+    text = (sources * (size // len(sources) + 1))[:size]
+    noise = random.Random(5).randbytes(size)
+    mixed = b''.join(text[start:start + (1 << 20)] if (start >> 20) % 2 else noise[start:start + (1 << 20)]
+                     for start in range(0, size, 1 << 20))
+    result = {}
+    for codec in compression.CODECS.values():
+        for name, data in (('text', text), ('random', noise), ('mixed', mixed)):
+            started = time.perf_counter()
+            encoded = compression.encode(data, codec)
+            encoding = time.perf_counter() - started
+            view, pos, decoded = memoryview(encoded), 0, []
+            started = time.perf_counter()
+            while pos < len(view):
+                cid, length = compression.BLOCK_HEADER.unpack(view[pos:pos + compression.BLOCK_HEADER.size])
+                pos += compression.BLOCK_HEADER.size
+                decoded.append(compression.decode_block(cid, view[pos:pos + length]))
+                pos += length
+            decoding = time.perf_counter() - started
+            result[f'{codec.name}/{name}'] = {'ratio': round(len(data) / len(encoded), 3),
+                                              'encode_mb_per_second': rate(len(data) / 1e6, encoding),
+                                              'decode_mb_per_second': rate(len(data) / 1e6, decoding)}
+    return result
+
+
+def folder_transfer(scale: float) -> dict:
+    """
+    send_folder and receive_folder over a local socket: many small files and a few big ones
+    """
+    result = {}
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, 'source')
+        files = small_files(int(20000 * scale), 6, folders=100, low=256, high=4 << 10)
+        write_files(source, files)
+        for index in range(3):
+            write_big_file(os.path.join(source, f'big{index}.bin'), int(50e6 * scale), index)
+        size = sum(map(len, files.values())) + 3 * int(50e6 * scale)
+        for codec in [None, *compression.CODECS.values()]:
+            target = os.path.join(root, f'target-{codec.name if codec else "raw"}')
+            seconds, _ = over_socketpair(lambda sock: u.send_folder(source, sock, codec),
+                                         lambda sock: u.receive_folder(target, sock, codec))
+            result[codec.name if codec else 'raw'] = {'files': len(files) + 3, 'seconds': round(seconds, 3),
+                                                     'files_per_second': rate(len(files) + 3, seconds),
+                                                     'mb_per_second': rate(size / 1e6, seconds)}
+    return result
+
+
+def grouped_fsync(scale: float) -> dict:
+    """
+    Flushing every new file on its own against flushing them together, see utils.sync_paths
+    """
+    count = int(2000 * scale)
+    content = bytes(4 << 10)
+    result = {}
+    with tempfile.TemporaryDirectory() as root:
+        for name in ('per_file', 'grouped'):
+            folder = os.path.join(root, name)
+            os.makedirs(folder)
+            paths = [os.path.join(folder, f'f{index}') for index in range(count)]
+            started = time.perf_counter()
+            for path in paths:
+                with open(path, 'wb') as file:
+                    file.write(content)
+                    if name == 'per_file':
+                        file.flush()
+                        os.fsync(file.fileno())
+            if name == 'grouped':
+                u.sync_paths(paths)
+            u.fsync_path(folder)
+            result[name] = {'files': count, 'files_per_second': rate(count, time.perf_counter() - started)}
+    return result
+
+
+def batch_execution(scale: float) -> dict:
+    """
+    A batch of modifies applied by the executor, on its own and with the chunk store tracking every file
+    """
+    count = int(10000 * scale)
+    result = {}
+    with tempfile.TemporaryDirectory() as root, ThreadPoolExecutor(executor.EXECUTOR_WORKERS) as pool:
+        store = chunkstore.ChunkStore(os.path.join(root, 'store'))
+        for name in ('untracked', 'tracked'):
+            folder = os.path.join(root, name)
+            spool = u.state_dir(folder, 'spool')
+            generator = random.Random(7)
+            commands = []
+            for index in range(count):
+                source = u.new_spool_path(spool)
+                with open(source, 'wb') as file:
+                    file.write(generator.randbytes(1 << 10))
+                commands.append(u.Command(u.MODIFY, f'd{index % 100}/f{index}', source=source))
+            track = (lambda command: store.track(name, folder, command)) if name == 'tracked' else None
+            started = time.perf_counter()
+            collapsed = executor.collapse(commands, folder)
+            executed, _ = executor.execute_batch(collapsed, folder, pool, track)
+            seconds = time.perf_counter() - started
+            result[name] = {'commands': len(executed), 'commands_per_second': rate(len(executed), seconds)}
+    return result
+
+
+def cold_scan(scale: float) -> dict:
+    """
+    What a client does when it starts on a big folder: the first scan hashes everything, the next ones only stat
+    """
+    count = int(100000 * scale)
+    result = {'files': count}
+    with tempfile.TemporaryDirectory() as root:
+        folder = os.path.join(root, 'folder')
+        for index in range(count):
+            path = os.path.join(folder, f'd{index // 10000}', f'e{index // 100 % 100}', f'f{index}')
+            if index % 100 == 0:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(str(index).encode())
+        states = filestate.FileStates(folder, os.path.join(root, 'states.db'))
+        result['first_scan_seconds'] = round(timed(states.reset), 3)
+        result['unchanged_scan_seconds'] = round(timed(states.changes), 3)
+        for index in range(0, count, 100):
+            with open(os.path.join(folder, f'd{index // 10000}', f'e{index // 100 % 100}', f'f{index}'), 'ab') as file:
+                file.write(b'!')
+        started = time.perf_counter()
+        changed = states.changes()
+        result['one_percent_changed_seconds'] = round(time.perf_counter() - started, 3)
+        result['changes_found'] = len(changed)
+    return result
+
+
+def journal(scale: float) -> dict:
+    """
+    The server's meta store: starting with many users, and a journal shared by many clients of one user
+    """
+    users, clients, batches = int(100000 * scale), max(2, int(1000 * scale)), 1000
+    result = {}
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'meta.db')
+        meta = metastore.MetaStore(path)
+        started = time.perf_counter()
+        for index in range(users):
+            meta.add_user(f'user{index}', f'folder{index}')
+        result['users'] = users
+        result['add_users_per_second'] = rate(users, time.perf_counter() - started)
+        result['reopen_seconds'] = round(timed(metastore.MetaStore, path), 4)
+        for _ in range(clients - 1):
+            meta.add_client('user0')
+        command = [u.Command(u.CREATE, 'some/path')]
+        started = time.perf_counter()
+        for _ in range(batches):
+            meta.append('user0', command, origin=0)
+        result['clients'] = clients
+        result['appends_per_second'] = rate(batches, time.perf_counter() - started)
+        started = time.perf_counter()
+        for client_id in range(1, clients):
+            meta.acknowledge('user0', client_id, batches)
+        result['acknowledges_per_second'] = rate(clients - 1, time.perf_counter() - started)
+        result['collect_seconds'] = round(timed(meta.collect_garbage, 'user0'), 4)
+    return result
+
+
+END_TO_END = {
+    'small_files': many_small_files,
+    'huge_files': few_huge_files,
+    'rename_storm': rename_storm,
+    'deep_tree': deep_tree,
+    'concurrent_edits': concurrent_edits,
+    'event_burst': event_burst,
+    'propagation': propagation,
+}
+# workloads that set up their own cluster: (clients, scale, keep) -> result
+OWN_CLUSTER = {
+    'many_users': many_users,
+    'dedup': duplicated_dataset,
+    'ignore_rules': ignore_rules,
+}
+MICRO = {
+    'wire_format': wire_format,
+    'compression': compression_codecs,
+    'folder_transfer': folder_transfer,
+    'fsync': grouped_fsync,
+    'batch_execution': batch_execution,
+    'cold_scan': cold_scan,
+    'journal': journal,
+}
+WORKLOADS = [*END_TO_END, *OWN_CLUSTER, *MICRO]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the sync pipeline')
+    parser.add_argument('workloads', nargs='*', help=f'what to run, everything by default: {" ".join(WORKLOADS)}')
+    parser.add_argument('--clients', type=int, default=2, help='clients of the same user in end to end workloads')
+    parser.add_argument('--scale', type=float, default=1, help='multiplies the size of every workload')
+    parser.add_argument('--output', help='write the JSON here as well')
+    parser.add_argument('--server-workers', type=int, default=1, help='worker processes of the server')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directories of the clusters')
+    arguments = parser.parse_args()
+    global SERVER_WORKERS
+    SERVER_WORKERS = arguments.server_workers
+    unknown = set(arguments.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f'unknown workloads: {" ".join(sorted(unknown))}')
+    results = {'revision': git_revision(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'cpus': os.cpu_count(), 'server_workers': SERVER_WORKERS, 'clients': arguments.clients,
+               'scale': arguments.scale, 'workloads': {}}
+    for name in arguments.workloads or WORKLOADS:
+        print(f'running {name}', file=sys.stderr)
+        try:
+            if name in END_TO_END:
+                result = run_end_to_end(END_TO_END[name], arguments.clients, arguments.scale, arguments.keep)
+            elif name in OWN_CLUSTER:
+                result = OWN_CLUSTER[name](arguments.clients, arguments.scale, arguments.keep)
+            else:
+                result = MICRO[name](arguments.scale)
+        except Exception as error:
+            # one broken workload must not lose the results of the others
+            result = {'error': repr(error)}
+        results['workloads'][name] = result
+    output = json.dumps(results, indent=2)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
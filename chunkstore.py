@@ -0,0 +1,402 @@
+"""
+Content addressed storage for the server, with deduplication across all users
+Files are cut into content defined chunks. Every distinct file content is stored once, as an object named by its hash,
+and the users' folders hold hard links to the objects. The chunks of every object are indexed, so an upload sends only
+the chunks the store does not have yet, and per user manifests map every path to the object holding its content
+"""
+import hashlib
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import compression
+import utils as u
+
+# content defined chunking: every byte is mapped to 0 or 1 by a fixed table, and a chunk ends right after WINDOW
+# bytes in a row that map to 1. whether a position is a boundary depends only on the bytes around it, so inserting
+# data moves only the boundaries near the insertion. translate + find keep the whole scan in C
+WINDOW = 11
+BOUNDARY = b'\x01' * WINDOW
+# every second byte of the common text characters (most common first) maps to 1, and every second of the others,
+# so text, json and random data are all cut about as often
+COMMON_TEXT = b' etaoinshrdlcumwfgypbvkjxqzETAOINSHRDLCUMWFGYPBVKJXQZ\n0123456789.,;:_-"\'(){}[]=/<>#*'
+MIN_CHUNK = 1 << 11
+MAX_CHUNK = 1 << 16
+READ_SIZE = 1 << 22
+DIGEST_SIZE = 20
+# the manifest and the answer to it are sent with their length first
+BLOB_LEN = struct.Struct('!Q')
+
+
+def build_byte_map() -> bytes:
+    table = bytearray(256)
+    for group in (COMMON_TEXT, [byte for byte in range(256) if byte not in COMMON_TEXT]):
+        for index, byte in enumerate(group):
+            table[byte] = index % 2
+    return bytes(table)
+
+
+BYTE_MAP = build_byte_map()
+
+
+def digest() -> 'hashlib.blake2b':
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def iter_chunks(file):
+    """
+    Yields the content defined chunks of an open file, reading it once
+    """
+    buff = b''
+    while True:
+        data = file.read(READ_SIZE)
+        buff += data
+        mapped = buff.translate(BYTE_MAP)
+        start = 0
+        # a boundary is searched only where a whole MAX_CHUNK is available, until the end of the file
+        while start < len(buff) and not (data and len(buff) - start <= MAX_CHUNK):
+            found = mapped.find(BOUNDARY, start + MIN_CHUNK - WINDOW, start + MAX_CHUNK)
+            end = found + WINDOW if found != -1 else min(start + MAX_CHUNK, len(buff))
+            yield buff[start:end]
+            start = end
+        buff = buff[start:]
+        if not data:
+            return
+
+
+def chunk_file(path: str) -> (str, list):
+    """
+    Returns the hash of a file (hex) and the hash and size of every chunk of it
+    """
+    file_digest = digest()
+    chunks = []
+    with open(path, 'rb') as file:
+        for chunk in iter_chunks(file):
+            file_digest.update(chunk)
+            chunks.append((hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest(), len(chunk)))
+    return file_digest.hexdigest(), chunks
+
+
+def send_blob(sock: socket.socket, blob: bytes):
+    sock.sendall(BLOB_LEN.pack(len(blob)) + blob)
+
+
+def receive_blob(sock: socket.socket) -> memoryview:
+    length, = BLOB_LEN.unpack(u.receive_exactly(sock, BLOB_LEN.size))
+    return memoryview(u.receive_exactly(sock, length))
+
+
+def upload_folder(folder: str, sock: socket.socket, codec: compression.Codec = None, ignored: callable = None) -> dict:
+    """
+    Client side of the first upload of a folder
+    1. send the manifest: every file with the hashes and sizes of its chunks
+    2. the server answers with a bit for every chunk it wants
+    3. send the wanted chunks, in manifest order, compressed if a codec was agreed on
+    A file that changed between 1 and 3 is left out of the result, the server does not keep it either
+    What ignored(path, is_dir) says is not synced is not walked, see syncignore
+    Returns relative path -> (size, mtime, hash) of every file, as it was when it was hashed
+    """
+    manifest = []
+    hashes = {}
+    for parent_path, dirs_list, files_list in os.walk(folder):
+        relative_parent = os.path.relpath(parent_path, folder)
+        if ignored is not None:
+            dirs_list[:] = [name for name in dirs_list
+                            if not ignored(os.path.normpath(os.path.join(relative_parent, name)), True)]
+        for file in files_list:
+            file_path = os.path.join(parent_path, file)
+            relative_path = os.path.relpath(file_path, folder)
+            if ignored is not None and ignored(relative_path, False):
+                continue
+            stat = os.stat(file_path)
+            file_hash, chunks = chunk_file(file_path)
+            manifest.append((relative_path, chunks))
+            hashes[relative_path] = (stat.st_size, stat.st_mtime, file_hash)
+    parts = [u.encode_varint(len(manifest))]
+    for relative_path, chunks in manifest:
+        path = relative_path.encode()
+        parts.append(u.encode_varint(len(path)) + path + u.encode_varint(len(chunks)))
+        parts.extend(chunk_hash + u.encode_varint(size) for chunk_hash, size in chunks)
+    send_blob(sock, b''.join(parts))
+    wanted = receive_blob(sock)
+    index = 0
+    for relative_path, chunks in manifest:
+        try:
+            file = open(os.path.join(folder, relative_path), 'rb')
+        except OSError:
+            file = None
+        offset = 0
+        # the chunks are read again where the manifest says, the server reads exactly their size
+        for chunk_hash, size in chunks:
+            if wanted[index // 8] & (1 << index % 8):
+                chunk = b''
+                if file is not None:
+                    file.seek(offset)
+                    chunk = file.read(size)
+                if len(chunk) != size or hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest() != chunk_hash:
+                    # the file changed since it was hashed: the server drops it, and as it is not in hashes
+                    # the client sends it once the session is open
+                    hashes.pop(relative_path, None)
+                    chunk = chunk.ljust(size, b'\0')
+                sock.sendall(chunk if codec is None else compression.encode(chunk, codec))
+            index += 1
+            offset += size
+        if file is not None:
+            file.close()
+    return hashes
+
+
+class ChunkStore:
+    """
+    The store lives in one directory on the same disk as the users' folders, so objects can be hard linked into them
+    Objects are never written in place: every write to a folder renames a new file over the link
+    """
+
+    def __init__(self, root: str):
+        self.objects = os.path.join(root, 'objects')
+        self.spool = os.path.join(root, 'spool')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.spool, exist_ok=True)
+        # one connection for all the server's threads
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        with self.__lock, self.__db:
+            # every executed command is a transaction, the write ahead log does not sync the disk for each of them
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                              '(hash BLOB PRIMARY KEY, object TEXT, offset INTEGER, size INTEGER) WITHOUT ROWID')
+            # size and mtime of the file in the user's folder, the object is the hash of its content
+            self.__db.execute('CREATE TABLE IF NOT EXISTS manifests (user TEXT, path TEXT, object TEXT, size INTEGER, '
+                              'mtime REAL, PRIMARY KEY (user, path)) WITHOUT ROWID')
+            # stores made before the two columns existed
+            columns = [row[1] for row in self.__db.execute('PRAGMA table_info(manifests)')]
+            for column, kind in (('size', 'INTEGER'), ('mtime', 'REAL')):
+                if column not in columns:
+                    self.__db.execute(f'ALTER TABLE manifests ADD COLUMN {column} {kind}')
+
+    def object_path(self, object_hash: str) -> str:
+        return os.path.join(self.objects, object_hash[:2], object_hash)
+
+    def locate(self, chunk_hash: bytes):
+        """
+        Returns (object path, offset, size) of a known chunk, None if we do not have it
+        """
+        with self.__lock:
+            row = self.__db.execute('SELECT object, offset, size FROM chunks WHERE hash = ?', (chunk_hash,)).fetchone()
+        return None if row is None else (self.object_path(row[0]), row[1], row[2])
+
+    def missing(self, chunk_hashes: set) -> set:
+        with self.__lock:
+            return {chunk_hash for chunk_hash in chunk_hashes
+                    if self.__db.execute('SELECT 1 FROM chunks WHERE hash = ?', (chunk_hash,)).fetchone() is None}
+
+    def add_object(self, path: str, object_hash: str, chunks: list) -> str:
+        """
+        Make the file at path (in our spool) an object, returns the object's path
+        If we already have this content the file is dropped
+        """
+        object_path = self.object_path(object_hash)
+        if os.path.exists(object_path):
+            os.remove(path)
+            return object_path
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(path, object_path)
+        rows, offset = [], 0
+        for chunk_hash, size in chunks:
+            rows.append((chunk_hash, object_hash, offset, size))
+            offset += size
+        with self.__lock, self.__db:
+            self.__db.executemany('INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?)', rows)
+        return object_path
+
+    def link(self, user_id: str, folder: str, relative_path: str, object_path: str):
+        # the folder's file becomes a hard link to the object, replaced atomically
+        target = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        # renaming a link over another link to the same file does nothing and leaves both
+        if not os.path.exists(target) or not os.path.samefile(target, object_path):
+            temp = u.new_spool_path(self.spool)
+            os.link(object_path, temp)
+            os.replace(temp, target)
+        stat = os.stat(target)
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?)',
+                              (user_id, relative_path, os.path.basename(object_path), stat.st_size, stat.st_mtime))
+
+    def stat(self, user_id: str, relative_path: str):
+        # (size, mtime, hash) of a file in a user's folder, None if the store does not know it
+        with self.__lock:
+            row = self.__db.execute('SELECT size, mtime, object FROM manifests WHERE user = ? AND path = ?',
+                                    (user_id, relative_path)).fetchone()
+        return row
+
+    def ingest(self, user_id: str, folder: str, relative_path: str):
+        """
+        Store the content of a file that was just written to a user's folder
+        """
+        path = os.path.join(folder, relative_path)
+        try:
+            object_hash, chunks = chunk_file(path)
+            # a second link to the file becomes the object, unless we already have this content
+            temp = u.new_spool_path(self.spool)
+            os.link(path, temp)
+        except (FileNotFoundError, IsADirectoryError):
+            return
+        self.link(user_id, folder, relative_path, self.add_object(temp, object_hash, chunks))
+
+    def forget(self, user_id: str, relative_path: str):
+        # a deleted file or folder
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM manifests WHERE user = ? AND (path = ? OR substr(path, 1, ?) = ?)',
+                              (user_id, relative_path, len(relative_path) + 1, relative_path + os.sep))
+
+    def rename(self, user_id: str, old_path: str, new_path: str):
+        # a moved file or folder
+        with self.__lock, self.__db:
+            self.__db.execute('UPDATE OR REPLACE manifests SET path = ? || substr(path, ?) '
+                              'WHERE user = ? AND (path = ? OR substr(path, 1, ?) = ?)',
+                              (new_path, len(old_path) + 1, user_id, old_path, len(old_path) + 1, old_path + os.sep))
+
+    def track(self, user_id: str, folder: str, command: u.Command):
+        """
+        Keep the store in step with a command that was executed on a user's folder
+        """
+        if command.cid in u.CONTENT_COMMANDS or (command.cid == u.CREATE and not command.is_dir):
+            self.ingest(user_id, folder, command.path)
+        elif command.cid == u.DELETE:
+            self.forget(user_id, command.path)
+        elif command.cid == u.MOVE:
+            self.rename(user_id, command.path, command.new_path)
+
+    def receive_folder(self, user_id: str, folder: str, sock: socket.socket, codec: compression.Codec = None):
+        """
+        Server side of upload_folder, every file is rebuilt from the chunks we have and the chunks we receive
+        """
+        view = receive_blob(sock)
+        count, pos = u.decode_varint(view, 0)
+        manifest = []
+        for _ in range(count):
+            path_len, pos = u.decode_varint(view, pos)
+            relative_path = u.checked_path(bytes(view[pos:pos + path_len]).decode())
+            chunk_count, pos = u.decode_varint(view, pos + path_len)
+            chunks = []
+            for _ in range(chunk_count):
+                chunk_hash = bytes(view[pos:pos + DIGEST_SIZE])
+                size, pos = u.decode_varint(view, pos + DIGEST_SIZE)
+                chunks.append((chunk_hash, size))
+            manifest.append((relative_path, chunks))
+        # ask for the first appearance of every chunk we do not have
+        missing = self.missing({chunk_hash for _, chunks in manifest for chunk_hash, _ in chunks})
+        wanted = bytearray((sum(len(chunks) for _, chunks in manifest) + 7) // 8)
+        index = 0
+        for _, chunks in manifest:
+            for chunk_hash, _ in chunks:
+                if chunk_hash in missing:
+                    wanted[index // 8] |= 1 << index % 8
+                    missing.discard(chunk_hash)
+                index += 1
+        send_blob(sock, bytes(wanted))
+        index = 0
+        # chunks received in this upload that are not in an object yet: hash -> (spool file, offset)
+        received = {}
+        # the files are rebuilt first, then flushed to the disk together and only then moved into place
+        rebuilt = []
+        # the file being rebuilt: its temp, its digest so far and the chunks written to it
+        current = None
+        try:
+            for relative_path, chunks in manifest:
+                temp = u.new_spool_path(self.spool)
+                file_digest = digest()
+                written = []
+                current = (temp, file_digest, written)
+                complete = True
+                with open(temp, 'w+b') as out:
+                    offset = 0
+                    for chunk_hash, size in chunks:
+                        if wanted[index // 8] & (1 << index % 8):
+                            data = bytes(u.receive_content(sock, size, codec))
+                            # the client's file changed while it was uploaded
+                            intact = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest() == chunk_hash
+                            complete = complete and intact
+                            received[chunk_hash] = (temp, offset)
+                        else:
+                            data = self.read_chunk(chunk_hash, size, received, out)
+                            complete = complete and data is not None
+                        index += 1
+                        if not complete:
+                            continue
+                        out.seek(offset)
+                        out.write(data)
+                        file_digest.update(data)
+                        written.append((chunk_hash, size))
+                        offset += size
+                current = None
+                if not complete:
+                    print(f'Error: could not rebuild {relative_path} of {user_id}')
+                    os.remove(temp)
+                    received = {chunk_hash: place for chunk_hash, place in received.items() if place[0] != temp}
+                    continue
+                rebuilt.append((relative_path, temp, file_digest.hexdigest(), chunks))
+        except (OSError, EOFError, ValueError):
+            self.salvage(rebuilt, current)
+            raise
+        u.sync_paths([temp for _, temp, _, _ in rebuilt])
+        for relative_path, temp, object_hash, chunks in rebuilt:
+            self.link(user_id, folder, relative_path, self.add_object(temp, object_hash, chunks))
+        u.sync_paths({os.path.dirname(os.path.join(folder, relative_path)) for relative_path, _, _, _ in rebuilt} |
+                     {os.path.dirname(self.object_path(object_hash)) for _, _, object_hash, _ in rebuilt})
+
+    def salvage(self, rebuilt: list, current):
+        """
+        Keep what an upload that was cut off got as objects, with their chunks, the client sends it again
+        without them (see ChunkStore.missing). The objects are not linked, the next collect_garbage removes them
+        current is (temp, digest, chunks) of the file that was being rebuilt, its chunks so far are kept too
+        """
+        kept = [(temp, object_hash, chunks) for _, temp, object_hash, chunks in rebuilt]
+        if current is not None:
+            temp, file_digest, written = current
+            if written and os.path.exists(temp):
+                # what was written after the last whole chunk is cut off
+                os.truncate(temp, sum(size for _, size in written))
+                kept.append((temp, file_digest.hexdigest(), written))
+            elif os.path.exists(temp):
+                os.remove(temp)
+        u.sync_paths([temp for temp, _, _ in kept])
+        for temp, object_hash, chunks in kept:
+            self.add_object(temp, object_hash, chunks)
+
+    def read_chunk(self, chunk_hash: bytes, size: int, received: dict, current):
+        """
+        Read a chunk we already have: from an object, or from a file rebuilt in this upload
+        """
+        if chunk_hash in received:
+            temp, offset = received[chunk_hash]
+            if temp == current.name:
+                current.seek(offset)
+                return current.read(size)
+            with open(temp, 'rb') as file:
+                file.seek(offset)
+                return file.read(size)
+        place = self.locate(chunk_hash)
+        if place is None:
+            return None
+        object_path, offset, _ = place
+        with open(object_path, 'rb') as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def collect_garbage(self):
+        """
+        Remove objects no user folder links to anymore
+        """
+        for parent_path, _, files_list in os.walk(self.objects):
+            for object_hash in files_list:
+                object_path = os.path.join(parent_path, object_hash)
+                if os.stat(object_path).st_nlink > 1:
+                    continue
+                os.remove(object_path)
+                with self.__lock, self.__db:
+                    self.__db.execute('DELETE FROM chunks WHERE object = ?', (object_hash,))
+                    self.__db.execute('DELETE FROM manifests WHERE object = ?', (object_hash,))
@@ -1,29 +1,65 @@
+import functools
 import os
+import queue
 import sys
 import time
 import socket
+import threading
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
+import chunkstore
+import delta
+import filestate
+import merkle
+import metrics
+import syncignore
 import utils as u
+from commandqueue import CommandQueue
+from scheduler import SyncScheduler
 
 
 IP = sys.argv[1]
 PORT = int(sys.argv[2])
 LOCAL_DIRECTORY_PATH = os.path.abspath(sys.argv[3])
-FREQUENCY = int(sys.argv[4]) if sys.argv[4].isnumeric() and len(sys.argv[4]) == u.USER_ID_LENGTH else 10
+# the longest an idle client goes without checking on its session, changes are sent as soon as they settle
+FREQUENCY = int(sys.argv[4]) if sys.argv[4].isnumeric() else 10
 # OPTIONAL : user's id
 USER_ID = sys.argv[5] if len(sys.argv) >= 6 else u.DEFAULT_USER_ID
 # This is the client's serial number in case he connects from more than 1 pc
 # -1 means this is a new computer
 CLIENT_ID = u.DEFAULT_CLIENT_ID
-# send the requests to the server every x seconds
-requests = []
+# who we are to the server, kept next to the folder so a restarted client is the same client again
+IDENTITY_PATH = os.path.join(u.state_dir(LOCAL_DIRECTORY_PATH), 'identity')
+# the requests waiting to be sent to the server, coalesced by path as the events come in
+requests = CommandQueue(LOCAL_DIRECTORY_PATH)
+# sends them when they are due, see SyncScheduler
+scheduler = SyncScheduler(requests, FREQUENCY)
+# the open session with the server, None while disconnected
+session = None
+# our batches the server did not acknowledge yet, they survive reconnects and are sent again with the same number
+outbox = u.Outbox()
+# the number of the last batch the server pushed that we applied, older ones are only acknowledged again
+applied_remote_seq = 0
+# the observer sees the server's updates we apply, see is_echo
+# held while one is applied and its state recorded, so the observer sees both or neither
+applying = threading.Lock()
+# the paths the server's deletes removed, until the observer reports them gone
+removed_by_remote = set()
+# the server's answers to our signature requests, filled by the listening thread
+signature_replies = queue.Queue()
+# the merkle tree of our folder, compared with the server's when we join as a new client
+folder_tree = merkle.MerkleTree(os.path.join(u.state_dir(LOCAL_DIRECTORY_PATH), 'merkle.db'))
+# what we do not sync: the folder's .syncignore and our own selective sync rules, read again when .syncignore changes
+rules = syncignore.load(LOCAL_DIRECTORY_PATH, u.state_dir(LOCAL_DIRECTORY_PATH))
+# what we last synced of every file, so unchanged files are neither read nor sent again
+states = filestate.FileStates(LOCAL_DIRECTORY_PATH, os.path.join(u.state_dir(LOCAL_DIRECTORY_PATH), 'states.db'),
+                              ignored=lambda path, is_dir: rules.ignored(path, is_dir))
 
 
 class FilesObserver:
     """
      This class is responsible for monitoring changes in a given folder
-     When calling the start function (see below), it executes a given operation every X seconds
+     When calling the start function (see below), it executes a given operation whenever the scheduler says so
     """
 
     def __init__(self, path_to_folder: str, created_func: callable,
@@ -45,6 +81,7 @@ class FilesObserver:
             exit(-1)
 
         # some important watchdog constants
+        # every event reaches the functions, they drop the ones on paths that are not synced (see syncignore)
         patterns = ["*"]
         recursively = True
         ignore_patterns = None
@@ -60,24 +97,21 @@ class FilesObserver:
         self.__observer = Observer()
         self.__observer.schedule(handler, path_to_folder, recursive=recursively)
 
-    def start(self, init: callable, operation: callable, frequency: int):
+    def start(self, init: callable, operation: callable, scheduler: SyncScheduler):
         """
         1. execute init function
         while watchdog runs in background:
-            wait X seconds
+            wait until changes are due, or for the next idle check
             do operation()
         """
-        # starting the file's observer previously initiated
-        self.__observer.start()
         # this method loops forever and observes for changes until user interrupts it
         # whenever it observes a change, it calls one of the 4 methods we supplied it with
         try:
             init()
-            while True:
-                # wait X seconds
-                time.sleep(frequency)
-                # call operation -> connect to server and send requests
-                operation()
+            # starting the file's observer previously initiated, after init so a downloaded folder is not sent back
+            self.__observer.start()
+            # call operation -> connect to server and send requests
+            scheduler.run(operation)
         except KeyboardInterrupt:
             self.__observer.stop()
         self.__observer.join()
@@ -87,156 +121,468 @@ def normalize_path_to_local_folder(path: str) -> str:
     return os.path.relpath(path, LOCAL_DIRECTORY_PATH)
 
 
-def connect_tcp(sock: socket.socket, timeout: int):
+def load_identity():
+    """
+    A client that ran on this folder before continues as the same client, unless it was given another user's id
+    """
+    global USER_ID, CLIENT_ID
+    try:
+        with open(IDENTITY_PATH) as file:
+            user_id, client_id = file.read().split()
+    except (FileNotFoundError, ValueError):
+        return
+    if USER_ID in (u.DEFAULT_USER_ID, user_id):
+        USER_ID, CLIENT_ID = user_id, int(client_id)
+
+
+def save_identity():
+    temp = IDENTITY_PATH + '.tmp'
+    with open(temp, 'w') as file:
+        file.write(f'{USER_ID} {CLIENT_ID}')
+    os.replace(temp, IDENTITY_PATH)
+
+
+def connect_tcp(sock: socket.socket, timeout: int) -> bool:
     sock.settimeout(timeout)
     # connect to host
     try:
         sock.connect((IP, PORT))
-    except socket.timeout:
+    except OSError:
         # remotes server in busy
         print('Error: server is busy, cannot connect')
         sock.close()
-        return
+        return False
+    return True
 
 
-def talk_to_remote():
-    global requests
-    print(requests)
+def forget_deltas(batch: list):
+    # our delta files are not needed once the server has the batch
+    for command in batch:
+        if command.cid == u.DELTA:
+            os.remove(command.source)
+
+
+def return_requests(batch: list):
+    # requests that never made it into the outbox go back to the front, in their original order
+    # a delta might not fit the server's copy by the time it is sent again, the file is sent whole instead
+    forget_deltas(batch)
+    # their contents did not reach the server
+    for cmd in batch:
+        if cmd.cid in u.CONTENT_COMMANDS:
+            states.forget(cmd.path)
+    batch = [u.Command(u.MODIFY, cmd.path, source=os.path.join(LOCAL_DIRECTORY_PATH, cmd.path))
+             if cmd.cid == u.DELTA else cmd for cmd in batch]
+    requests.put_back(batch)
+
+
+def apply_remote(command: u.Command, current: u.Session):
+    # the observer will see the changes we are about to make, the states tell it they are synced already
+    with applying:
+        if command.cid == u.DELETE:
+            removed_by_remote.add(os.path.normpath(command.path))
+        try:
+            u.execute_command(command, LOCAL_DIRECTORY_PATH)
+            if command.cid == u.CREATE and not command.is_dir:
+                # the file is empty here and on the server
+                states.refresh(command.path)
+            else:
+                states.track(command)
+        except delta.DeltaMismatch:
+            # our copy is not the one the delta was made against, ask for the whole file
+            states.forget(command.path)
+            current.send_frame(u.FRAME_RESEND, command.path.encode())
+        finally:
+            forget_deltas([command])
+
+
+def make_delta(command: u.Command, current: u.Session) -> (u.Command, int):
     """
-    Connect to remotes and send all requests
-    Then wait for conformation
+    Turn the MODIFY of a big file into a DELTA against the server's copy, if that saves enough
+    Returns the command to send and how many bytes it saves
     """
-    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    connect_tcp(client_sock, u.CONNECTION_TIMEOUT_VAL)
-    # sending user_id + client_id
-    client_sock.sendall(USER_ID.encode() + str(CLIENT_ID).zfill(2).encode())
-    # todo make thread safe
-    # sending num_commands + commands
-    old_requests = requests.copy()
-    u.send_requests(client_sock, requests)
-    # temporarily increase the timeout while waiting for confirmation
-    client_sock.settimeout(u.SPECIAL_TIMEOUT)
     try:
-        # receive all updates from server
-        server_requests = u.receive_requests(client_sock)
-        # execute server requests
-        for cmd in server_requests:
-            u.execute_command(cmd, LOCAL_DIRECTORY_PATH)
-        # A for ACK
-        if client_sock.recv(1) == b'A':
-            # server acked, success
-            # clean the requests send to remote
-            # only contain requests not sent
-            requests = [request for request in requests if request not in old_requests]
-            return
-    except socket.timeout:
-        # server could not complete operation in time
-        print('Error: server had trouble managing requests')
-        exit(-1)
+        size = os.path.getsize(command.source)
+    except OSError:
+        return command, 0
+    if size < delta.DELTA_MIN_SIZE:
+        return command, 0
+    # drop the answer to a request we gave up on before
+    while not signature_replies.empty():
+        signature_replies.get_nowait()
+    current.send_frame(u.FRAME_SIGNATURES_REQUEST, command.path.encode())
+    try:
+        signatures = signature_replies.get(timeout=u.SPECIAL_TIMEOUT)
+    except queue.Empty:
+        return command, 0
+    delta_path = u.new_spool_path(current.spool)
+    try:
+        delta_size = delta.make_delta(command.source, signatures, delta_path)
+    except FileNotFoundError:
+        return command, 0
+    if delta_size is None:
+        return command, 0
+    return u.Command(u.DELTA, command.path, source=delta_path), size - delta_size
+
+
+def is_echo(path: str, is_dir: bool, gone: bool = False) -> bool:
+    """
+    Check if an event was caused by apply_remote: what is on the disk is what the states say the server has
+    gone is for an event that says the path is not there anymore
+    A local change made right after a remote one changes the signature, it is never taken for an echo
+    """
+    with applying:
+        state = states.get(path)
+        if gone:
+            if path in removed_by_remote and state is None:
+                removed_by_remote.discard(path)
+                return True
+            return False
+        try:
+            stat = os.stat(os.path.join(LOCAL_DIRECTORY_PATH, path))
+        except OSError:
+            return False
+        if state is None:
+            return False
+        if is_dir:
+            return state[0] is None and state[2] == stat.st_ino
+        return state[:3] == filestate.signature(stat)
+
+
+def listen_to_remote(current: u.Session):
+    """
+    Runs on its own thread for as long as the session lives
+    Applies the updates the server pushes and collects the server's acknowledgements
+    """
+    global applied_remote_seq
+    waiting_for_heartbeat = False
+    try:
+        while True:
+            try:
+                frame_type, seq, commands = current.read_frame()
+            except socket.timeout:
+                # the server did not answer our last heartbeat
+                if waiting_for_heartbeat:
+                    raise
+                current.send_frame(u.FRAME_HEARTBEAT)
+                waiting_for_heartbeat = True
+                continue
+            waiting_for_heartbeat = False
+            if frame_type == u.FRAME_COMMANDS:
+                # execute server requests, then acknowledge them
+                if seq > applied_remote_seq:
+                    # the server acknowledges our batches in the order it applies them, what it sends before
+                    # the acknowledgement of one of ours was applied before it: ours overwrites it
+                    in_flight = {cmd.path for _, batch in outbox.pending() for cmd in batch
+                                 if cmd.cid in u.CONTENT_COMMANDS}
+                    with metrics.Timed('client.apply'):
+                        for cmd in commands:
+                            if cmd.path in in_flight and (cmd.cid in u.CONTENT_COMMANDS or
+                                                          cmd.cid == u.DELETE and not cmd.is_dir):
+                                u.discard_spooled([cmd])
+                            else:
+                                apply_remote(cmd, current)
+                    applied_remote_seq = seq
+                else:
+                    # sent again after a reconnect, but we applied it before our acknowledgement was lost
+                    u.discard_spooled(commands)
+                current.send_ack(seq)
+                if any(syncignore.IGNORE_FILE in u.command_paths(cmd) for cmd in commands):
+                    # another client changed the rules
+                    reload_rules()
+            elif frame_type == u.FRAME_ACK:
+                # server acked, every batch up to seq was applied
+                forget_deltas(outbox.acknowledge(seq))
+                scheduler.acknowledged(seq)
+            elif frame_type == u.FRAME_SIGNATURES:
+                signature_replies.put(commands)
+            elif frame_type == u.FRAME_RESEND:
+                # a delta we sent did not fit the server's copy, send the whole file
+                path = u.checked_path(commands.decode())
+                requests.push(u.Command(u.MODIFY, path, source=os.path.join(LOCAL_DIRECTORY_PATH, path)))
+    except (OSError, EOFError, ValueError) as error:
+        print(f'Error: lost connection to server: {error!r}')
     finally:
-        client_sock.close()
-    # if we reached here it means the server sent an error code
-    print('Error: unknown error occurred')
-    exit(-1)
+        # whatever the server did not acknowledge stays in the outbox for the next session
+        drop_session(current)
+        # reconnect without waiting for the next idle check
+        scheduler.poke()
+
+
+def open_session() -> bool:
+    """
+    Connect to the server and authenticate once, the connection then stays open
+    A new user uploads his folder and a new client downloads it before the session starts
+    """
+    # this function modifies global variables
+    global USER_ID, CLIENT_ID, session
+    # a first transfer that is cut off starts over as a new user or client, continuing what it got
+    identity = USER_ID, CLIENT_ID
+    # connect to remote
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if not connect_tcp(client_socket, u.CONNECTION_TIMEOUT_VAL):
+        return False
+    try:
+        # the initial transfer may take a while
+        client_socket.settimeout(u.SPECIAL_TIMEOUT)
+        # sending user_id + client_id + the wire format we would like to use
+        client_socket.sendall(USER_ID.encode() + str(CLIENT_ID).zfill(u.CLIENT_ID_LENGTH).encode() + str(u.PROTOCOL_VERSION).encode())
+        # the server answers with the wire format it agreed to
+        version = u.read_protocol_version(client_socket)
+        # then we offer our compression codecs and the server picks one
+        codec = u.offer_codecs(client_socket) if version >= u.PROTOCOL_CODECS else None
+        # and whether it takes us now, a busy server tells us when to come back instead
+        retry_after = u.receive_admission(client_socket) if version >= u.PROTOCOL_ADMISSION else 0
+        if retry_after:
+            print(f'Server is busy, trying again in {retry_after:g} seconds')
+            metrics.count('client.turned_away')
+            scheduler.defer(retry_after)
+            client_socket.close()
+            return False
+        # if new user => receive an id and upload folder
+        if USER_ID == u.DEFAULT_USER_ID:
+            USER_ID = u.read_x_bytes(client_socket, u.USER_ID_LENGTH)
+            # uploading folder to server, only the chunks it does not have yet
+            hashes = chunkstore.upload_folder(LOCAL_DIRECTORY_PATH, client_socket, codec, rules.ignored)
+            CLIENT_ID = 0
+            # everything we have is synced now, but empty folders are not uploaded, catch_up creates them
+            held = {parent for path in hashes for parent in filestate.ancestors(path)}
+            states.reset(hashes.get, lambda path: path in hashes or path in held)
+            save_identity()
+        # if new client => download remote folder
+        elif CLIENT_ID == u.DEFAULT_CLIENT_ID:
+            # get client id
+            CLIENT_ID = int(u.read_x_bytes(client_socket, u.CLIENT_ID_LENGTH))
+            # download folder, or only the files we do not have already
+            if version < u.PROTOCOL_MERKLE:
+                u.receive_folder(LOCAL_DIRECTORY_PATH, client_socket, codec)
+                states.reset()
+            else:
+                _, extra = folder_tree.reconcile(merkle.ROOT, LOCAL_DIRECTORY_PATH, client_socket, codec, states.known,
+                                                 version >= u.PROTOCOL_RESUME, rules.ignored)
+                # the tree has the hashes of everything now, what only we have is not synced yet
+                states.reset(functools.partial(folder_tree.file, merkle.ROOT))
+                for path in extra:
+                    states.forget(path)
+            save_identity()
+    except (OSError, EOFError, ValueError) as error:
+        print(f'Error: could not open a session: {error!r}')
+        USER_ID, CLIENT_ID = identity
+        client_socket.close()
+        return False
+    current = u.Session(client_socket, u.state_dir(LOCAL_DIRECTORY_PATH, 'spool'), version, codec,
+                        u.state_dir(LOCAL_DIRECTORY_PATH, 'partial'))
+    try:
+        # both sides start by acknowledging the last batch they applied, so nothing is applied twice
+        current.send_ack(applied_remote_seq)
+        if version >= u.PROTOCOL_RESUME:
+            # and by telling what they kept of the other's batch that was cut off
+            current.send_resume()
+        if version >= u.PROTOCOL_SELECTIVE:
+            # then we tell what we do not sync, the server pushes none of it
+            current.send_frame(u.FRAME_RULES, rules.text.encode())
+        seq, _ = current.expect_frame(u.FRAME_ACK)
+        if version >= u.PROTOCOL_RESUME:
+            _, kept = current.expect_frame(u.FRAME_RESUME)
+            current.resume_from(kept)
+    except (OSError, EOFError, ValueError) as error:
+        print(f'Error: could not open a session: {error!r}')
+        current.close()
+        return False
+    forget_deltas(outbox.acknowledge(seq))
+    # after a restart our numbers continue from the server's
+    outbox.last_seq = max(outbox.last_seq, seq)
+    # if the server is silent for this long we send a heartbeat
+    client_socket.settimeout(u.HEARTBEAT_INTERVAL)
+    session = current
+    threading.Thread(target=listen_to_remote, args=(current,), daemon=True).start()
+    try:
+        # the batches the server did not get, with their old numbers
+        for seq, batch in outbox.pending():
+            requests.lost([cmd.path for cmd in current.send_commands(seq, batch)])
+    except OSError:
+        # we try again on the next session
+        drop_session(current)
+    return True
+
+
+def drop_session(current: u.Session):
+    """
+    A send failed, maybe after writing part of a frame: nothing more can be sent on this stream
+    The outbox is sent again on the next session
+    """
+    global session
+    current.close()
+    if session is current:
+        session = None
+
+
+def talk_to_remote() -> bool:
+    """
+    Send the requests that are due on the open session, reconnect first if needed
+    The server's acknowledgement arrives on the listening thread
+    Returns False if the server could not be reached
+    """
+    current = session
+    if current is None:
+        if not open_session():
+            return False
+        current = session
+    metrics.gauge('client.queue_depth', len(requests))
+    metrics.gauge('client.outbox_depth', len(outbox))
+    if not requests.ready():
+        return True
+    since = requests.since() or time.monotonic()
+    batch = requests.take()
+    # touched files, and files saved with the same content again, are not sent
+    unchanged = len(batch)
+    with metrics.Timed('client.check_unchanged'):
+        batch = [cmd for cmd in batch if states.track(cmd)]
+    metrics.count('client.unchanged_skipped', unchanged - len(batch))
+    if not batch:
+        return True
+    try:
+        # big modified files are sent as deltas when the server has an older copy
+        with metrics.Timed('client.make_deltas'):
+            for index, cmd in enumerate(batch):
+                if cmd.cid == u.MODIFY:
+                    batch[index], bytes_saved = make_delta(cmd, current)
+                    metrics.count('client.delta_saved_bytes', bytes_saved)
+    except OSError:
+        # the session is dead, try again once we reconnect
+        return_requests(batch)
+        drop_session(current)
+        return False
+    seq = outbox.add(batch)
+    scheduler.sent(seq, since)
+    try:
+        # files that moved before their content was read are sent again from their new place
+        requests.lost([cmd.path for cmd in current.send_commands(seq, batch)])
+    except OSError:
+        # the batch is in the outbox, it is sent again once we reconnect
+        drop_session(current)
+        return False
+    return True
+
+
+def reload_rules():
+    """
+    The folder's .syncignore changed: what it does not ignore anymore is sent, and the server gets the new rules
+    What it ignores now stays on the server as it is
+    """
+    global rules
+    loaded = syncignore.load(LOCAL_DIRECTORY_PATH, u.state_dir(LOCAL_DIRECTORY_PATH))
+    if loaded.text == rules.text:
+        return
+    rules = loaded
+    # what the rules let in now is new to the server
+    for command in states.changes():
+        requests.push(command)
+    current = session
+    if current is not None:
+        # the rules go with the next session
+        current.close()
+
+
+def left_out(path: str, is_dir: bool) -> bool:
+    # the rules do not sync this path, a change to the rules themselves is taken into account first
+    if path == syncignore.IGNORE_FILE:
+        reload_rules()
+    if rules.ignored(path, is_dir):
+        metrics.count('client.events.ignored')
+        return True
+    return False
 
 
 # here we can modify what the observer will do whenever it detects a change
 def on_created(event):
-    print(f'{event.src_path} has been created')
-    # command id => "1"
-    # command format: len(8 characters) + command_id(1 character) + is_folder(1 character) + path
-    command = f'{str(len(normalize_path_to_local_folder(event.src_path)) + u.COMMAND_LEN_SIZE + u.COMMAND_ID_LEN + 1).zfill(u.COMMAND_LEN_SIZE)}' \
-              f'1{str(int(event.is_directory))}{normalize_path_to_local_folder(event.src_path)}'
-    requests.append(command)
+    path = normalize_path_to_local_folder(event.src_path)
+    if is_echo(path, event.is_directory) or left_out(path, event.is_directory):
+        return
+    # made here again after the server deleted it, its deletion is ours from now on
+    removed_by_remote.discard(path)
+    metrics.count('client.events.created')
+    requests.push(u.Command(u.CREATE, path, event.is_directory))
+    if not event.is_directory:
+        # a file that appeared with its content (moved in, or created before its folder was watched)
+        # gets no modified event, the queue merges the two when one does come
+        requests.push(u.Command(u.MODIFY, path, source=event.src_path))
 
 
 def on_deleted(event):
-    print(f'{event.src_path} has been deleted')
-    # command id => "2"
-    # command format: len(8 characters) + command_id(1 character) + is_folder(1 character) + path
-    command = f'{str(len(normalize_path_to_local_folder(event.src_path)) + u.COMMAND_LEN_SIZE + u.COMMAND_ID_LEN + 1).zfill(u.COMMAND_LEN_SIZE)}' \
-              f'2{str(int(event.is_directory))}{normalize_path_to_local_folder(event.src_path)}'
-    requests.append(command)
+    path = normalize_path_to_local_folder(event.src_path)
+    if is_echo(path, event.is_directory, True) or left_out(path, event.is_directory):
+        return
+    metrics.count('client.events.deleted')
+    requests.push(u.Command(u.DELETE, path, event.is_directory))
 
 
 def on_modified(event):
-    # command id => "3"
+    path = normalize_path_to_local_folder(event.src_path)
     # ignore if the modified object is a directory
-    if event.is_directory:
+    if event.is_directory or is_echo(path, False) or left_out(path, False):
         return
-    # todo handle big files
-    # command format: len(8 characters) + command_id(1 character) + path_size(3 character) + path + file
-    path = normalize_path_to_local_folder(event.src_path)
-    path_length = len(path)
-    command_length = os.path.getsize(event.src_path) + \
-                     path_length + u.COMMAND_LEN_SIZE + u.COMMAND_ID_LEN + u.PATH_LEN_SIZE
-    with open(event.src_path, 'r') as file:
-        command = f'{str(command_length).zfill(u.COMMAND_LEN_SIZE)}3' \
-                  f'{str(path_length).zfill(u.PATH_LEN_SIZE)}{path}{file.read()}'
-        print(f'{event.src_path} has been modified  ==>  {command}')
-        requests.append(command)
+    metrics.count('client.events.modified')
+    # only a reference to the file is queued, its content is streamed from the disk when the command is sent
+    requests.push(u.Command(u.MODIFY, path, source=event.src_path))
 
 
 def on_moved(event):
-    print(f'{"folder" if event.is_directory else "file"} {event.src_path} was moved to {event.dest_path}')
-    # command id => "4"
-    # command format: len(8 characters) + command_id(1 character) + old_path_size(3 characters) + old_path + new_path
     old_path = normalize_path_to_local_folder(event.src_path)
     new_path = normalize_path_to_local_folder(event.dest_path)
-    old_path_length = len(old_path)
-    command_length = u.COMMAND_LEN_SIZE + u.COMMAND_ID_LEN + u.PATH_LEN_SIZE + old_path_length + len(new_path)
-    command = f'{str(command_length).zfill(u.COMMAND_LEN_SIZE)}4' \
-              f'{str(old_path_length).zfill(u.PATH_LEN_SIZE)}{old_path}{new_path}'
-    requests.append(command)
-
-
-def new_user():
-    # this function modifies global variables
-    global USER_ID, CLIENT_ID
-    # connect to remote
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    connect_tcp(client_socket, 1000)
-    # build a command from: user_id + client_id + 0 commands => id + '-1' + '00'
-    client_socket.send(f'{u.DEFAULT_USER_ID}{u.DEFAULT_CLIENT_ID}00'.encode())
-    USER_ID = u.read_x_bytes(client_socket, u.USER_ID_LENGTH)
-    # uploading folder to server
-    u.send_folder(LOCAL_DIRECTORY_PATH, client_socket)
-    CLIENT_ID = 0
-    client_socket.close()
+    if states.get(old_path) is None and is_echo(new_path, event.is_directory):
+        return
+    if left_out(old_path, event.is_directory):
+        if left_out(new_path, event.is_directory):
+            return
+        # moved in from what we do not sync, it is new to the server
+        metrics.count('client.events.created')
+        if not event.is_directory:
+            requests.push(u.Command(u.CREATE, new_path))
+            requests.push(u.Command(u.MODIFY, new_path, source=event.dest_path))
+        else:
+            # what is inside is found like the changes made while the client was not running
+            catch_up()
+        return
+    if left_out(new_path, event.is_directory):
+        # moved out of what we sync, it is gone for the server
+        metrics.count('client.events.deleted')
+        requests.push(u.Command(u.DELETE, old_path, event.is_directory))
+        return
+    metrics.count('client.events.moved')
+    requests.push(u.Command(u.MOVE, old_path, event.is_directory, new_path=new_path))
 
 
-def new_client():
-    # this function modifies global variables
-    global CLIENT_ID
-    # connect to remote
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    connect_tcp(client_socket, 1000)
-    # command: user_id + default_client_id + 0 commands
-    client_socket.send(f'{USER_ID}{u.DEFAULT_CLIENT_ID}00'.encode())
-    # get client id
-    CLIENT_ID = u.read_x_bytes(client_socket, 2)
-    # download folder
-    u.receive_folder(LOCAL_DIRECTORY_PATH, client_socket)
-    client_socket.close()
+def catch_up():
+    # what changed here while we were not running, or what only we have after joining
+    commands = states.changes()
+    if commands:
+        print(f'{len(commands)} changes were made while the client was not running')
+    for command in commands:
+        requests.push(command)
 
 
 def initialize():
     print('Initializing...')
-    # if new user => receive an id and upload folder
-    if USER_ID == u.DEFAULT_USER_ID:
-        new_user()
-    # if new client => download remote folder
-    elif CLIENT_ID == u.DEFAULT_CLIENT_ID:
-        new_client()
+    returning = CLIENT_ID != u.DEFAULT_CLIENT_ID
+    if returning:
+        # before the session starts, the updates we missed must not be taken for our own changes
+        catch_up()
+    # until the server is reachable, a first transfer that was cut off continues where it stopped
+    scheduler.retry(open_session)
+    if not returning:
+        catch_up()
     print('Finished initializing')
 
 
 def main():
+    load_identity()
+    # folders deleted before the client stopped
+    u.empty_trash(u.state_dir(LOCAL_DIRECTORY_PATH, 'trash'))
     # start observer
     # make sure to call Observer in right order => path, create, delete, modified, moved
+    metrics.start()
     observer = FilesObserver(LOCAL_DIRECTORY_PATH, on_created, on_deleted, on_modified, on_moved)
-    # every 20 seconds client attempts to connect
-    observer.start(initialize, talk_to_remote, FREQUENCY)
+    observer.start(initialize, talk_to_remote, scheduler)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+import os
+import threading
+import time
+from collections import deque
+import metrics
+import utils as u
+
+# a burst of events is sent once it was quiet for this many seconds
+DEBOUNCE = 0.5
+# but never held longer than this, even if events keep coming
+MAX_DELAY = 5
+# or sent right away once this many commands, or modifies of this many bytes, are pending
+MAX_COMMANDS = 1024
+MAX_BYTES = 64 << 20
+
+
+def is_under(path: str, folder: str) -> bool:
+    return path == folder or path.startswith(folder + os.sep)
+
+
+class CommandQueue:
+    """
+    The commands waiting to be sent, coalesced by path as the observer's events come in
+    - repeated modifies of a file are one modify, its content is read only when it is sent
+    - a file created and then modified is just a modify
+    - anything created and then deleted before it was sent is nothing at all
+    - a file created under a temporary name and renamed (what editors do on save) is a modify of the final name
+    - chains of moves are one move, and pending modifies follow the files that were moved
+    Commands on different paths keep their order
+    The observer thread only appends its events to a deque, which needs no lock
+    Everything else runs on the thread that sends the commands, the events are coalesced there
+    """
+
+    def __init__(self, folder: str, debounce: float = DEBOUNCE, max_delay: float = MAX_DELAY,
+                 max_commands: int = MAX_COMMANDS, max_bytes: int = MAX_BYTES):
+        self.folder = folder
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_commands = max_commands
+        self.max_bytes = max_bytes
+        # set on every event, so the sending thread can sleep until something happens
+        self.wake = threading.Event()
+        # events the sending thread did not see yet
+        self.__events = deque()
+        # sequence number -> command, in the order they will be sent
+        self.__entries = {}
+        # path -> sequence number of the last pending command on it
+        self.__last = {}
+        # paths that did not exist before their first pending command
+        self.__born = set()
+        # files whose content could not be sent because they were moved away, waiting for the move's event
+        self.__lost = set()
+        self.__seq = 0
+        self.__first_event = self.__last_event = None
+        # size of the files the pending modifies read, when they were queued
+        self.__bytes = 0
+
+    def __len__(self) -> int:
+        self.__drain()
+        return len(self.__entries)
+
+    def push(self, command: u.Command):
+        # called from any thread
+        self.__last_event = time.monotonic()
+        self.__events.append(command)
+        self.wake.set()
+
+    def __drain(self):
+        while self.__events:
+            metrics.count('client.queue.events_in')
+            if self.__first_event is None:
+                self.__first_event = time.monotonic()
+            self.__coalesce(self.__events.popleft())
+
+    def due(self):
+        """
+        Seconds until the pending commands should be sent, None if there are none
+        They are due once the current burst of events is over, was held for too long, or grew too big
+        """
+        self.__drain()
+        if not self.__entries:
+            return None
+        if len(self.__entries) >= self.max_commands or self.__bytes >= self.max_bytes:
+            return 0
+        now = time.monotonic()
+        # commands found again after a send come without an event
+        first_event = self.__first_event or now
+        last_event = self.__last_event or now
+        return max(0, min(last_event + self.debounce, first_event + self.max_delay) - now)
+
+    def ready(self) -> bool:
+        return self.due() == 0
+
+    def since(self):
+        # when the first event of the pending commands came in
+        return self.__first_event
+
+    def take(self) -> list:
+        self.__drain()
+        batch = list(self.__entries.values())
+        self.__entries.clear()
+        self.__last.clear()
+        self.__born.clear()
+        self.__first_event = None
+        self.__bytes = 0
+        metrics.count('client.queue.commands_out', len(batch))
+        return batch
+
+    def put_back(self, batch: list):
+        """
+        Commands that did not reach the server go back to the front, in their original order
+        Nothing is coalesced into them
+        """
+        entries = {}
+        for command in batch:
+            self.__seq += 1
+            entries[-self.__seq] = command
+        entries.update(self.__entries)
+        self.__entries = entries
+        metrics.count('client.queue.commands_out', -len(batch))
+        if self.__first_event is None:
+            self.__first_event = self.__last_event = time.monotonic()
+
+    def lost(self, paths: list):
+        """
+        The content of these files could not be read when it was sent, they were moved or deleted meanwhile
+        It is sent again from wherever the moves took them
+        """
+        self.__drain()
+        for path in paths:
+            # follow the moves that are pending already
+            path = u.follow_moves(path, list(self.__entries.values()))
+            if path is not None:
+                self.__found(path)
+
+    def __found(self, path: str):
+        if os.path.isfile(os.path.join(self.folder, path)):
+            self.__coalesce(u.Command(u.MODIFY, path, source=os.path.join(self.folder, path)))
+        else:
+            # moved by an event we did not see yet
+            self.__lost.add(path)
+
+    def __append(self, command: u.Command):
+        if command.cid == u.MODIFY:
+            try:
+                self.__bytes += os.path.getsize(command.source)
+            except OSError:
+                pass
+        self.__seq += 1
+        self.__entries[self.__seq] = command
+        for path in u.command_paths(command):
+            self.__last[path] = self.__seq
+
+    def __forget_under(self, path: str):
+        # later commands must not be merged into commands from before a delete or a move of this path
+        for known in [known for known in self.__last if is_under(known, path)]:
+            del self.__last[known]
+            self.__born.discard(known)
+
+    def __drop_under(self, path: str, cids: tuple) -> list:
+        # remove pending commands on this path or inside it, returns them
+        dropped = [(seq, command) for seq, command in self.__entries.items()
+                   if command.cid in cids and is_under(command.path, path)]
+        for seq, _ in dropped:
+            del self.__entries[seq]
+        return [command for _, command in dropped]
+
+    def __previous(self, path: str):
+        return self.__entries.get(self.__last.get(path))
+
+    def __coalesce(self, command: u.Command):
+        path = command.path
+        previous = self.__previous(path)
+        if command.cid == u.MODIFY:
+            if previous is not None and previous.cid == u.MODIFY:
+                return
+            if previous is not None and previous.cid == u.CREATE and not previous.is_dir:
+                # the modify creates the file anyway
+                self.__entries[self.__last[path]] = command
+                return
+            self.__append(command)
+        elif command.cid == u.CREATE:
+            if previous == command:
+                return
+            if previous is None:
+                self.__born.add(path)
+            self.__append(command)
+        elif command.cid == u.DELETE:
+            born = path in self.__born
+            # nothing done to it or inside it matters anymore, moves out of it do
+            self.__drop_under(path, (u.CREATE, u.MODIFY, u.DELETE))
+            self.__forget_under(path)
+            self.__lost.difference_update([lost for lost in self.__lost if is_under(lost, path)])
+            if not born:
+                self.__append(command)
+        elif command.cid == u.MOVE:
+            self.__coalesce_move(command, previous)
+        else:
+            self.__append(command)
+
+    def __coalesce_move(self, command: u.Command, previous):
+        path, new_path = command.path, command.new_path
+        if path in self.__born and not command.is_dir:
+            # written under a temporary name and renamed: only the content at the new name matters
+            self.__drop_under(path, (u.CREATE, u.MODIFY))
+            self.__forget_under(path)
+            self.__coalesce(u.Command(u.MODIFY, new_path, source=os.path.join(self.folder, new_path)))
+            return
+        # modifies read the file when they are sent, so they have to follow it to its new place
+        seq = self.__last.get(path)
+        moved = self.__drop_under(path, (u.MODIFY,))
+        self.__forget_under(path)
+        self.__forget_under(new_path)
+        if previous is not None and previous.cid == u.MOVE and previous.new_path == path:
+            # x -> path -> new_path is x -> new_path
+            self.__entries[seq] = previous._replace(new_path=new_path)
+            self.__last[new_path] = seq
+        else:
+            self.__append(command)
+        for modified in moved:
+            relative_path = new_path + modified.path[len(path):]
+            self.__append(u.Command(u.MODIFY, relative_path, source=os.path.join(self.folder, relative_path)))
+        for lost in [lost for lost in self.__lost if is_under(lost, path)]:
+            self.__lost.remove(lost)
+            self.__found(new_path + lost[len(path):])
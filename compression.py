@@ -0,0 +1,82 @@
+"""
+Compression of file contents on the wire
+The client offers the codecs it knows when it connects and the server picks one, see utils.offer_codecs
+With a codec, every content is sent as blocks: codec id (0 for a raw block) + length + bytes
+A block that does not shrink enough is sent raw, and the blocks after it are not even tried for a while
+"""
+import struct
+import zlib
+from collections import namedtuple
+
+# cid is what goes on the wire, compress takes and returns bytes, decompress(data, limit) returns at most limit bytes
+# and raises ValueError if there would be more
+Codec = namedtuple('Codec', ['cid', 'name', 'compress', 'decompress'])
+RAW = 0
+# codec id -> codec, the first ones are preferred
+CODECS = {}
+BLOCK_SIZE = 1 << 18
+BLOCK_HEADER = struct.Struct('!BI')
+# the longest a block may be on the wire: what zlib makes of BLOCK_SIZE bytes at worst, the peer sets the length
+MAX_BLOCK_LENGTH = BLOCK_SIZE + (BLOCK_SIZE >> 12) + (BLOCK_SIZE >> 14) + (BLOCK_SIZE >> 25) + 13
+# a block is sent compressed only if it shrinks to this part of its size
+MAX_RATIO = 0.9
+# after a block that did not compress this many blocks are sent raw without trying, already compressed files
+# (images, archives, video) cost almost no cpu this way
+SKIP_BLOCKS = 8
+# contents smaller than this are not worth a try
+MIN_SIZE = 256
+
+
+def register(codec: Codec):
+    if codec.cid == RAW or codec.cid in CODECS:
+        raise ValueError(f'Error: codec id {codec.cid} is taken')
+    CODECS[codec.cid] = codec
+
+
+def inflate(data, limit: int) -> bytes:
+    # a block that inflates to more than limit is refused before it takes the memory
+    inflater = zlib.decompressobj()
+    out = inflater.decompress(data, limit + 1)
+    if len(out) > limit:
+        raise ValueError('Error: a compressed block is too long')
+    if not inflater.eof:
+        raise ValueError('Error: a compressed block is cut off')
+    return out
+
+
+# level 1: most of the ratio of the higher levels on text, at a fraction of the cpu
+register(Codec(1, 'zlib', lambda data: zlib.compress(data, 1), inflate))
+
+
+def encode_blocks(blocks, codec: Codec):
+    """
+    Yields the wire form of every block, the blocks come from one content
+    """
+    skip = 0
+    for block in blocks:
+        if skip:
+            skip -= 1
+        elif len(block) >= MIN_SIZE:
+            packed = codec.compress(block)
+            if len(packed) <= len(block) * MAX_RATIO:
+                yield BLOCK_HEADER.pack(codec.cid, len(packed)) + packed
+                continue
+            skip = SKIP_BLOCKS
+        yield BLOCK_HEADER.pack(RAW, len(block)) + block
+
+
+def encode(data, codec: Codec) -> bytes:
+    # a content that is in memory already
+    view = memoryview(data)
+    return b''.join(encode_blocks((view[i:i + BLOCK_SIZE] for i in range(0, len(view), BLOCK_SIZE)), codec))
+
+
+def decode_block(cid: int, data, limit: int = BLOCK_SIZE):
+    # a block holds at most limit bytes of content, a longer one is refused
+    if cid == RAW:
+        if len(data) > limit:
+            raise ValueError('Error: a block is too long')
+        return data
+    if cid not in CODECS:
+        raise ValueError(f'Error: unknown codec {cid}')
+    return CODECS[cid].decompress(data, limit)
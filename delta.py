@@ -0,0 +1,223 @@
+"""
+rsync style delta transfer of a modified file
+The receiver sends the signatures of the blocks of its current copy: a rolling weak checksum and a strong hash
+The sender looks for those blocks anywhere in the new file, and sends only block references and the bytes in between
+"""
+import hashlib
+import math
+import os
+import struct
+from itertools import accumulate
+
+# files smaller than this are sent whole, the extra round trip costs more than it saves
+DELTA_MIN_SIZE = 1 << 16
+# give up on the delta once its literal bytes pass this part of the file
+DELTA_MAX_RATIO = 0.5
+MIN_BLOCK_SIZE = 2048
+# the new file is read in pieces of this size
+READ_SIZE = 1 << 22
+WEAK_MOD = 1 << 16
+# signatures: block size + number of blocks, then weak checksum + strong hash of every full block
+SIGNATURES_HEADER = struct.Struct('!IQ')
+BLOCK_SIGNATURE = struct.Struct('!I8s')
+# delta: block size + hash of the new file, then operations
+DELTA_HEADER = struct.Struct('!I16s')
+# 'C' + first block + number of blocks: copy consecutive blocks of the old file
+COPY_OP = struct.Struct('!QI')
+# 'L' + length + bytes: literal bytes of the new file
+LITERAL_OP = struct.Struct('!I')
+
+
+class DeltaMismatch(Exception):
+    """
+    The delta does not fit the file it was applied to, the whole file has to be sent instead
+    """
+
+
+def block_size_for(size: int) -> int:
+    # about sqrt(size) blocks of sqrt(size) bytes each, like rsync
+    return max(MIN_BLOCK_SIZE, math.isqrt(size) & ~7)
+
+
+def weak_checksum(block) -> (int, int):
+    # a = sum of the bytes, b = sum of the bytes weighted by their distance from the end of the block
+    return sum(block) % WEAK_MOD, sum(accumulate(block)) % WEAK_MOD
+
+
+def strong_hash(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=8).digest()
+
+
+def signatures(path: str) -> bytes:
+    """
+    The signatures of a file, an empty list if we do not have it
+    """
+    try:
+        file = open(path, 'rb')
+    except OSError:
+        return SIGNATURES_HEADER.pack(0, 0)
+    parts = []
+    with file:
+        block_size = block_size_for(os.fstat(file.fileno()).st_size)
+        while True:
+            block = file.read(block_size)
+            # a partial last block is never matched, it is sent as literal bytes
+            if len(block) < block_size:
+                break
+            a, b = weak_checksum(block)
+            parts.append(BLOCK_SIGNATURE.pack(a | b << 16, strong_hash(block)))
+    return SIGNATURES_HEADER.pack(block_size, len(parts)) + b''.join(parts)
+
+
+def make_delta(path: str, signatures_payload: bytes, delta_path: str):
+    """
+    Write the delta between the file at path and the file the signatures came from to delta_path
+    Returns the size of the delta, or None (and writes nothing) if sending the whole file is better
+    """
+    block_size, count = SIGNATURES_HEADER.unpack_from(signatures_payload)
+    if count == 0:
+        return None
+    # weak checksum -> [(strong hash, block index)]
+    table = {}
+    view = memoryview(signatures_payload)[SIGNATURES_HEADER.size:]
+    for index, (weak, strong) in enumerate(BLOCK_SIGNATURE.iter_unpack(view)):
+        table.setdefault(weak, []).append((strong, index))
+    budget = os.path.getsize(path) * DELTA_MAX_RATIO
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file, open(delta_path, 'wb') as out:
+        # the hash of the new file is known only at the end
+        out.write(DELTA_HEADER.pack(block_size, bytes(16)))
+        buff = bytearray()
+        # the window starts at pos, everything from literal_start to pos has no match
+        pos = literal_start = literal_total = 0
+        # consecutive matched blocks are sent as one copy: [first block, number of blocks]
+        run = None
+        fresh = True
+        a = b = 0
+        eof = False
+
+        def flush_run():
+            nonlocal run
+            if run is not None:
+                out.write(b'C' + COPY_OP.pack(*run))
+                run = None
+
+        def flush_literal(end: int):
+            nonlocal literal_total
+            if end > literal_start:
+                flush_run()
+                out.write(b'L' + LITERAL_OP.pack(end - literal_start))
+                out.write(buff[literal_start:end])
+                literal_total += end - literal_start
+
+        while True:
+            if len(buff) - pos <= block_size and not eof:
+                # everything before the window is settled, keep only the rest and read more
+                flush_literal(pos)
+                del buff[:pos]
+                pos = literal_start = 0
+                chunk = file.read(READ_SIZE)
+                if chunk:
+                    digest.update(chunk)
+                    buff += chunk
+                else:
+                    eof = True
+                continue
+            if len(buff) - pos < block_size:
+                break
+            window = memoryview(buff)[pos:pos + block_size]
+            if fresh:
+                a, b = weak_checksum(window)
+                fresh = False
+            candidates = table.get(a | b << 16)
+            if candidates:
+                strong = strong_hash(window)
+                index = next((i for s, i in candidates if s == strong), None)
+                if index is not None:
+                    window.release()
+                    flush_literal(pos)
+                    if run is not None and run[0] + run[1] == index:
+                        run[1] += 1
+                    else:
+                        flush_run()
+                        run = [index, 1]
+                    pos += block_size
+                    literal_start = pos
+                    fresh = True
+                    continue
+            window.release()
+            if len(buff) - pos == block_size:
+                # the next byte is not read yet, or this was the last window
+                if eof:
+                    break
+                continue
+            # no match here, roll the window one byte forward
+            old_byte, new_byte = buff[pos], buff[pos + block_size]
+            a = (a - old_byte + new_byte) % WEAK_MOD
+            b = (b - block_size * old_byte + a) % WEAK_MOD
+            pos += 1
+            if literal_total + pos - literal_start > budget:
+                break
+        if literal_total + len(buff) - literal_start > budget:
+            out.close()
+            os.remove(delta_path)
+            return None
+        flush_literal(len(buff))
+        flush_run()
+        out.seek(0)
+        out.write(DELTA_HEADER.pack(block_size, digest.digest()))
+    return os.path.getsize(delta_path)
+
+
+def copy_bytes(source, out, size: int, digest) -> int:
+    # returns how many bytes were really copied
+    copied = 0
+    while copied < size:
+        chunk = source.read(min(READ_SIZE, size - copied))
+        if not chunk:
+            break
+        out.write(chunk)
+        digest.update(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def apply_delta(base_path: str, delta_path: str, out_path: str):
+    """
+    Rebuild the new file at out_path from the old file at base_path and a delta
+    Raises DeltaMismatch if the result is not the file the delta was made from, or if the delta is malformed
+    out_path is removed on any failure
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(delta_path, 'rb') as delta, open(base_path, 'rb') as base:
+            out = open(out_path, 'xb')
+            try:
+                with out:
+                    block_size, expected = DELTA_HEADER.unpack(delta.read(DELTA_HEADER.size))
+                    while True:
+                        op = delta.read(1)
+                        if not op:
+                            break
+                        if op == b'C':
+                            first, count = COPY_OP.unpack(delta.read(COPY_OP.size))
+                            base.seek(first * block_size)
+                            if copy_bytes(base, out, count * block_size, digest) != count * block_size:
+                                raise DeltaMismatch(base_path)
+                        elif op == b'L':
+                            length, = LITERAL_OP.unpack(delta.read(LITERAL_OP.size))
+                            if copy_bytes(delta, out, length, digest) != length:
+                                raise DeltaMismatch(delta_path)
+                        else:
+                            raise DeltaMismatch(f'{delta_path}: {op} is not a valid delta operation')
+                if digest.digest() != expected:
+                    raise DeltaMismatch(base_path)
+            except BaseException:
+                # nothing half written is left behind, whatever went wrong
+                os.remove(out_path)
+                raise
+    except FileNotFoundError:
+        raise DeltaMismatch(base_path)
+    except struct.error:
+        # the delta ends in the middle of an operation
+        raise DeltaMismatch(delta_path)
@@ -0,0 +1,183 @@
+"""
+Applies a batch of commands to a folder
+Commands that a later one in the batch makes redundant are dropped first. The rest is split into levels: a command
+goes one level after the last earlier command it conflicts with, which is one on the same path, on a folder above it
+or on something inside it. The commands of a level touch unrelated paths and run in parallel, level after level
+"""
+import os
+from collections import defaultdict
+from concurrent.futures import wait
+import delta
+import utils as u
+
+# threads that apply the commands of a level
+EXECUTOR_WORKERS = 8
+# smaller levels are applied on the calling thread
+MIN_PARALLEL = 16
+
+
+def parents(path: str) -> list:
+    # the folders above a relative path
+    found = []
+    path = os.path.dirname(path)
+    while path:
+        found.append(path)
+        path = os.path.dirname(path)
+    return found
+
+
+def collapse(commands: list, folder: str) -> list:
+    """
+    The commands of a batch without the ones a later command makes redundant, the contents of those are removed
+    - a file written more than once is written once, with its last content
+    - a file that is created and then written is just written
+    - a new file that is written and then moved is written at its new place
+    - a file that is written and then deleted is just deleted, not even that if it is new
+    Commands on a path are not collapsed across a move or a delete of a folder above it
+    """
+    # index in the batch -> command, for the ones kept so far
+    entries = {}
+    # path -> index of the last command on it
+    last = {}
+    # folder -> the paths under it that were in last, so forgetting a folder does not go through every path
+    under = defaultdict(set)
+    # files this batch creates, nothing was at their paths before it
+    born = set()
+    # where this batch moved things, what is under them is not known before the moves are executed
+    moved_to = set()
+    dropped = []
+
+    def forget_under(path: str):
+        for known in [path, *under.pop(path, ())]:
+            last.pop(known, None)
+            born.discard(known)
+
+    def is_new(path: str) -> bool:
+        if os.path.lexists(os.path.join(folder, path)):
+            return False
+        return not any(parent in moved_to for parent in [path, *parents(path)])
+
+    for index, command in enumerate(commands):
+        path = command.path
+        previous_index = last.get(path)
+        previous = entries.get(previous_index)
+        writes = previous is not None and (previous.cid in u.CONTENT_COMMANDS or
+                                           previous.cid == u.CREATE and not previous.is_dir)
+        if command.cid == u.MODIFY and writes:
+            dropped.append(entries.pop(previous_index))
+        elif command.cid == u.CREATE and not command.is_dir and previous is None and is_new(path):
+            born.add(path)
+        elif command.cid == u.MOVE and path in born and previous is not None and previous.cid == u.MODIFY:
+            # the content is renamed into its new place either way
+            del entries[previous_index]
+            forget_under(path)
+            forget_under(command.new_path)
+            command = previous._replace(path=command.new_path)
+        elif command.cid == u.DELETE and not command.is_dir and writes:
+            dropped.append(entries.pop(previous_index))
+            if path in born:
+                forget_under(path)
+                continue
+        if command.cid in (u.DELETE, u.MOVE):
+            forget_under(path)
+        if command.cid == u.MOVE:
+            forget_under(command.new_path)
+            moved_to.add(command.new_path)
+        entries[index] = command
+        for command_path in u.command_paths(command):
+            last[command_path] = index
+            for parent in parents(command_path):
+                under[parent].add(command_path)
+    u.discard_spooled(dropped)
+    return list(entries.values())
+
+
+def levels(commands: list) -> list:
+    """
+    The indexes of the commands, grouped in levels that can run one after the other, see above
+    Costs a lookup per folder above every path, not a comparison of every pair of commands
+    """
+    # path -> the last level of a command on exactly this path
+    on_path = {}
+    # path -> the last level of a command on this path or anything inside it
+    inside = {}
+    grouped = []
+    for index, command in enumerate(commands):
+        paths = u.command_paths(command)
+        level = 0
+        for path in paths:
+            level = max(level, inside.get(path, -1) + 1,
+                        *(on_path.get(parent, -1) + 1 for parent in parents(path)))
+        if level == len(grouped):
+            grouped.append([])
+        grouped[level].append(index)
+        for path in paths:
+            on_path[path] = level
+            for parent in [path, *parents(path)]:
+                inside[parent] = max(inside.get(parent, -1), level)
+    return grouped
+
+
+def touched_folders(commands: list, folder: str) -> set:
+    # the folders whose entries the commands change, with the ones above them that they might have created
+    touched = {folder}
+    for command in commands:
+        for path in u.command_paths(command):
+            touched.update(os.path.join(folder, parent) for parent in parents(path))
+    return touched
+
+
+def execute_batch(commands: list, folder: str, pool, track: callable = None, done_levels: int = 0,
+                  resume: bool = False, on_level: callable = None) -> (list, list):
+    """
+    Execute a collapsed batch, track(command) is called on the worker right after each command
+    Returns the commands that were executed, in their order, and the deltas that did not fit our copy
+    Any other error is raised once the level it happened in is over
+    Nothing is synced to the disk per file: the new contents are flushed together before the first level,
+    and the folders a level changed together after it, then on_level(number of levels done) is called
+    With resume the batch continues after done_levels, the next level may have been executed in part
+    """
+    executed = [False] * len(commands)
+    mismatched = []
+
+    def run(indexes: list, resuming: bool):
+        for index in indexes:
+            command = commands[index]
+            try:
+                # a content that is not in the spool anymore was renamed into place before the crash
+                if not resuming or command.cid != u.MODIFY or os.path.lexists(command.source):
+                    u.execute_command(command, folder)
+                if track is not None:
+                    track(command)
+                executed[index] = True
+            except delta.DeltaMismatch:
+                if resuming:
+                    # it fitted our copy before the crash, so it was applied already
+                    executed[index] = True
+                else:
+                    mismatched.append(command)
+
+    grouped = levels(commands)
+    for level in grouped[:done_levels]:
+        for index in level:
+            # a delta that did not fit was dropped, see apply_commands
+            executed[index] = commands[index].cid != u.DELTA or os.path.exists(commands[index].source)
+    u.sync_paths([commands[index].source for level in grouped[done_levels:] for index in level
+                  if commands[index].cid in u.CONTENT_COMMANDS], pool)
+    for number in range(done_levels, len(grouped)):
+        level = grouped[number]
+        resuming = resume and number == done_levels
+        if len(level) < MIN_PARALLEL:
+            # not worth the threads
+            run(level, resuming)
+        else:
+            # a slice of the level per worker, a task per command would cost more than most commands
+            futures = [pool.submit(run, level[start::EXECUTOR_WORKERS], resuming)
+                       for start in range(EXECUTOR_WORKERS)]
+            wait(futures)
+            for future in futures:
+                future.result()
+        u.sync_paths(touched_folders([commands[index] for index in level], folder), pool)
+        if on_level is not None:
+            on_level(number + 1)
+    return [command for index, command in enumerate(commands) if executed[index]], mismatched
@@ -0,0 +1,324 @@
+"""
+What the client last synced of every file: its stat signature (size, mtime, inode) and the hash of its content
+A file whose signature did not change since is not read again, and one whose content hashes the same as before
+(a touch, or an editor saving the same content again) is not sent again
+Directories are kept too, with their inode only, so what changed while the client was not running can be found
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import merkle
+import utils as u
+
+# entries kept in memory, the least recently used ones are read from the disk again when they are needed
+MAX_CACHED = 1 << 16
+
+
+def signature(stat: os.stat_result) -> tuple:
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+def list_dir(folder: str, relative_folder: str, ignored: callable = None) -> list:
+    # runs on a worker: (relative path, is_dir, size, mtime, inode) of everything in a directory, a stat per file
+    listed = []
+    with os.scandir(os.path.join(folder, relative_folder)) as entries:
+        for entry in entries:
+            path = os.path.join(relative_folder, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if ignored is None or not ignored(path, True):
+                    # the inode comes with the directory entry
+                    listed.append((path, True, None, None, entry.inode()))
+            elif entry.is_file(follow_symlinks=False) and (ignored is None or not ignored(path, False)):
+                listed.append((path, False, *signature(entry.stat(follow_symlinks=False))))
+    return listed
+
+
+def scan(folder: str, ignored: callable = None) -> dict:
+    """
+    Relative path -> (is_dir, size, mtime, inode) of everything in a folder but what ignored(path, is_dir) says
+    The directories are listed in parallel, a scandir per directory, ignored ones are not listed at all
+    """
+    found = {}
+    with ThreadPoolExecutor(u.FOLDER_WORKERS) as pool:
+        pending = {pool.submit(list_dir, folder, merkle.ROOT, ignored)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for listed in done:
+                for path, is_dir, size, mtime, inode in listed.result():
+                    found[path] = (is_dir, size, mtime, inode)
+                    if is_dir:
+                        pending.add(pool.submit(list_dir, folder, path, ignored))
+    return found
+
+
+def ancestors(path: str) -> list:
+    # the directories above a path, the closest first
+    parents = []
+    path = os.path.dirname(path)
+    while path != merkle.ROOT:
+        parents.append(path)
+        path = os.path.dirname(path)
+    return parents
+
+
+class FileStates:
+    """
+    Kept in SQLite next to the folder, every change is written through, the most recently used entries are cached
+    Used from the sending thread and the listening thread
+    Paths that ignored(path, is_dir) says are not synced are neither scanned nor taken for deleted, see syncignore
+    """
+
+    def __init__(self, folder: str, path: str, max_cached: int = MAX_CACHED, ignored: callable = None):
+        self.folder = folder
+        self.max_cached = max_cached
+        self.ignored = ignored
+        # relative path -> (size, mtime, inode, hash), least recently used first
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS states (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                              'inode INTEGER, hash TEXT) WITHOUT ROWID')
+
+    def __get(self, path: str):
+        state = self.__cache.get(path)
+        if state is not None:
+            self.__cache.move_to_end(path)
+            return state
+        state = self.__db.execute('SELECT size, mtime, inode, hash FROM states WHERE path = ?', (path,)).fetchone()
+        if state is not None:
+            self.__remember(path, state)
+        return state
+
+    def __remember(self, path: str, state: tuple):
+        self.__cache[path] = state
+        self.__cache.move_to_end(path)
+        while len(self.__cache) > self.max_cached:
+            self.__cache.popitem(last=False)
+
+    def __set(self, path: str, state: tuple):
+        self.__db.execute('INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?)', (path, *state))
+        self.__remember(path, state)
+
+    def __parents(self, path: str):
+        # the directories above a synced file were synced too
+        path = os.path.dirname(path)
+        while path != merkle.ROOT and self.__get(path) is None:
+            try:
+                inode = os.stat(os.path.join(self.folder, path)).st_ino
+            except FileNotFoundError:
+                return
+            self.__set(path, (None, None, inode, None))
+            path = os.path.dirname(path)
+
+    def __forget(self, path: str):
+        self.__db.execute('DELETE FROM states WHERE path = ?', (path,))
+        self.__db.execute('DELETE FROM states WHERE path >= ? AND path < ?', merkle.inside(path))
+        for cached in [cached for cached in self.__cache if cached == path or cached.startswith(path + os.sep)]:
+            del self.__cache[cached]
+
+    def get(self, path: str):
+        # (size, mtime, inode, hash) of the file when we last synced it, None if we did not
+        with self.__lock:
+            return self.__get(path)
+
+    def known(self, path: str):
+        # (size, mtime, hash), what merkle takes to skip hashing a file again
+        state = self.get(path)
+        return None if state is None else (state[0], state[1], state[3])
+
+    def refresh(self, path: str) -> bool:
+        """
+        Bring the state of a file up to date with the disk, returns True if its content changed
+        A file is hashed only if its signature changed, even if its size did: the state keeps the hash of every file
+        (a hash of None is how a directory is told apart, see changes) and merkle takes it from here, see known
+        """
+        try:
+            stat = os.stat(os.path.join(self.folder, path))
+        except (FileNotFoundError, NotADirectoryError):
+            self.forget(path)
+            return True
+        with self.__lock:
+            state = self.__get(path)
+        if state is not None and state[:3] == signature(stat):
+            return False
+        hashed = merkle.file_hash(os.path.join(self.folder, path))
+        with self.__lock, self.__db:
+            self.__set(path, (*signature(stat), hashed))
+            self.__parents(path)
+        return state is None or state[3] != hashed
+
+    def add_dir(self, path: str):
+        try:
+            inode = os.stat(os.path.join(self.folder, path)).st_ino
+        except FileNotFoundError:
+            return
+        with self.__lock, self.__db:
+            self.__set(path, (None, None, inode, None))
+            self.__parents(path)
+
+    def reset(self, known=None, synced=None):
+        """
+        Take what is on the disk as synced, after the whole folder was uploaded or downloaded
+        known(path) may give (size, mtime, hash) of a file as it was transferred, so it is not hashed again
+        A file that changed since then is left out, so changes() finds it
+        synced(path) may tell which paths the server got, the others are found by changes()
+        """
+        found = scan(self.folder, self.ignored)
+        states = {}
+        for path, (is_dir, size, mtime, inode) in found.items():
+            if synced is not None and not synced(path):
+                continue
+            if is_dir:
+                states[path] = (None, None, inode, None)
+                continue
+            row = known(path) if known is not None else None
+            if row is not None and row[:2] == (size, mtime):
+                states[path] = (size, mtime, inode, row[2])
+            elif row is not None:
+                # changed since it was transferred, what the server has is not this: changes() sends it
+                continue
+            else:
+                try:
+                    states[path] = (size, mtime, inode, merkle.file_hash(os.path.join(self.folder, path)))
+                except FileNotFoundError:
+                    pass
+        with self.__lock, self.__db:
+            self.__cache.clear()
+            self.__db.execute('DELETE FROM states')
+            self.__db.executemany('INSERT INTO states VALUES (?, ?, ?, ?, ?)',
+                                  [(path, *state) for path, state in states.items()])
+
+    def changes(self) -> list:
+        """
+        The commands that take the server from what we last synced to what is on the disk now
+        These are the changes made while the client was not running, watchdog reports only live ones
+        Renames are found by inode, or by content for files that were copied and then deleted
+        """
+        found = scan(self.folder, self.ignored)
+        with self.__lock:
+            synced = {path: (size, mtime, inode, hashed) for path, size, mtime, inode, hashed in
+                      self.__db.execute('SELECT path, size, mtime, inode, hash FROM states')}
+        if self.ignored is not None:
+            # what was synced before the rules ignored it stays on the server
+            synced = {path: state for path, state in synced.items() if not self.ignored(path, state[3] is None)}
+        # a path that changed between a file and a directory is gone and new at the same time
+        gone = {path for path, state in synced.items() if path not in found or found[path][0] != (state[3] is None)}
+        by_inode = {synced[path][2]: path for path in gone}
+        modified = [path for path, (is_dir, size, mtime, _) in found.items() if not is_dir and path not in gone
+                    and path in synced and synced[path][:2] != (size, mtime)]
+        # (old path, new path, is_dir)
+        moves = []
+        created = []
+        added = []
+        # new paths that turned out to be inside a moved directory
+        moved_with = set()
+        for path in sorted(path for path in found if path not in synced or path in gone):
+            if path in moved_with:
+                continue
+            is_dir, size, mtime, inode = found[path]
+            old_path = by_inode.get(inode)
+            # a renamed file keeps its size and mtime, a deleted file's inode may be reused by another
+            if not self.__movable(old_path, path, is_dir, synced, gone) or \
+                    not is_dir and synced[old_path][:2] != (size, mtime):
+                (created if is_dir else added).append(path)
+                continue
+            gone.discard(old_path)
+            moves.append((old_path, path, is_dir))
+            if not is_dir:
+                continue
+            # what was inside the directory moved with it
+            for inner in [inner for inner in gone if inner.startswith(old_path + os.sep)]:
+                target = path + inner[len(old_path):]
+                if target in found and found[target][0] == (synced[inner][3] is None) and target not in synced:
+                    gone.discard(inner)
+                    moved_with.add(target)
+                    if not found[target][0] and found[target][1:3] != synced[inner][:2]:
+                        modified.append(target)
+        # new files with the content of a file that is gone
+        by_size = defaultdict(list)
+        for path in gone:
+            if synced[path][3] is not None:
+                by_size[synced[path][0]].append(path)
+        for path in added:
+            hashed = None
+            for old_path in by_size.get(found[path][1], []):
+                if not self.__movable(old_path, path, False, synced, gone):
+                    continue
+                if hashed is None:
+                    try:
+                        hashed = merkle.file_hash(os.path.join(self.folder, path))
+                    except FileNotFoundError:
+                        break
+                if synced[old_path][3] == hashed:
+                    gone.discard(old_path)
+                    moves.append((old_path, path, False))
+                    break
+            else:
+                modified.append(path)
+        return self.__order(moves, created, modified, gone, synced)
+
+    @staticmethod
+    def __movable(old_path, path: str, is_dir: bool, synced: dict, gone: set) -> bool:
+        # a move onto a path that was synced, or under one that was a file, could not be done on the server
+        if old_path not in gone or (synced[old_path][3] is None) != is_dir or path in synced:
+            return False
+        return not any(parent in synced and synced[parent][3] is not None for parent in ancestors(path))
+
+    def __order(self, moves: list, created: list, modified: list, gone: set, synced: dict) -> list:
+        """
+        Put the changes in an order the server can execute
+        Deletes come first, but a directory that something was moved out of is deleted after the move
+        Moves go by their new paths, so a moved directory is in place before anything is moved into it,
+        and new directories are created right before something is moved into them
+        """
+        holding = {parent for old_path, _, _ in moves for parent in ancestors(old_path)}
+        # what is in a deleted directory is deleted with it
+        gone = sorted(path for path in gone if os.path.dirname(path) not in gone)
+        commands = [u.Command(u.DELETE, path, synced[path][3] is None) for path in gone if path not in holding]
+        to_create = set(created)
+        for old_path, path, is_dir in sorted(moves, key=lambda move: move[1]):
+            for parent in reversed(ancestors(path)):
+                if parent in to_create:
+                    to_create.remove(parent)
+                    commands.append(u.Command(u.CREATE, parent, True))
+            commands.append(u.Command(u.MOVE, u.follow_moves(old_path, commands), is_dir, new_path=path))
+        commands.extend(u.Command(u.DELETE, u.follow_moves(path, commands), True) for path in gone if path in holding)
+        commands.extend(u.Command(u.CREATE, path, True) for path in sorted(to_create))
+        commands.extend(u.Command(u.MODIFY, path, source=os.path.join(self.folder, path)) for path in modified)
+        return commands
+
+    def forget(self, path: str):
+        # a deleted file or folder
+        with self.__lock, self.__db:
+            self.__forget(path)
+
+    def move(self, old_path: str, new_path: str):
+        # a moved file or folder keeps its states, renames keep the inode and the mtime
+        with self.__lock, self.__db:
+            self.__forget(new_path)
+            self.__db.execute('UPDATE states SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?',
+                              (new_path, len(old_path) + 1, *merkle.inside(old_path)))
+            self.__db.execute('UPDATE states SET path = ? WHERE path = ?', (new_path, old_path))
+            for cached in [cached for cached in self.__cache if cached == old_path or
+                           cached.startswith(old_path + os.sep)]:
+                del self.__cache[cached]
+
+    def track(self, command: u.Command) -> bool:
+        """
+        Keep the states in step with a command that was synced, returns False for a modify that changes nothing
+        """
+        if command.cid in u.CONTENT_COMMANDS:
+            return self.refresh(command.path)
+        if command.cid == u.CREATE and command.is_dir:
+            self.add_dir(command.path)
+        if command.cid == u.DELETE or command.cid == u.CREATE and not command.is_dir:
+            # the server has an empty file after a create, not what is on the disk
+            self.forget(command.path)
+        elif command.cid == u.MOVE:
+            self.move(command.path, command.new_path)
+        return True
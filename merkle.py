@@ -0,0 +1,346 @@
+"""
+Merkle tree of a synced folder: the hash of every file, and of every directory over the names and hashes inside it
+Two folders with the same root hash hold the same files, and the files that differ are found by walking down from the
+root only through the directories whose hashes differ, one round trip per level
+The trees of many folders are kept in one SQLite database, by name
+"""
+import os
+import socket
+import sqlite3
+import threading
+import chunkstore
+import utils as u
+
+ROOT = ''
+# a missing directory in a listing
+NO_HASH = bytes(chunkstore.DIGEST_SIZE)
+
+
+def file_hash(path: str) -> str:
+    # the same hash chunkstore names its objects by
+    file_digest = chunkstore.digest()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(chunkstore.READ_SIZE), b''):
+            file_digest.update(block)
+    return file_digest.hexdigest()
+
+
+def parent_of(path: str):
+    return None if path == ROOT else os.path.dirname(path)
+
+
+def inside(path: str) -> (str, str):
+    # every path below a directory sorts between these two, so the primary key finds them without a scan
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+def encode_paths(paths: list) -> bytes:
+    encoded = [path.encode() for path in paths]
+    return u.encode_varint(len(encoded)) + b''.join(u.encode_varint(len(path)) + path for path in encoded)
+
+
+def decode_paths(view: memoryview, pos: int) -> (list, int):
+    count, pos = u.decode_varint(view, pos)
+    paths = []
+    for _ in range(count):
+        length, pos = u.decode_varint(view, pos)
+        paths.append(bytes(view[pos:pos + length]).decode())
+        pos += length
+    return paths, pos
+
+
+class MerkleTree:
+    """
+    A node for every file and directory: its hash, and the size and modification time the hash was computed at
+    A change clears the hashes of the directories above it, they are computed again only when they are asked for
+    """
+
+    def __init__(self, path: str):
+        # one connection for all the threads
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS nodes (tree TEXT, path TEXT, parent TEXT, is_dir INTEGER, '
+                              'hash TEXT, size INTEGER, mtime REAL, PRIMARY KEY (tree, path)) WITHOUT ROWID')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS children ON nodes (tree, parent)')
+
+    def __touch(self, tree: str, path: str):
+        # the directories above a changed path exist, and their hashes are computed again
+        while path != ROOT:
+            path = os.path.dirname(path)
+            row = self.__db.execute('SELECT is_dir, hash FROM nodes WHERE tree = ? AND path = ?', (tree, path)).fetchone()
+            if row is not None and row[0] and row[1] is None:
+                # and so are the ones above it already
+                return
+            self.__db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, 1, NULL, NULL, NULL)',
+                              (tree, path, parent_of(path)))
+
+    def __remove(self, tree: str, path: str):
+        # two statements, with an OR the primary key would not be used
+        self.__db.execute('DELETE FROM nodes WHERE tree = ? AND path = ?', (tree, path))
+        self.__db.execute('DELETE FROM nodes WHERE tree = ? AND path >= ? AND path < ?', (tree, *inside(path)))
+        self.__touch(tree, path)
+
+    def __set_file(self, tree: str, path: str, hashed: str, size: int, mtime: float):
+        # whatever was at the path before, a directory too
+        self.__remove(tree, path)
+        self.__db.execute('INSERT INTO nodes VALUES (?, ?, ?, 0, ?, ?, ?)',
+                          (tree, path, parent_of(path), hashed, size, mtime))
+
+    def __add_dir(self, tree: str, path: str):
+        row = self.__db.execute('SELECT is_dir FROM nodes WHERE tree = ? AND path = ?', (tree, path)).fetchone()
+        if row is not None and row[0]:
+            return
+        self.__db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, 1, NULL, NULL, NULL)',
+                          (tree, path, parent_of(path)))
+        self.__touch(tree, path)
+
+    def __move(self, tree: str, old_path: str, new_path: str):
+        self.__remove(tree, new_path)
+        self.__db.execute('UPDATE nodes SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) '
+                          'WHERE tree = ? AND path >= ? AND path < ?',
+                          (new_path, len(old_path) + 1, new_path, len(old_path) + 1, tree, *inside(old_path)))
+        self.__db.execute('UPDATE nodes SET path = ?, parent = ? WHERE tree = ? AND path = ?',
+                          (new_path, parent_of(new_path), tree, old_path))
+        self.__touch(tree, old_path)
+        self.__touch(tree, new_path)
+
+    def __update(self, tree: str, folder: str, path: str, known=None):
+        """
+        Hash the file at path again, unless its size and modification time did not change
+        known(path) may give (size, mtime, hash) of the file from somewhere else
+        """
+        try:
+            stat = os.stat(os.path.join(folder, path))
+        except FileNotFoundError:
+            self.__remove(tree, path)
+            return
+        row = self.__db.execute('SELECT size, mtime, hash FROM nodes WHERE tree = ? AND path = ? AND is_dir = 0',
+                                (tree, path)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime):
+            return
+        row = known(path) if known is not None else None
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime):
+            hashed = row[2]
+        else:
+            hashed = file_hash(os.path.join(folder, path))
+        self.__set_file(tree, path, hashed, stat.st_size, stat.st_mtime)
+
+    def __hash(self, tree: str, path: str):
+        # the hash of a node, a directory's is computed from its children if a change cleared it, None if not found
+        row = self.__db.execute('SELECT is_dir, hash FROM nodes WHERE tree = ? AND path = ?', (tree, path)).fetchone()
+        if row is None:
+            # an empty folder has no nodes at all
+            return self.__dir_hash(tree, path) if path == ROOT else None
+        return row[1] if row[1] is not None else self.__dir_hash(tree, path)
+
+    def __dir_hash(self, tree: str, path: str) -> str:
+        dir_digest = chunkstore.digest()
+        for name, is_dir, hashed in self.__children(tree, path):
+            dir_digest.update(f'{name}\0{is_dir}\0{hashed}\n'.encode())
+        hashed = dir_digest.hexdigest()
+        self.__db.execute('UPDATE nodes SET hash = ? WHERE tree = ? AND path = ?', (hashed, tree, path))
+        return hashed
+
+    def __children(self, tree: str, path: str) -> list:
+        # (name, is_dir, hash) of every node in a directory, by name
+        rows = self.__db.execute('SELECT path, is_dir, hash FROM nodes WHERE tree = ? AND parent = ? ORDER BY path',
+                                 (tree, path)).fetchall()
+        return [(os.path.basename(child), is_dir, hashed if hashed is not None else self.__dir_hash(tree, child))
+                for child, is_dir, hashed in rows]
+
+    def track(self, tree: str, folder: str, command: u.Command, known=None):
+        """
+        Keep the tree in step with a command that was executed on the folder
+        """
+        with self.__lock, self.__db:
+            if command.cid == u.CREATE and command.is_dir:
+                self.__add_dir(tree, command.path)
+            elif command.cid == u.DELETE:
+                self.__remove(tree, command.path)
+            elif command.cid == u.MOVE:
+                self.__move(tree, command.path, command.new_path)
+            else:
+                self.__update(tree, folder, command.path, known)
+
+    def refresh(self, tree: str, folder: str, known=None, ignored: callable = None):
+        """
+        Bring the tree up to date with the folder on the disk, costs a stat per file
+        Only the files whose size or modification time changed are hashed again
+        What ignored(path, is_dir) says is not synced is left out of the tree, see syncignore
+        """
+        with self.__lock, self.__db:
+            stored = {path: (is_dir, size, mtime) for path, is_dir, size, mtime in self.__db.execute(
+                'SELECT path, is_dir, size, mtime FROM nodes WHERE tree = ?', (tree,))}
+            seen = {ROOT}
+            folders = [ROOT]
+            while folders:
+                relative_folder = folders.pop()
+                with os.scandir(os.path.join(folder, relative_folder)) as entries:
+                    for entry in entries:
+                        path = os.path.join(relative_folder, entry.name)
+                        if ignored is not None and ignored(path, entry.is_dir(follow_symlinks=False)):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(path)
+                            if stored.get(path, (0,))[0] != 1:
+                                self.__add_dir(tree, path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            if stored.get(path) != (0, stat.st_size, stat.st_mtime):
+                                self.__update(tree, folder, path, known)
+                        else:
+                            continue
+                        seen.add(path)
+            removed = None
+            for path in sorted(set(stored) - seen):
+                # what was inside a removed directory is gone with it
+                if removed is None or not (path + os.sep).startswith(removed + os.sep):
+                    self.__remove(tree, path)
+                    removed = path
+
+    def file(self, tree: str, path: str):
+        # (size, mtime, hash) of a file, None if it is not one
+        with self.__lock:
+            return self.__db.execute('SELECT size, mtime, hash FROM nodes WHERE tree = ? AND path = ? AND is_dir = 0',
+                                     (tree, path)).fetchone()
+
+    def has(self, tree: str) -> bool:
+        with self.__lock:
+            return self.__db.execute('SELECT 1 FROM nodes WHERE tree = ? LIMIT 1', (tree,)).fetchone() is not None
+
+    def hash(self, tree: str, path: str = ROOT):
+        with self.__lock, self.__db:
+            return self.__hash(tree, path)
+
+    def listing(self, tree: str, path: str):
+        """
+        The hash of a directory and the (name, is_dir, hash) of everything in it, None if it is not a directory
+        """
+        with self.__lock, self.__db:
+            hashed = self.__hash(tree, path)
+            row = self.__db.execute('SELECT is_dir FROM nodes WHERE tree = ? AND path = ?', (tree, path)).fetchone()
+            if hashed is None or row is not None and not row[0]:
+                return None
+            return hashed, self.__children(tree, path)
+
+    def serve_reconcile(self, tree: str, folder: str, sock: socket.socket, codec=None, resumable: bool = False):
+        """
+        Server side of reconcile: answer the listings the client asks for, then send the files it wants
+        With resumable the client says how much it kept of every file it wants, only the rest is sent
+        """
+        while True:
+            paths, _ = decode_paths(chunkstore.receive_blob(sock), 0)
+            if not paths:
+                break
+            parts = []
+            for path in paths:
+                path = path if path == ROOT else u.checked_path(path)
+                found = self.listing(tree, path)
+                if found is None:
+                    parts.append(NO_HASH + u.encode_varint(0))
+                    continue
+                hashed, children = found
+                parts.append(bytes.fromhex(hashed) + u.encode_varint(len(children)))
+                for name, is_dir, child_hash in children:
+                    name = name.encode()
+                    parts.append(u.encode_varint(len(name)) + name + bytes([is_dir]) + bytes.fromhex(child_hash))
+            chunkstore.send_blob(sock, b''.join(parts))
+        wanted = [u.checked_path(path) for path in decode_paths(chunkstore.receive_blob(sock), 0)[0]]
+        offsets = {}
+        if resumable:
+            view, pos = chunkstore.receive_blob(sock), 0
+            for path in wanted:
+                offsets[path], pos = u.decode_varint(view, pos)
+        u.send_folder(folder, sock, codec, [(path, os.path.join(folder, path)) for path in wanted], offsets)
+
+    def reconcile(self, tree: str, folder: str, sock: socket.socket, codec=None, known=None,
+                  resumable: bool = False, ignored: callable = None) -> (list, list):
+        """
+        Bring a local folder to the remote folder's content, transferring only the files that differ
+        1. ask for the listings of the directories whose hashes differ, level by level from the root
+        2. an empty request ends the walk, then ask for the files that differ and receive them like a folder
+        Files that are only here are kept
+        With resumable, what an earlier attempt kept of a file (see u.receive_download) is continued
+        What ignored(path, is_dir) says is not synced is neither walked nor received, here or on the remote
+        Returns the paths that were changed, and the ones that are only here (or were edited here while received)
+        """
+        self.refresh(tree, folder, known, ignored)
+        # path -> the hash the remote has for it
+        wanted = {}
+        # the paths we changed, the tree is brought up to date only for them
+        changed = []
+        extra = []
+        frontier = [ROOT]
+        while frontier:
+            chunkstore.send_blob(sock, encode_paths(frontier))
+            view = chunkstore.receive_blob(sock)
+            pos = 0
+            next_frontier = []
+            for dir_path in frontier:
+                dir_hash = bytes(view[pos:pos + chunkstore.DIGEST_SIZE]).hex()
+                count, pos = u.decode_varint(view, pos + chunkstore.DIGEST_SIZE)
+                children = []
+                for _ in range(count):
+                    length, pos = u.decode_varint(view, pos)
+                    name = bytes(view[pos:pos + length]).decode()
+                    pos += length
+                    children.append((name, view[pos], bytes(view[pos + 1:pos + 1 + chunkstore.DIGEST_SIZE]).hex()))
+                    pos += 1 + chunkstore.DIGEST_SIZE
+                found = self.listing(tree, dir_path)
+                if found is not None and found[0] == dir_hash:
+                    continue
+                local = {name: (is_dir, hashed) for name, is_dir, hashed in (found[1] if found is not None else [])}
+                remote = {name for name, _, _ in children}
+                extra.extend(os.path.join(dir_path, name) for name in local if name not in remote)
+                for name, is_dir, hashed in children:
+                    path = os.path.join(dir_path, name)
+                    mine = local.get(name)
+                    if mine == (is_dir, hashed) or ignored is not None and ignored(path, bool(is_dir)):
+                        continue
+                    full_path = os.path.join(folder, path)
+                    changed.append(path)
+                    if mine is not None and mine[0] != is_dir:
+                        # a file here where the remote has a directory, or the other way around
+                        if mine[0]:
+                            u.remove_folder(full_path)
+                            os.rmdir(full_path)
+                        else:
+                            os.remove(full_path)
+                    if is_dir:
+                        os.makedirs(full_path, exist_ok=True)
+                        next_frontier.append(path)
+                    else:
+                        wanted[path] = hashed
+            frontier = next_frontier
+        chunkstore.send_blob(sock, encode_paths([]))
+        chunkstore.send_blob(sock, encode_paths(list(wanted)))
+        if not resumable:
+            u.receive_folder(folder, sock, codec)
+        else:
+            download = u.state_dir(folder, 'download')
+            expected = {}
+            # files with the same content are received one after the other, only the first continues the part
+            continued = set()
+            for path, hashed in wanted.items():
+                kept = os.path.join(download, hashed)
+                offset = os.path.getsize(kept) if hashed not in continued and os.path.exists(kept) else 0
+                continued.add(hashed)
+                expected[path] = (hashed, offset)
+            chunkstore.send_blob(sock, b''.join(u.encode_varint(offset) for _, offset in expected.values()))
+            u.receive_folder(folder, sock, codec, expected)
+        with self.__lock, self.__db:
+            for path in changed:
+                if os.path.isdir(os.path.join(folder, path)):
+                    self.__add_dir(tree, path)
+                else:
+                    self.__update(tree, folder, path)
+            # a file edited here while it was received is not what the remote has, it is sent like the extra ones
+            for path, hashed in wanted.items():
+                row = self.__db.execute('SELECT hash FROM nodes WHERE tree = ? AND path = ? AND is_dir = 0',
+                                        (tree, path)).fetchone()
+                if row is not None and row[0] != hashed:
+                    extra.append(path)
+        return changed, extra
@@ -0,0 +1,211 @@
+"""
+Durable state of the server: users, their clients and a change journal per user, in one SQLite database
+Every batch the server applies is appended to the user's journal once. Every client has a cursor, the number of the
+last journal entry it acknowledged, so what a client still has to get is everything after its cursor
+Entries every client is past are collected, a client that falls too far behind gets a snapshot of the folder instead
+A batch a client sent is kept here while it is applied, with how far it got, so a crash does not leave it half done:
+it is finished when the server starts again, and journaled in the same transaction that drops it
+The contents of the files are not in here, see chunkstore
+"""
+import json
+import sqlite3
+import threading
+import utils as u
+
+# every this many entries the clients that fell behind are looked for
+JOURNAL_SEGMENT = 1024
+# a client that is this many entries behind gets a snapshot instead, the journal does not keep growing for him
+MAX_LAG = 16 * JOURNAL_SEGMENT
+# the entries of the journal that are for a client: the ones for him only, or for everyone but the one they came from
+FOR_CLIENT = '(target = ? OR target IS NULL AND (origin IS NULL OR origin != ?))'
+
+
+def encode_commands(commands: list) -> str:
+    return json.dumps([list(command) for command in commands])
+
+
+def decode_commands(encoded: str) -> list:
+    return [u.Command(*fields) for fields in json.loads(encoded)]
+
+
+class MetaStore:
+    """
+    Every method is one transaction, nothing is loaded at startup, every lookup goes through a primary key
+    """
+
+    def __init__(self, path: str):
+        # one connection for all the server's threads
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__db:
+            # the journal is appended to on every batch, the write ahead log keeps that to one sequential write
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            # last_seq: number of the user's last journal entry
+            self.__db.execute('CREATE TABLE IF NOT EXISTS users '
+                              '(user TEXT PRIMARY KEY, folder TEXT, last_seq INTEGER) WITHOUT ROWID')
+            # applied_seq: number of the client's last batch we applied, cursor: see above
+            # snapshot: the client fell too far behind, he gets the whole folder on his next session
+            self.__db.execute('CREATE TABLE IF NOT EXISTS clients (user TEXT, client INTEGER, applied_seq INTEGER, '
+                              'cursor INTEGER, snapshot INTEGER, PRIMARY KEY (user, client)) WITHOUT ROWID')
+            # stores made before the snapshot column existed
+            if 'snapshot' not in [row[1] for row in self.__db.execute('PRAGMA table_info(clients)')]:
+                self.__db.execute('ALTER TABLE clients ADD COLUMN snapshot INTEGER DEFAULT 0')
+            # an entry is for every client but the one it came from (origin), or only for target
+            self.__db.execute('CREATE TABLE IF NOT EXISTS journal (user TEXT, seq INTEGER, origin INTEGER, '
+                              'target INTEGER, commands TEXT, PRIMARY KEY (user, seq)) WITHOUT ROWID')
+            # the batch being applied to a user's folder, one at a time under the user's lock
+            # levels: how many of its levels are done, see executor
+            self.__db.execute('CREATE TABLE IF NOT EXISTS batches (user TEXT PRIMARY KEY, client INTEGER, '
+                              'seq INTEGER, commands TEXT, levels INTEGER) WITHOUT ROWID')
+
+    def user_folder(self, user_id: str):
+        # None for an unknown user
+        with self.__lock:
+            row = self.__db.execute('SELECT folder FROM users WHERE user = ?', (user_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def add_user(self, user_id: str, folder: str) -> bool:
+        """
+        Add a user with his first client (0), False if the id is taken
+        """
+        with self.__lock, self.__db:
+            added = self.__db.execute('INSERT OR IGNORE INTO users VALUES (?, ?, 0)', (user_id, folder)).rowcount
+            if added:
+                self.__db.execute('INSERT INTO clients (user, client, applied_seq, cursor, snapshot) '
+                                  'VALUES (?, 0, 0, 0, 0)', (user_id,))
+        return bool(added)
+
+    def remove_user(self, user_id: str):
+        # a user whose first upload was cut off, his client starts over as a new user
+        with self.__lock, self.__db:
+            for table in ('users', 'clients', 'journal', 'batches'):
+                self.__db.execute(f'DELETE FROM {table} WHERE user = ?', (user_id,))
+
+    def add_client(self, user_id: str) -> int:
+        """
+        Returns the new client's id, he starts at the end of the journal since he gets the whole folder
+        None if the user has all the clients an id can number (see utils.MAX_CLIENT_ID)
+        """
+        with self.__lock, self.__db:
+            client_id, = self.__db.execute('SELECT COALESCE(MAX(client), -1) + 1 FROM clients WHERE user = ?',
+                                           (user_id,)).fetchone()
+            if client_id > u.MAX_CLIENT_ID:
+                return None
+            self.__db.execute('INSERT INTO clients (user, client, applied_seq, cursor, snapshot) '
+                              'SELECT user, ?, 0, last_seq, 0 FROM users WHERE user = ?',
+                              (client_id, user_id))
+        return client_id
+
+    def has_client(self, user_id: str, client_id: int) -> bool:
+        with self.__lock:
+            return self.__db.execute('SELECT 1 FROM clients WHERE user = ? AND client = ?',
+                                     (user_id, client_id)).fetchone() is not None
+
+    def applied_seq(self, user_id: str, client_id: int) -> int:
+        with self.__lock:
+            row = self.__db.execute('SELECT applied_seq FROM clients WHERE user = ? AND client = ?',
+                                    (user_id, client_id)).fetchone()
+        return row[0]
+
+    def set_applied(self, user_id: str, client_id: int, applied_seq: int):
+        with self.__lock, self.__db:
+            self.__db.execute('UPDATE clients SET applied_seq = ? WHERE user = ? AND client = ?',
+                              (applied_seq, user_id, client_id))
+            self.__db.execute('DELETE FROM batches WHERE user = ?', (user_id,))
+
+    def begin_batch(self, user_id: str, client_id: int, seq: int, commands: list):
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, 0)',
+                              (user_id, client_id, seq, encode_commands(commands)))
+
+    def batch_progress(self, user_id: str, levels: int):
+        with self.__lock, self.__db:
+            self.__db.execute('UPDATE batches SET levels = ? WHERE user = ?', (levels, user_id))
+
+    def interrupted_batches(self, user_id: str = None) -> list:
+        """
+        The batches a crash stopped in the middle: (user, client, seq, commands, levels done), of one user or all
+        """
+        with self.__lock:
+            rows = self.__db.execute('SELECT user, client, seq, commands, levels FROM batches WHERE ? IS NULL OR '
+                                     'user = ?', (user_id, user_id)).fetchall()
+        return [(user_id, client_id, seq, decode_commands(commands), levels)
+                for user_id, client_id, seq, commands, levels in rows]
+
+    def append(self, user_id: str, commands: list, origin: int = None, target: int = None,
+               applied_seq: int = None) -> int:
+        """
+        Add an entry to the user's journal, returns its number
+        applied_seq marks the origin's batch as applied in the same transaction, it is not kept as a batch anymore
+        Fan out costs the same for any number of clients, each of them reads the entry from his cursor
+        """
+        with self.__lock, self.__db:
+            self.__db.execute('UPDATE users SET last_seq = last_seq + 1 WHERE user = ?', (user_id,))
+            seq, = self.__db.execute('SELECT last_seq FROM users WHERE user = ?', (user_id,)).fetchone()
+            self.__db.execute('INSERT INTO journal VALUES (?, ?, ?, ?, ?)',
+                              (user_id, seq, origin, target, encode_commands(commands)))
+            if applied_seq is not None:
+                self.__db.execute('UPDATE clients SET applied_seq = ? WHERE user = ? AND client = ?',
+                                  (applied_seq, user_id, origin))
+                self.__db.execute('DELETE FROM batches WHERE user = ?', (user_id,))
+            if origin is not None:
+                # the entry is not for him, he must not hold it back
+                self.__advance(user_id, origin)
+            if seq % JOURNAL_SEGMENT == 0:
+                self.__db.execute('UPDATE clients SET cursor = ?, snapshot = 1 WHERE user = ? AND cursor < ?',
+                                  (seq, user_id, seq - MAX_LAG))
+        return seq
+
+    def __advance(self, user_id: str, client_id: int):
+        # move a client's cursor past the entries that are not for him, up to the first one that is
+        cursor, = self.__db.execute('SELECT cursor FROM clients WHERE user = ? AND client = ?',
+                                    (user_id, client_id)).fetchone()
+        following, = self.__db.execute(f'SELECT MIN(seq) FROM journal WHERE user = ? AND seq > ? AND {FOR_CLIENT}',
+                                       (user_id, cursor, client_id, client_id)).fetchone()
+        if following is None:
+            following, = self.__db.execute('SELECT last_seq + 1 FROM users WHERE user = ?', (user_id,)).fetchone()
+        self.__db.execute('UPDATE clients SET cursor = ? WHERE user = ? AND client = ?',
+                          (following - 1, user_id, client_id))
+
+    def pending(self, user_id: str, client_id: int) -> list:
+        """
+        The entries of the journal after a client's cursor that are for him, (seq, commands) in order
+        """
+        with self.__lock:
+            cursor, = self.__db.execute('SELECT cursor FROM clients WHERE user = ? AND client = ?',
+                                        (user_id, client_id)).fetchone()
+            rows = self.__db.execute(f'SELECT seq, commands FROM journal WHERE user = ? AND seq > ? AND {FOR_CLIENT} '
+                                     'ORDER BY seq', (user_id, cursor, client_id, client_id)).fetchall()
+        return [(seq, decode_commands(commands)) for seq, commands in rows]
+
+    def acknowledge(self, user_id: str, client_id: int, seq: int):
+        # the client applied every entry for him up to seq
+        with self.__lock, self.__db:
+            cursor, = self.__db.execute('SELECT cursor FROM clients WHERE user = ? AND client = ?',
+                                        (user_id, client_id)).fetchone()
+            if seq > cursor:
+                self.__db.execute('UPDATE clients SET cursor = ? WHERE user = ? AND client = ?',
+                                  (seq, user_id, client_id))
+                self.__advance(user_id, client_id)
+
+    def collect_garbage(self, user_id: str) -> list:
+        """
+        Remove the entries every client of the user is past, returns their commands
+        """
+        with self.__lock, self.__db:
+            lowest, = self.__db.execute('SELECT MIN(cursor) FROM clients WHERE user = ?', (user_id,)).fetchone()
+            rows = self.__db.execute('SELECT commands FROM journal WHERE user = ? AND seq <= ?',
+                                     (user_id, lowest)).fetchall()
+            if rows:
+                self.__db.execute('DELETE FROM journal WHERE user = ? AND seq <= ?', (user_id, lowest))
+        return [command for commands, in rows for command in decode_commands(commands)]
+
+    def needs_snapshot(self, user_id: str, client_id: int) -> bool:
+        with self.__lock:
+            return bool(self.__db.execute('SELECT snapshot FROM clients WHERE user = ? AND client = ?',
+                                          (user_id, client_id)).fetchone()[0])
+
+    def snapshot_sent(self, user_id: str, client_id: int):
+        with self.__lock, self.__db:
+            self.__db.execute('UPDATE clients SET snapshot = 0 WHERE user = ? AND client = ?', (user_id, client_id))
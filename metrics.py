@@ -0,0 +1,137 @@
+"""
+Counters, gauges and histograms of the hot paths of the client and the server, kept in process
+Off unless METRICS_PORT or METRICS_DUMP is set in the environment, every call then returns right away
+With METRICS_PORT the registry is served as text on http://127.0.0.1:<port>/metrics, one "name value" per line,
+with METRICS_DUMP it is printed every that many seconds
+A histogram keeps the count, sum and max of everything it saw and the percentiles of its last samples,
+durations are in seconds and sizes in bytes
+"""
+import http.server
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+# how many of the last samples of a histogram its percentiles are computed over
+SAMPLES = 1024
+PORT = int(os.environ.get('METRICS_PORT', 0))
+DUMP_INTERVAL = float(os.environ.get('METRICS_DUMP', 0))
+enabled = bool(PORT or DUMP_INTERVAL)
+
+# one lock for the whole registry, an update holds it for a few dictionary operations
+lock = threading.Lock()
+counters = defaultdict(int)
+gauges = {}
+# name -> [count, sum, max, last samples]
+histograms = {}
+
+
+def count(name: str, value: int = 1):
+    if enabled:
+        with lock:
+            counters[name] += value
+
+
+def gauge(name: str, value: float):
+    if enabled:
+        gauges[name] = value
+
+
+def observe(name: str, value: float):
+    if not enabled:
+        return
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [0, 0, 0, deque(maxlen=SAMPLES)]
+        histogram[0] += 1
+        histogram[1] += value
+        histogram[2] = max(histogram[2], value)
+        histogram[3].append(value)
+
+
+def clock() -> float:
+    # the start of a duration, see since
+    return time.perf_counter() if enabled else 0
+
+
+def since(name: str, started: float):
+    # the time since clock() was called is a sample of the histogram
+    if enabled:
+        observe(name, time.perf_counter() - started)
+
+
+class Timed:
+    """
+    with Timed(name): the duration of the block is a sample of the histogram
+    """
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = clock()
+
+    def __exit__(self, *error):
+        since(self.name, self.started)
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def snapshot() -> dict:
+    """
+    Every value of the registry by name, a histogram gives name.count, .sum, .max, .p50, .p90 and .p99
+    """
+    with lock:
+        values = dict(counters)
+        values.update(gauges)
+        for name, (total, value_sum, value_max, samples) in histograms.items():
+            ordered = sorted(samples)
+            values.update({f'{name}.count': total, f'{name}.sum': value_sum, f'{name}.max': value_max,
+                           f'{name}.p50': percentile(ordered, 0.5), f'{name}.p90': percentile(ordered, 0.9),
+                           f'{name}.p99': percentile(ordered, 0.99)})
+    return values
+
+
+def render() -> str:
+    return ''.join(f'{name} {value:.6g}\n' for name, value in sorted(snapshot().items()))
+
+
+class ScrapeHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # no line on the output for every scrape
+        pass
+
+
+def dump_forever():
+    while True:
+        time.sleep(DUMP_INTERVAL)
+        print(render(), end='', flush=True)
+
+
+def start(offset: int = 0):
+    """
+    Serve or dump the registry as the environment asks, call once when the process starts
+    The worker processes of a server serve theirs on the ports after METRICS_PORT, offset is the worker's place
+    """
+    if PORT:
+        # only this machine can scrape
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', PORT + offset), ScrapeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if DUMP_INTERVAL:
+        threading.Thread(target=dump_forever, daemon=True).start()
@@ -0,0 +1,115 @@
+import random
+import time
+from collections import deque
+import metrics
+
+# with nothing to send, the client checks on its session this often at first
+IDLE_INTERVAL = 1
+# and less and less often the longer it stays idle, down to this
+MAX_IDLE_INTERVAL = 10
+# after a failed sync we wait this long, twice as long after every further failure, up to MAX_BACKOFF
+BACKOFF = 1
+MAX_BACKOFF = 120
+# every wait is cut short by up to this fraction at random
+JITTER = 0.5
+
+
+def jittered(delay: float) -> float:
+    # clients that lost the server together must not all come back at the same moment
+    return delay * (1 - JITTER * random.random())
+
+
+def spread(delay: float) -> float:
+    # the same for a wait the server asked for, never shorter than what it asked
+    return delay * (1 + JITTER * random.random())
+
+
+class SyncScheduler:
+    """
+    Decides when the client talks to the server
+    - pending commands go out as soon as their burst of events is over, or right away once there are many of them
+      (see CommandQueue.due), a waiting client is woken by the observer's events, it does not poll
+    - with nothing to send it only wakes up to check on its session, less and less often
+    - after a failed sync (the server is down or turned us away) it waits twice as long each time,
+      or as long as the server asked for when it turned us away (see defer)
+    It also measures how long a change takes to reach the server: from its first event to the server's acknowledgement,
+    see metrics
+    """
+
+    def __init__(self, requests, max_idle_interval: float = MAX_IDLE_INTERVAL):
+        self.requests = requests
+        self.max_idle_interval = max_idle_interval
+        self.__idle_interval = IDLE_INTERVAL
+        self.__idle_at = 0
+        # no sync before this, we are backing off
+        self.__not_before = 0
+        self.__failures = 0
+        # the wait the server asked for when it last turned us away, 0 for none
+        self.__retry_after = 0
+        # (batch number, time of its first event), appended by the sending thread and taken by the listening thread
+        self.__sent = deque()
+
+    def run(self, operation: callable):
+        """
+        Call operation() whenever there is something to do, forever
+        operation returns False if it could not reach the server
+        """
+        while True:
+            busy = self.__wait()
+            succeeded = operation()
+            now = time.monotonic()
+            if succeeded:
+                self.__failures = 0
+                self.__not_before = 0
+            else:
+                self.__not_before = now + self.__backoff(self.__failures)
+                self.__failures += 1
+                metrics.count('client.sync_failures')
+            # any activity brings the idle checks back to their shortest interval
+            self.__idle_interval = IDLE_INTERVAL if busy else min(self.__idle_interval * 2, self.max_idle_interval)
+            self.__idle_at = now + jittered(self.__idle_interval)
+
+    def retry(self, operation: callable):
+        """
+        Call operation() until it returns True, waiting twice as long after every failure
+        """
+        failures = 0
+        while not operation():
+            time.sleep(self.__backoff(failures))
+            failures += 1
+
+    def defer(self, retry_after: float):
+        # the server turned us away and asked us to come back after this many seconds
+        self.__retry_after = retry_after
+
+    def __backoff(self, failures: int) -> float:
+        # how long to wait after a failed sync
+        retry_after, self.__retry_after = self.__retry_after, 0
+        if retry_after:
+            return spread(retry_after)
+        return jittered(min(MAX_BACKOFF, BACKOFF << failures))
+
+    def __wait(self) -> bool:
+        # sleep until commands are due or the next idle check, returns True if commands are due
+        while True:
+            now = time.monotonic()
+            due = self.requests.due()
+            if now >= self.__not_before and (due == 0 or now >= self.__idle_at):
+                return due == 0
+            wake_at = self.__idle_at if due is None else min(now + due, self.__idle_at)
+            self.requests.wake.wait(max(wake_at, self.__not_before) - now)
+            self.requests.wake.clear()
+
+    def poke(self):
+        # called from any thread, check on the session now (unless we are backing off)
+        self.__idle_at = 0
+        self.requests.wake.set()
+
+    def sent(self, seq: int, since: float):
+        self.__sent.append((seq, since))
+
+    def acknowledged(self, seq: int):
+        # called from the listening thread, every batch up to seq reached the server
+        now = time.monotonic()
+        while self.__sent and self.__sent[0][0] <= seq:
+            metrics.observe('client.propagation_latency', now - self.__sent.popleft()[1])
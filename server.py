@@ -1,14 +1,61 @@
+import functools
+import glob
+import hashlib
+import itertools
+import multiprocessing
 import os
+import shutil
+import signal
 import socket
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from random import choice
+import admission
+import chunkstore
+import delta
+import executor
+import merkle
+import metastore
+import metrics
+import syncignore
 import utils as u
 
 PORT = int(sys.argv[1])
+# OPTIONAL: number of worker processes, every user is served by one of them (see owner), 1 serves in this process
+WORKERS = int(sys.argv[2]) if len(sys.argv) >= 3 else 1
 REMOTE_DIRECTORIES_PATH = './remotes'
-# this dictionary : the client's database
-users_book = {}
-QUEUE_SIZE = 7
+# connections are accepted as they come, admission is decided after (see admission)
+QUEUE_SIZE = 128
+# OPTIONAL: maximum number of clients connected at the same time, in every worker process
+# a connected client keeps its session and its worker thread until it disconnects, so this caps the clients online:
+# the ones above it are told to come back later (see refuse), and keep being told so until a session ends
+# every session costs a thread, raise it with the number of clients that stay online at once
+MAX_WORKERS = int(sys.argv[3]) if len(sys.argv) >= 4 else 256
+# the threads that answer the connections that find every worker busy, and how many may wait for an answer
+REFUSERS = 4
+MAX_REFUSING = 256
+# a turned away client that does not finish his handshake in time is not told anything
+REFUSE_TIMEOUT = 1
+# the threads of the acceptor that wait for the user id of a connection, and how long they wait for it
+ROUTERS = 4
+ROUTE_TIMEOUT = u.CONNECTION_TIMEOUT_VAL
+# the number of this worker process, 0 in a server of one process
+shard = 0
+# guards the user locks, every user gets his own lock for his folder and his clients
+book_lock = threading.Lock()
+user_locks = {}
+# the open sessions: user_id -> {client_id -> session}, guarded by the user's lock
+sessions = {}
+# every file of every user is stored once in here, see chunkstore
+store = chunkstore.ChunkStore(os.path.join(REMOTE_DIRECTORIES_PATH, '.store'))
+# the client's database: users, their clients and what every client still has to get, kept across restarts
+meta = metastore.MetaStore(os.path.join(REMOTE_DIRECTORIES_PATH, '.meta.db'))
+# a merkle tree of every user's folder, named by the user's id, so a new client downloads only what it does not have
+trees = merkle.MerkleTree(os.path.join(REMOTE_DIRECTORIES_PATH, '.merkle.db'))
+# applies the commands of a batch that touch unrelated paths in parallel, shared by all the users
+appliers = ThreadPoolExecutor(executor.EXECUTOR_WORKERS)
 
 
 def generate_user_id() -> str:
@@ -17,82 +64,526 @@ def generate_user_id() -> str:
                   'u', 'v', 'w', 'x', 'y', 'z', 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N',
                   'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z', '0', '1', '2', '3', '4', '5', '6', '7',
                   '8', '9']
-    return ''.join(choice(characters) for _ in range(length))
+    while True:
+        user_id = ''.join(choice(characters) for _ in range(length))
+        # the acceptor will route his next connections by his id, it must be one of ours
+        if owner(user_id) == shard:
+            return user_id
+
+
+def owner(user_id: str) -> int:
+    # the worker process that serves a user, python's own hash differs from process to process
+    return int.from_bytes(hashlib.blake2b(user_id.encode(), digest_size=8).digest(), 'big') % WORKERS
 
 
 def read_ids(sock: socket.socket) -> (str, int):
-    user_id = u.read_x_bytes(sock, 128)
-    client_id = int(u.read_x_bytes(sock, 2))
+    user_id = u.read_x_bytes(sock, u.USER_ID_LENGTH)
+    client_id = int(u.read_x_bytes(sock, u.CLIENT_ID_LENGTH))
     return user_id, client_id
 
 
+def negotiate_protocol(sock: socket.socket) -> (int, object):
+    """
+    The client proposes the newest wire format it knows, we answer with the one both of us know
+    Then newer clients offer compression codecs, returns the version and the codec (None for none)
+    """
+    version = min(u.read_protocol_version(sock), u.PROTOCOL_VERSION)
+    sock.sendall(str(version).encode())
+    codec = u.choose_codec(sock) if version >= u.PROTOCOL_CODECS else None
+    return version, codec
+
+
+def get_user_lock(user_id: str) -> threading.Lock:
+    # one lock per user, unrelated users never wait on each other
+    with book_lock:
+        return user_locks.setdefault(user_id, threading.Lock())
+
+
 def new_user() -> (bytes, str):
-    # new client has connected, generate a unique id
+    # new client has connected, generate a unique id and add the user to the client's database
     user_id = generate_user_id()
+    while not meta.add_user(user_id, os.path.join(REMOTE_DIRECTORIES_PATH, user_id)):
+        user_id = generate_user_id()
     # creating remote folder for client
-    path_to_folder = os.path.join(REMOTE_DIRECTORIES_PATH, user_id)
+    path_to_folder = meta.user_folder(user_id)
     os.mkdir(path_to_folder)
-    # adding the user to the client's book
-    users_book[user_id] = (path_to_folder, [[]])
     print(f'Client: {user_id}\nConnected to remote folder at {path_to_folder}')
     # return user's id
     return user_id.encode(), path_to_folder
 
 
-def new_client(user_id: str, client: socket.socket):
-    remote_folder_path, clients = users_book[user_id]
-    # getting a new client id
-    client_id = len(clients)
-    # adding the new client to the list
-    clients.append([])
+def new_client(user_id: str, client: socket.socket, version: int, codec=None) -> int:
+    # getting a new client id, the client gets the folder as it is now and nothing from the journal before it
+    client_id = meta.add_client(user_id)
+    if client_id is None:
+        # the connection is closed, the client tries again later
+        raise ValueError(f'Error: {user_id} has {u.MAX_CLIENT_ID + 1} clients already, there is no id for another')
     # send the client id
-    client.send(str(client_id).encode())
-    # send the remote folder
-    u.send_folder(remote_folder_path, client)
+    client.sendall(str(client_id).zfill(u.CLIENT_ID_LENGTH).encode())
+    remote_folder_path = meta.user_folder(user_id)
+    if version < u.PROTOCOL_MERKLE:
+        # send the remote folder
+        u.send_folder(remote_folder_path, client, codec)
+        return client_id
+    if not trees.has(user_id):
+        # a user from before the trees were kept, the store knows the hashes of his files
+        trees.refresh(user_id, remote_folder_path, functools.partial(store.stat, user_id))
+    # send only the files that differ from the client's folder
+    trees.serve_reconcile(user_id, remote_folder_path, client, codec, version >= u.PROTOCOL_RESUME)
+    return client_id
 
 
-def main():
-    # create 'remotes' folder if it does not exist yet
-    os.makedirs(REMOTE_DIRECTORIES_PATH)
-    # opening socket and listening for clients
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('', PORT))
-    server.listen(QUEUE_SIZE)
+def remove_user(user_id: str, path: str):
+    # a new user whose upload was cut off, what the store got of it is kept (see ChunkStore.salvage)
+    meta.remove_user(user_id)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def push_updates(user_id: str, commands: list, origin: int = None, target: int = None, applied_seq: int = None):
+    """
+    Journal commands for every client of the user but origin (or for target only)
+    and send them right away to the ones that are connected
+    They stay in the journal until the clients acknowledge them
+    Call while holding the user's lock
+    """
+    started = metrics.clock()
+    if not commands:
+        if applied_seq is not None:
+            meta.set_applied(user_id, origin, applied_seq)
+        return
+    seq = meta.append(user_id, commands, origin, target, applied_seq)
+    for client_id, session in sessions.get(user_id, {}).items():
+        if client_id == origin or target is not None and client_id != target:
+            continue
+        try:
+            session.send_commands(seq, selected(user_id, session, commands))
+        except OSError:
+            # the session is dying, its own thread will clean up, the commands remain in the journal
+            pass
+    # with a single client nobody has to get it
+    release_deltas(meta.collect_garbage(user_id))
+    metrics.since('server.fan_out', started)
+
+
+def release_deltas(commands: list):
+    # the deltas of journal entries no client needs anymore
+    for command in commands:
+        if command.cid == u.DELTA:
+            os.remove(command.source)
+
+
+def snapshot_commands(folder: str, under: str = merkle.ROOT, excluded: syncignore.Matcher = None) -> list:
+    """
+    The whole folder as commands, for a client that fell too far behind for the journal
+    Or only the directory under (with itself), without what excluded leaves out
+    """
+    commands = [u.Command(u.CREATE, under, True)] if under != merkle.ROOT else []
+    for top, dirs, files in os.walk(os.path.join(folder, under)):
+        relative_top = os.path.relpath(top, folder)
+        if excluded is not None:
+            dirs[:] = [name for name in dirs
+                       if not excluded.ignored(os.path.normpath(os.path.join(relative_top, name)), True)]
+        for name in dirs:
+            commands.append(u.Command(u.CREATE, os.path.normpath(os.path.join(relative_top, name)), True))
+        for name in files:
+            path = os.path.normpath(os.path.join(relative_top, name))
+            if excluded is None or not excluded.ignored(path):
+                commands.append(u.Command(u.MODIFY, path, source=os.path.join(top, name)))
+    return commands
+
+
+def selected(user_id: str, session: u.Session, commands: list) -> list:
+    """
+    The commands as a client that does not sync everything should get them (see syncignore): nothing it leaves out,
+    a move out of what it syncs deletes its copy, a move into it brings it the content
+    """
+    excluded = session.excluded
+    if excluded is None:
+        return commands
+    out = []
+    for command in commands:
+        left_out = excluded.ignored(command.path, command.is_dir)
+        if command.cid != u.MOVE:
+            if not left_out:
+                out.append(command)
+            continue
+        moved_out = excluded.ignored(command.new_path, command.is_dir)
+        if not left_out and not moved_out:
+            out.append(command)
+        elif not left_out:
+            out.append(u.Command(u.DELETE, command.path, command.is_dir))
+        elif not moved_out and command.is_dir:
+            out.extend(snapshot_commands(meta.user_folder(user_id), command.new_path, excluded))
+        elif not moved_out:
+            out.append(u.Command(u.MODIFY, command.new_path,
+                                 source=os.path.join(meta.user_folder(user_id), command.new_path)))
+    return out
+
+
+def tracker(user_id: str, remote_folder_path: str) -> callable:
+    # keeps the store and the tree in step with the commands executed on a user's folder
+    def track(x: u.Command):
+        store.track(user_id, remote_folder_path, x)
+        trees.track(user_id, remote_folder_path, x, functools.partial(store.stat, user_id))
+    return track
+
+
+def finish_batches(only_user: str = None):
+    """
+    Finish the batches a crash (or an error) stopped in the middle and pass them on, a batch is applied all or nothing
+    Call while holding the user's lock, or before the server accepts connections
+    """
+    for user_id, client_id, seq, commands, levels in meta.interrupted_batches(only_user):
+        remote_folder_path = meta.user_folder(user_id)
+        applied, _ = executor.execute_batch(commands, remote_folder_path, appliers,
+                                            tracker(user_id, remote_folder_path), levels, resume=True,
+                                            on_level=functools.partial(meta.batch_progress, user_id))
+        print(f'Finished batch {seq} of client {client_id} of {user_id} after it was interrupted')
+        push_updates(user_id, [u.as_reference(x, remote_folder_path) for x in applied],
+                     origin=client_id, applied_seq=seq)
+
+
+def apply_commands(user_id: str, client_id: int, session: u.Session, seq: int, commands: list):
+    """
+    Execute a batch a client sent and pass it on to the user's other clients
+    The batch is kept in the meta store until it is journaled, see finish_batches
+    Call while holding the user's lock
+    """
+    remote_folder_path = meta.user_folder(user_id)
+    # execute all commands, the redundant ones are dropped and the independent ones run in parallel
+    with metrics.Timed('server.collapse'):
+        commands = executor.collapse(commands, remote_folder_path)
+    meta.begin_batch(user_id, client_id, seq, commands)
+    with metrics.Timed('server.apply'):
+        applied, mismatched = executor.execute_batch(commands, remote_folder_path, appliers,
+                                                     tracker(user_id, remote_folder_path),
+                                                     on_level=functools.partial(meta.batch_progress, user_id))
+    for x in mismatched:
+        # our copy is not the one the client made the delta against, ask him for the whole file
+        os.remove(x.source)
+        try:
+            session.send_frame(u.FRAME_RESEND, x.path.encode())
+        except OSError:
+            # the session is dying, the batch is still journaled below
+            pass
+    # the other clients get the new contents from the remote folder, read when they are sent
+    # the same delta fits every client that is in sync with us, it is removed once the journal entry is collected
+    applied = [u.as_reference(x, remote_folder_path) for x in applied]
+    # update every other client of this user, connected clients get it immediately
+    # the batch counts as applied in the same transaction, a restart can not apply it twice
+    push_updates(user_id, applied, origin=client_id, applied_seq=seq)
+
+
+def open_session(user_id: str, client_id: int, session: u.Session):
+    with get_user_lock(user_id):
+        # a client that reconnects replaces his old session
+        old_session = sessions.setdefault(user_id, {}).get(client_id)
+        if old_session is not None:
+            old_session.close()
+        else:
+            metrics.count('server.sessions')
+        sessions[user_id][client_id] = session
+        # tell the client which of his batches we already have, he sends the rest again
+        session.send_ack(meta.applied_seq(user_id, client_id))
+        if session.version >= u.PROTOCOL_RESUME:
+            # and what we kept of the one that was cut off, he continues it
+            session.send_resume()
+        # everything the client did not acknowledge yet is sent again, with the same numbers
+        remote_folder_path = meta.user_folder(user_id)
+        if meta.needs_snapshot(user_id, client_id):
+            # what he missed is not in the journal anymore, it is sent with the rest of his pending entries
+            meta.append(user_id, snapshot_commands(remote_folder_path), target=client_id)
+            meta.snapshot_sent(user_id, client_id)
+        pending = meta.pending(user_id, client_id)
+        skipped = []
+        for index, (seq, commands) in enumerate(pending):
+            for command in session.send_commands(seq, selected(user_id, session, commands)):
+                # a file that was moved later on, its content is sent from where it is now
+                later = [x for _, batch in pending[index + 1:] for x in batch]
+                skipped.append(u.follow_moves(command.path, later))
+        push_updates(user_id, [u.Command(u.MODIFY, path, source=os.path.join(remote_folder_path, path))
+                               for path in skipped if path is not None], target=client_id)
+
+
+def close_session(user_id: str, client_id: int, session: u.Session):
+    with get_user_lock(user_id):
+        if sessions.get(user_id, {}).get(client_id) is session:
+            del sessions[user_id][client_id]
+            metrics.count('server.sessions', -1)
+            if not sessions[user_id]:
+                del sessions[user_id]
+    session.close()
+
+
+def acknowledge(user_id: str, client_id: int, seq: int):
+    # the client applied every batch up to seq
+    with metrics.Timed('server.ack'), get_user_lock(user_id):
+        meta.acknowledge(user_id, client_id, seq)
+        release_deltas(meta.collect_garbage(user_id))
+
+
+def run_session(user_id: str, client_id: int, session: u.Session):
+    """
+    Serve the frames of a connected client until he disconnects
+    """
     while True:
-        # accept incoming client
-        client_socket, client_address = server.accept()
-        print(f'Connection from: {client_address}')
+        frame_type, seq, commands = session.read_frame()
+        if frame_type == u.FRAME_HEARTBEAT:
+            # answer so the client knows we are alive
+            session.send_frame(u.FRAME_HEARTBEAT)
+        elif frame_type == u.FRAME_ACK:
+            acknowledge(user_id, client_id, seq)
+        elif frame_type == u.FRAME_SIGNATURES_REQUEST:
+            # the client wants to send a delta of a file, answer with the signatures of our copy
+            remote_folder_path = meta.user_folder(user_id)
+            path = u.checked_path(commands.decode())
+            session.send_frame(u.FRAME_SIGNATURES, delta.signatures(os.path.join(remote_folder_path, path)))
+        elif frame_type == u.FRAME_RESEND:
+            # a delta we sent did not fit the client's copy, send it the whole file
+            with get_user_lock(user_id):
+                remote_folder_path = meta.user_folder(user_id)
+                path = u.checked_path(commands.decode())
+                push_updates(user_id, [u.Command(u.MODIFY, path, source=os.path.join(remote_folder_path, path))],
+                             target=client_id)
+        else:
+            waiting = metrics.clock()
+            with get_user_lock(user_id):
+                # other sessions of the user hold the lock while they apply their batches
+                metrics.since('server.lock_wait', waiting)
+                # a batch that failed halfway is finished first, applying it again from the start is not safe
+                finish_batches(user_id)
+                if seq > meta.applied_seq(user_id, client_id):
+                    apply_commands(user_id, client_id, session, seq, commands)
+                else:
+                    # sent again after a reconnect, but we applied it before our acknowledgement was lost
+                    u.discard_spooled(commands)
+                # send A for "ACK", under the lock: the updates of batches applied after it come after it
+                session.send_ack(seq)
+
+
+def handle_client(client_socket: socket.socket, client_address):
+    """
+    Serve a single connection from start to end, runs on one of the worker threads
+    """
+    print(f'Connection from: {client_address}')
+    # a stuck client must not hold a worker forever, connected clients send heartbeats
+    client_socket.settimeout(u.SESSION_TIMEOUT)
+    with metrics.Timed('server.handshake'):
         user_id, client_id = read_ids(client_socket)
-        commands = u.receive_requests(client_socket)
+        version, codec = negotiate_protocol(client_socket)
+    # a new user uploads his folder and a new client downloads it first, these bulk transfers need a free slot
+    new = user_id == u.DEFAULT_USER_ID
+    bulk = new or client_id == int(u.DEFAULT_CLIENT_ID)
+    if bulk and not admission.reserve_transfer(None if new else user_id):
+        turn_away(client_socket, version, admission.TRANSFER_RETRY_AFTER)
+        return
+    if version >= u.PROTOCOL_ADMISSION:
+        u.send_admission(client_socket)
+    try:
         # check if this is a new user
-        if user_id == u.DEFAULT_USER_ID:
+        if new:
             # generate and send id
             user_id, path = new_user()
-            client_socket.send(user_id)
-            # receive client's folder
-            u.receive_folder(path, client_socket)
+            # nobody knows the new id yet, but hold the lock until the folder is complete
+            with get_user_lock(user_id.decode()):
+                client_socket.sendall(user_id)
+                # receive client's folder, only the chunks the store does not have yet
+                try:
+                    with metrics.Timed('server.new_user_upload'):
+                        store.receive_folder(user_id.decode(), path,
+                                             admission.throttled(client_socket, user_id.decode(), True), codec)
+                except (OSError, EOFError, ValueError):
+                    # he starts over as a new user, and sends only the chunks we did not get
+                    remove_user(user_id.decode(), path)
+                    raise
+                trees.refresh(user_id.decode(), path, functools.partial(store.stat, user_id.decode()))
+            user_id, client_id = user_id.decode(), 0
+        elif meta.user_folder(user_id) is None:
+            print(f'Error: unknown user {user_id}')
+            return
         # new client : check if a known user connected from a new pc
-        elif client_id == u.DEFAULT_CLIENT_ID:
-            new_client(user_id, client_socket)
-        else:
-            # normal call with existing user id with existing client id
-            # execute all commands
-            print(f'todo => {commands}')
-            for x in commands:
-                u.execute_command(x, os.path.join(REMOTE_DIRECTORIES_PATH, user_id))
-            # update every client's todo_list, except for the current client
-            _, clients = users_book[user_id]
-            current_client_updates = []
-            for index, item in enumerate(clients):
-                if index != client_id:
-                    item.extand(commands)
-                else:
-                    current_client_updates = item
-            # push updates to client
-            u.send_requests(client_socket, current_client_updates)
-            # send A for "ACK"
-            client_socket.send(b'A')
-        client_socket.close()
+        elif client_id == int(u.DEFAULT_CLIENT_ID):
+            with metrics.Timed('server.new_client_download'), get_user_lock(user_id):
+                client_id = new_client(user_id, admission.throttled(client_socket, user_id, True), version, codec)
+        elif not meta.has_client(user_id, client_id):
+            print(f'Error: unknown client {client_id} of {user_id}')
+            return
+    finally:
+        if bulk:
+            admission.release_transfer(None if new else user_id)
+    remote_folder_path = meta.user_folder(user_id)
+    # his batches and the ones pushed to him draw from his rate
+    session = u.Session(admission.throttled(client_socket, user_id), u.state_dir(remote_folder_path, 'spool'),
+                        version, codec, u.state_dir(remote_folder_path, 'partial', str(client_id)))
+    if version >= u.PROTOCOL_RESUME:
+        # the client starts with what he applied and what he kept of our batch that was cut off
+        seq, _ = session.expect_frame(u.FRAME_ACK)
+        acknowledge(user_id, client_id, seq)
+        _, kept = session.expect_frame(u.FRAME_RESUME)
+        session.resume_from(kept)
+    if version >= u.PROTOCOL_SELECTIVE:
+        # and with what it does not sync, none of that is pushed to it
+        _, rules = session.expect_frame(u.FRAME_RULES)
+        session.excluded = syncignore.Matcher(rules.decode()) or None
+    with metrics.Timed('server.open_session'):
+        open_session(user_id, client_id, session)
+    try:
+        run_session(user_id, client_id, session)
+    except EOFError:
+        print(f'Client {client_id} of {user_id} disconnected')
+    finally:
+        close_session(user_id, client_id, session)
+
+
+def turn_away(client_socket: socket.socket, version: int, retry_after: float):
+    # newer clients are told when to come back, older ones only see the connection close and back off
+    metrics.count('server.turned_away')
+    if version >= u.PROTOCOL_ADMISSION:
+        u.send_admission(client_socket, retry_after)
+
+
+def refuse(client_socket: socket.socket, refusing: threading.BoundedSemaphore):
+    """
+    Answer a connection that came while every worker was busy, runs on one of the refusing threads
+    """
+    try:
+        with client_socket:
+            client_socket.settimeout(REFUSE_TIMEOUT)
+            read_ids(client_socket)
+            version, _ = negotiate_protocol(client_socket)
+            turn_away(client_socket, version, admission.BUSY_RETRY_AFTER)
+    except (OSError, EOFError, ValueError):
+        pass
+    finally:
+        refusing.release()
+
+
+def serve(client_socket: socket.socket, client_address, workers: threading.BoundedSemaphore):
+    metrics.count('server.busy_workers')
+    try:
+        with client_socket:
+            handle_client(client_socket, client_address)
+    except Exception as error:
+        # one broken connection must not take the server down, and the pool would swallow the error silently
+        print(f'Error: connection from {client_address} failed: {error!r}')
+    finally:
+        metrics.count('server.busy_workers', -1)
+        workers.release()
+
+
+def serve_connections(accept: callable):
+    """
+    Serve the connections accept() returns as (socket, address), forever
+    """
+    # every connection is served by a worker, at most MAX_WORKERS at the same time
+    workers = threading.BoundedSemaphore(MAX_WORKERS)
+    refusing = threading.BoundedSemaphore(MAX_REFUSING)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool, ThreadPoolExecutor(max_workers=REFUSERS) as refusers:
+        while True:
+            # accept incoming client
+            client_socket, client_address = accept()
+            metrics.count('server.connections')
+            if workers.acquire(blocking=False):
+                pool.submit(serve, client_socket, client_address, workers)
+            elif refusing.acquire(blocking=False):
+                # every worker is busy, it is told when to come back instead of waiting until it times out
+                print(f'Error: {MAX_WORKERS} clients are connected, {client_address} has to come back later')
+                metrics.count('server.full')
+                refusers.submit(refuse, client_socket, refusing)
+            else:
+                # too many to even answer, it backs off on its own
+                print(f'Error: {MAX_WORKERS} clients are connected, {client_address} is not answered')
+                metrics.count('server.full')
+                metrics.count('server.turned_away')
+                client_socket.close()
+
+
+def peek(sock: socket.socket, size: int) -> bytes:
+    # the first size bytes of the connection, they are left in it
+    deadline = time.monotonic() + ROUTE_TIMEOUT
+    while True:
+        data = sock.recv(size, socket.MSG_PEEK)
+        if not data:
+            raise EOFError
+        if len(data) == size:
+            return data
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        # the rest is on its way
+        time.sleep(0.005)
+
+
+def route(client_socket: socket.socket, client_address, channels: list, new_users):
+    """
+    Hand a connection to the worker process of its user, runs on one of the acceptor's threads
+    The bytes of the connection are not copied: its descriptor is sent to the worker, who reads it from the start
+    New users go to the workers in turn, each of them gives ids of its own (see generate_user_id)
+    """
+    try:
+        with client_socket:
+            client_socket.settimeout(ROUTE_TIMEOUT)
+            user_id = peek(client_socket, u.USER_ID_LENGTH).decode()
+            worker = next(new_users) % WORKERS if user_id == u.DEFAULT_USER_ID else owner(user_id)
+            host, port = client_address[:2]
+            socket.send_fds(channels[worker], [f'{host} {port}'.encode()], [client_socket.fileno()])
+    except (OSError, EOFError, UnicodeDecodeError) as error:
+        print(f'Error: could not route the connection from {client_address}: {error!r}')
+
+
+def worker(index: int, channel: socket.socket):
+    """
+    A worker process of a sharded server, serves the connections the acceptor hands it
+    Every worker has its own sessions and user locks, the users of the others never reach it
+    The store, the meta store and the trees are shared on the disk, each worker has its own connections to them
+    """
+    global shard
+    shard = index
+    metrics.start(index + 1)
+
+    def receive() -> (socket.socket, tuple):
+        message, descriptors, _, _ = socket.recv_fds(channel, 1024, 1)
+        if not descriptors:
+            # the acceptor is gone, the sessions we serve end as their clients leave
+            sys.exit(0)
+        host, port = message.decode().rsplit(' ', 1)
+        return socket.socket(fileno=descriptors[0]), (host, int(port))
+    serve_connections(receive)
+
+
+def main():
+    # batches the server was applying when it went down
+    finish_batches()
+    # folders deleted before the server stopped still link objects, they go first
+    for trash in glob.glob(os.path.join(REMOTE_DIRECTORIES_PATH, '.*.sync', 'trash')):
+        u.empty_trash(trash)
+    # objects no folder links to anymore are left over from before
+    store.collect_garbage()
+    metrics.start()
+    # opening socket and listening for clients
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # a restarted server takes the port back right away, the old connections may still be closing
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('', PORT))
+    server.listen(QUEUE_SIZE)
+    if WORKERS == 1:
+        serve_connections(server.accept)
+        return
+    # hashing, compression and parsing hold the GIL, every worker process gets a share of the users and a core
+    # a stopped acceptor takes its workers down with it
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    channels = []
+    for index in range(WORKERS):
+        # one message per connection, with the descriptor attached
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        multiprocessing.get_context('spawn').Process(target=worker, args=(index, theirs), daemon=True).start()
+        theirs.close()
+        channels.append(ours)
+    new_users = itertools.count()
+    with ThreadPoolExecutor(max_workers=ROUTERS) as routers:
+        while True:
+            client_socket, client_address = server.accept()
+            metrics.count('server.routed')
+            routers.submit(route, client_socket, client_address, channels, new_users)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+"""
+Rules of what is not synced, written like gitignore
+The .syncignore file at the top of a folder is synced like any other file, so every client of the user ignores the
+same paths: they are not watched, scanned, uploaded or downloaded
+A client can also leave subtrees out of its own sync (selective sync) with rules of the same form in the file
+`selective` of its state directory (see utils.state_dir). The server gets a client's rules when the session opens and
+pushes it nothing they exclude, what is already on its disk there is left alone
+All the rules are compiled into one regular expression, a path costs one match (and one per directory above it, cached)
+"""
+import functools
+import os
+import re
+
+IGNORE_FILE = '.syncignore'
+SELECTIVE_FILE = 'selective'
+# directories whose verdict is remembered, every path below them asks for it
+MAX_CACHED = 1 << 14
+
+
+def translate(glob: str) -> str:
+    """
+    The regular expression of a gitignore glob: * and ? never match a /, ** matches any number of directories
+    """
+    out = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**', i) and (i == 0 or glob[i - 1] == '/') and (i + 2 == len(glob) or glob[i + 2] == '/'):
+            if i + 2 == len(glob):
+                # a/** is everything inside a, not a itself
+                out.append('.+')
+            else:
+                # **/ is any number of directories, none included
+                out.append('(?:.*/)?')
+                i += 1
+            i += 2
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '\\' and i + 1 < len(glob):
+            i += 1
+            out.append(re.escape(glob[i]))
+        elif c == '[':
+            end = glob.find(']', i + 2)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                members = glob[i + 1:end]
+                if members[0] in '!^':
+                    members = '^' + members[1:]
+                expression = '(?!/)[' + members.replace('\\', '\\\\') + ']'
+                try:
+                    re.compile(expression)
+                except re.error:
+                    # not a valid set ([z-a], [!]...), the [ is just a character
+                    out.append(re.escape(c))
+                    i += 1
+                    continue
+                out.append(expression)
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def parse(text: str) -> list:
+    """
+    (regular expression, negated) of every rule in the text, in order
+    The expression matches a path with / between its parts and after it for a directory
+    """
+    rules = []
+    for line in text.splitlines():
+        # trailing spaces do not count unless escaped
+        line = re.sub(r'(?<!\\) +$', '', line)
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        elif line.startswith('\\!') or line.startswith('\\#'):
+            line = line[1:]
+        directory_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        # a rule with a / before its end is relative to the top, the others match a name at any depth
+        anchored = '/' in line
+        expression = translate(line.lstrip('/'))
+        if not anchored:
+            expression = '(?:.*/)?' + expression
+        expression += '/' if directory_only else '/?'
+        try:
+            re.compile(expression)
+        except re.error as error:
+            # a rule that does not compile is left out like git does, one typo must not stop the sync
+            print(f'Error: ignoring the rule {line!r}: {error}')
+            continue
+        rules.append((expression, negated))
+    return rules
+
+
+class Matcher:
+    """
+    The last rule that matches a path decides, a path inside an ignored directory is ignored whatever the rules say
+    """
+
+    def __init__(self, text: str = ''):
+        self.text = text
+        rules = parse(text)
+        # the last rule comes first: the first alternative that matches is the one that decides
+        self.__negated = [negated for _, negated in reversed(rules)]
+        self.__pattern = re.compile('|'.join(f'(?P<r{index}>{expression})'
+                                             for index, (expression, _) in enumerate(reversed(rules)))) \
+            if rules else None
+        self.__directory_ignored = functools.lru_cache(MAX_CACHED)(functools.partial(self.__matches, is_dir=True))
+
+    def __bool__(self) -> bool:
+        return self.__pattern is not None
+
+    def __matches(self, path: str, is_dir: bool) -> bool:
+        found = self.__pattern.fullmatch(path + '/' if is_dir else path)
+        return found is not None and not self.__negated[int(found.lastgroup[1:])]
+
+    def ignored(self, path: str, is_dir: bool = False) -> bool:
+        # path is relative to the top of the folder
+        if self.__pattern is None:
+            return False
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        end = path.find('/')
+        while end != -1:
+            if self.__directory_ignored(path[:end]):
+                return True
+            end = path.find('/', end + 1)
+        return self.__matches(path, is_dir)
+
+
+def load(folder: str, state: str = None) -> Matcher:
+    """
+    The rules of a folder's .syncignore, followed by the client's selective sync rules kept in state (if given)
+    """
+    texts = []
+    for path in [os.path.join(folder, IGNORE_FILE)] + ([os.path.join(state, SELECTIVE_FILE)] if state else []):
+        try:
+            with open(path, encoding='utf-8', errors='replace') as file:
+                texts.append(file.read())
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+    return Matcher('\n'.join(texts))
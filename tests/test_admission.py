@@ -0,0 +1,22 @@
+import gc
+import socket
+import admission
+
+
+def test_idle_buckets_are_dropped(monkeypatch):
+    monkeypatch.setattr(admission, 'buckets', {})
+    monkeypatch.setattr(admission, 'SWEEP_INTERVAL', -1)
+    left, right = socket.socketpair()
+    with left, right:
+        connected = admission.throttled(left, 'connected')
+        gone = admission.throttled(right, 'gone')
+        gone.sendall(b'x')
+        # in debt, coming back must not give a full bucket
+        indebted = admission.bucket('indebted')
+        indebted.take(admission.USER_BURST)
+        del gone, indebted
+        gc.collect()
+        admission.bucket('other')
+        assert set(admission.buckets) == {'connected', 'indebted', 'other'}
+        # the same bucket for every connection of a user
+        assert admission.bucket('connected') is connected.bucket
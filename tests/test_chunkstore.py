@@ -0,0 +1,95 @@
+import io
+import os
+import random
+import socket
+import threading
+import pytest
+import chunkstore
+from chunkstore import ChunkStore
+
+
+class CountingSocket:
+    # counts what is sent, everything else is the socket's own
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+        self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def write(folder, files: dict):
+    for relative_path, content in files.items():
+        path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+
+
+def upload(store: ChunkStore, user_id: str, source: str, target: str) -> (dict, int):
+    # the client's side on a thread, returns what it says it synced and the bytes it sent
+    left, right = socket.socketpair()
+    counting = CountingSocket(left)
+    with left, right:
+        result = {}
+        client = threading.Thread(target=lambda: result.update(chunkstore.upload_folder(source, counting)))
+        client.start()
+        store.receive_folder(user_id, target, right)
+        client.join()
+    return result, counting.sent
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(str(tmp_path / 'store'))
+
+
+def test_chunks_depend_on_the_content_around_them():
+    data = random.Random(1).randbytes(1 << 20)
+    edited = data[:500000] + b'inserted' + data[500000:]
+    before = list(chunkstore.iter_chunks(io.BytesIO(data)))
+    after = list(chunkstore.iter_chunks(io.BytesIO(edited)))
+    assert b''.join(before) == data and b''.join(after) == edited
+    assert all(chunkstore.MIN_CHUNK <= len(chunk) <= chunkstore.MAX_CHUNK for chunk in before[:-1])
+    # only the chunk with the insertion is new, maybe with its neighbour
+    assert len([chunk for chunk in after if chunk not in set(before)]) <= 2
+
+
+def test_second_upload_sends_only_new_chunks(tmp_path, store):
+    files = {'a.bin': random.Random(2).randbytes(300 << 10), os.path.join('d', 'b.bin'): b'small' * 100}
+    write(str(tmp_path / 'first'), files)
+    write(str(tmp_path / 'second'), {**files, 'new.bin': random.Random(3).randbytes(100 << 10)})
+    hashes, first_sent = upload(store, 'u1', str(tmp_path / 'first'), str(tmp_path / 'u1'))
+    assert set(hashes) == set(files) and first_sent > 300 << 10
+    _, second_sent = upload(store, 'u2', str(tmp_path / 'second'), str(tmp_path / 'u2'))
+    assert 100 << 10 < second_sent < 150 << 10
+    for relative_path, content in files.items():
+        # one object on the disk, linked into both folders
+        assert os.path.samefile(tmp_path / 'u1' / relative_path, tmp_path / 'u2' / relative_path)
+        with open(tmp_path / 'u2' / relative_path, 'rb') as file:
+            assert file.read() == content
+
+
+def test_garbage_is_what_no_folder_links(tmp_path, store):
+    content = random.Random(4).randbytes(100 << 10)
+    write(str(tmp_path / 'source'), {'a.bin': content})
+    upload(store, 'u1', str(tmp_path / 'source'), str(tmp_path / 'u1'))
+    # another user writes the same content, it is deduplicated
+    write(str(tmp_path / 'u2'), {'copy.bin': content})
+    store.ingest('u2', str(tmp_path / 'u2'), 'copy.bin')
+    object_hash, chunks = chunkstore.chunk_file(str(tmp_path / 'u1' / 'a.bin'))
+    assert os.stat(store.object_path(object_hash)).st_nlink == 3
+    os.remove(tmp_path / 'u1' / 'a.bin')
+    store.forget('u1', 'a.bin')
+    store.collect_garbage()
+    assert os.path.exists(store.object_path(object_hash))
+    os.remove(tmp_path / 'u2' / 'copy.bin')
+    store.forget('u2', 'copy.bin')
+    store.collect_garbage()
+    assert not os.path.exists(store.object_path(object_hash))
+    assert store.locate(chunks[0][0]) is None
+    assert store.missing({chunk_hash for chunk_hash, _ in chunks}) == {chunk_hash for chunk_hash, _ in chunks}
@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+import utils as u
+from commandqueue import CommandQueue
+
+
+def replay(batches: list) -> set:
+    """
+    The paths the server holds after applying the batches, every command must make sense where it comes
+    """
+    held = set()
+    for batch in batches:
+        assert len({(command.cid, command.path) for command in batch}) == len(batch), 'a command was sent twice'
+        for command in batch:
+            if command.cid in (u.CREATE, u.MODIFY):
+                held.add(command.path)
+            elif command.cid == u.DELETE:
+                assert command.path in held, f'{command.path} deleted but never sent'
+                held.remove(command.path)
+            elif command.cid == u.MOVE:
+                assert command.path in held, f'{command.path} moved but never sent'
+                held.remove(command.path)
+                held.add(command.new_path)
+    return held
+
+
+def events(folder: str, index: int) -> (list, str):
+    # the events of one file and where it ends up, None if it is deleted
+    path = f'f{index}'
+    source = os.path.join(folder, path)
+    created = [u.Command(u.CREATE, path), *[u.Command(u.MODIFY, path, source=source)] * 3]
+    if index % 3 == 0:
+        return created, path
+    if index % 3 == 1:
+        return created + [u.Command(u.DELETE, path)], None
+    return created + [u.Command(u.MOVE, path, new_path=f'g{index}')], f'g{index}'
+
+
+def test_coalesced_batches(tmp_path):
+    folder = str(tmp_path)
+    requests = CommandQueue(folder)
+    for command in events(folder, 0)[0] + events(folder, 1)[0]:
+        requests.push(command)
+    assert requests.take() == [u.Command(u.MODIFY, 'f0', source=os.path.join(folder, 'f0'))]
+    requests.push(u.Command(u.MODIFY, 'f0', source=os.path.join(folder, 'f0')))
+    requests.push(u.Command(u.MOVE, 'f0', new_path='g0'))
+    assert requests.take() == [u.Command(u.MOVE, 'f0', new_path='g0'),
+                               u.Command(u.MODIFY, 'g0', source=os.path.join(folder, 'g0'))]
+    assert requests.take() == []
+
+
+def test_flood_during_drain(tmp_path):
+    """
+    An observer thread floods the queue while the sending thread keeps taking batches
+    Nothing may be lost or sent twice: replaying the batches gives exactly the final state of the folder
+    """
+    folder = str(tmp_path)
+    requests = CommandQueue(folder)
+    files = 3000
+    expected = set()
+    done = threading.Event()
+
+    def observer():
+        for index in range(files):
+            commands, final = events(folder, index)
+            for command in commands:
+                requests.push(command)
+            if final is not None:
+                expected.add(final)
+            if index % 100 == 0:
+                # let the sending thread cut into the middle of the flood
+                time.sleep(0.001)
+        done.set()
+
+    flood = threading.Thread(target=observer)
+    flood.start()
+    batches = []
+    while not done.is_set() or len(requests):
+        batches.append(requests.take())
+    flood.join()
+    assert replay(batches) == expected
+    assert sum(1 for batch in batches if batch) > 1, 'the flood was never cut by a take'
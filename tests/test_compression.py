@@ -0,0 +1,48 @@
+import socket
+import threading
+import zlib
+import pytest
+import compression
+import utils as u
+
+ZLIB = compression.CODECS[1]
+
+
+def receive(wire: bytes, size: int) -> bytes:
+    # what the receiving side makes of wire, sent from another thread
+    left, right = socket.socketpair()
+    right.settimeout(5)
+    sender = threading.Thread(target=lambda: (left.sendall(wire), left.close()))
+    sender.start()
+    try:
+        return bytes(u.receive_content(right, size, ZLIB))
+    finally:
+        right.close()
+        sender.join()
+
+
+def test_round_trip():
+    data = b'some text ' * 100000 + bytes(range(256)) * 100
+    assert receive(compression.encode(data, ZLIB), len(data)) == data
+
+
+def test_bomb_is_refused():
+    bomb = zlib.compress(bytes(1 << 26), 9)
+    with pytest.raises(ValueError):
+        receive(compression.BLOCK_HEADER.pack(ZLIB.cid, len(bomb)) + bomb, 1 << 26)
+
+
+def test_block_longer_than_announced():
+    block = zlib.compress(bytes(1000))
+    with pytest.raises(ValueError):
+        receive(compression.BLOCK_HEADER.pack(ZLIB.cid, len(block)) + block, 999)
+
+
+def test_length_is_checked_before_reading():
+    with pytest.raises(ValueError):
+        receive(compression.BLOCK_HEADER.pack(compression.RAW, 1 << 31), 1 << 31)
+
+
+def test_cut_off_block():
+    with pytest.raises(ValueError):
+        compression.decode_block(ZLIB.cid, zlib.compress(bytes(1000))[:-4], 1000)
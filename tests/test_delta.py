@@ -0,0 +1,76 @@
+import os
+import random
+import pytest
+import delta
+
+
+@pytest.fixture
+def files(tmp_path):
+    generator = random.Random(1)
+    old = generator.randbytes(300 << 10)
+    # an edit in the middle, bytes inserted near the start and a new tail
+    new = old[:1000] + b'inserted' + old[1000:150000] + generator.randbytes(5000) + old[160000:] + b'tail'
+    paths = {name: str(tmp_path / name) for name in ('old', 'new', 'delta', 'out')}
+    for name, content in (('old', old), ('new', new)):
+        with open(paths[name], 'wb') as file:
+            file.write(content)
+    return paths, new
+
+
+def test_round_trip(files):
+    paths, new = files
+    size = delta.make_delta(paths['new'], delta.signatures(paths['old']), paths['delta'])
+    assert size is not None and size < len(new) // 4
+    delta.apply_delta(paths['old'], paths['delta'], paths['out'])
+    with open(paths['out'], 'rb') as file:
+        assert file.read() == new
+
+
+def test_unrelated_file_is_sent_whole(files):
+    paths, _ = files
+    with open(paths['old'], 'wb') as file:
+        file.write(random.Random(2).randbytes(300 << 10))
+    assert delta.make_delta(paths['new'], delta.signatures(paths['old']), paths['delta']) is None
+    assert not os.path.exists(paths['delta'])
+
+
+def test_base_changed_since_the_signatures(files):
+    paths, _ = files
+    delta.make_delta(paths['new'], delta.signatures(paths['old']), paths['delta'])
+    with open(paths['old'], 'r+b') as file:
+        file.seek(50000)
+        file.write(b'changed')
+    with pytest.raises(delta.DeltaMismatch):
+        delta.apply_delta(paths['old'], paths['delta'], paths['out'])
+    assert not os.path.exists(paths['out'])
+
+
+def test_missing_base(files):
+    paths, _ = files
+    delta.make_delta(paths['new'], delta.signatures(paths['old']), paths['delta'])
+    os.remove(paths['old'])
+    with pytest.raises(delta.DeltaMismatch):
+        delta.apply_delta(paths['old'], paths['delta'], paths['out'])
+    assert not os.path.exists(paths['out'])
+
+
+@pytest.mark.parametrize('cut', [
+    # an unknown operation after the header
+    lambda content: content[:delta.DELTA_HEADER.size] + b'X' + content[delta.DELTA_HEADER.size:],
+    # in the middle of the first operation
+    lambda content: content[:delta.DELTA_HEADER.size + 3],
+    # in the middle of the header
+    lambda content: content[:5],
+    # literal bytes missing at the end
+    lambda content: content[:-2],
+])
+def test_malformed_delta(files, cut):
+    paths, _ = files
+    delta.make_delta(paths['new'], delta.signatures(paths['old']), paths['delta'])
+    with open(paths['delta'], 'rb') as file:
+        content = file.read()
+    with open(paths['delta'], 'wb') as file:
+        file.write(cut(content))
+    with pytest.raises(delta.DeltaMismatch):
+        delta.apply_delta(paths['old'], paths['delta'], paths['out'])
+    assert not os.path.exists(paths['out'])
@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import executor
+import utils as u
+
+
+@pytest.fixture
+def spool(tmp_path):
+    os.makedirs(tmp_path / 'spool')
+    os.makedirs(tmp_path / 'folder')
+    counter = iter(range(1 << 20))
+
+    def content(data: bytes) -> str:
+        # a received content, waiting in the spool
+        path = str(tmp_path / 'spool' / str(next(counter)))
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+    return str(tmp_path / 'folder'), content
+
+
+def modify(path: str, source: str) -> u.Command:
+    return u.Command(u.MODIFY, path, source=source)
+
+
+def test_a_file_written_twice_is_written_once(spool):
+    folder, content = spool
+    first, second = content(b'1'), content(b'2')
+    assert executor.collapse([modify('f', first), modify('f', second)], folder) == [modify('f', second)]
+    # the content that is not needed anymore is gone from the spool
+    assert not os.path.exists(first) and os.path.exists(second)
+
+
+def test_a_new_file_written_and_moved_is_written_in_place(spool):
+    folder, content = spool
+    source = content(b'x')
+    commands = [u.Command(u.CREATE, 'f'), modify('f', source), u.Command(u.MOVE, 'f', new_path='g')]
+    assert executor.collapse(commands, folder) == [modify('g', source)]
+
+
+def test_deleted_files(spool):
+    folder, content = spool
+    with open(os.path.join(folder, 'old'), 'wb') as file:
+        file.write(b'old')
+    new, old = content(b'new'), content(b'old')
+    commands = [u.Command(u.CREATE, 'new'), modify('new', new), u.Command(u.DELETE, 'new'),
+                modify('old', old), u.Command(u.DELETE, 'old')]
+    # a new file leaves nothing behind, an existing one is still deleted
+    assert executor.collapse(commands, folder) == [u.Command(u.DELETE, 'old')]
+    assert not os.path.exists(new) and not os.path.exists(old)
+
+
+def test_nothing_collapses_across_a_folder_delete(spool):
+    folder, content = spool
+    commands = [modify(os.path.join('d', 'f'), content(b'1')), u.Command(u.DELETE, 'd', True),
+                modify(os.path.join('d', 'f'), content(b'2'))]
+    assert executor.collapse(commands, folder) == commands
+
+
+def test_levels_order_conflicting_commands():
+    commands = [u.Command(u.CREATE, 'a', True),
+                u.Command(u.CREATE, 'b', True),
+                u.Command(u.CREATE, os.path.join('a', 'f')),
+                u.Command(u.CREATE, os.path.join('b', 'g')),
+                u.Command(u.MOVE, 'a', True, new_path='c'),
+                u.Command(u.CREATE, 'unrelated'),
+                u.Command(u.DELETE, os.path.join('c', 'f'))]
+    grouped = executor.levels(commands)
+    level = {index: number for number, indexes in enumerate(grouped) for index in indexes}
+    # unrelated paths run together, a path inside a folder after the folder, a move after what is inside
+    assert level[0] == level[1] == level[5] == 0
+    assert level[2] == level[3] == 1
+    assert level[4] == 2
+    assert level[6] == 3
+
+
+def test_execute_batch(spool):
+    folder, content = spool
+    commands = [u.Command(u.CREATE, 'd', True)]
+    commands += [modify(os.path.join('d', f'f{index}'), content(b'%d' % index)) for index in range(40)]
+    commands += [u.Command(u.MOVE, 'd', True, new_path='e')]
+    tracked = []
+    done = []
+    with ThreadPoolExecutor(executor.EXECUTOR_WORKERS) as pool:
+        executed, mismatched = executor.execute_batch(commands, folder, pool, tracked.append, on_level=done.append)
+    assert mismatched == [] and executed == commands
+    assert sorted(tracked) == sorted(commands) and tracked[-1] == commands[-1]
+    assert done == [1, 2, 3]
+    assert sorted(os.listdir(os.path.join(folder, 'e'))) == sorted(f'f{index}' for index in range(40))
+    with open(os.path.join(folder, 'e', 'f7'), 'rb') as file:
+        assert file.read() == b'7'
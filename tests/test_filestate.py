@@ -0,0 +1,98 @@
+import os
+import shutil
+import pytest
+import utils as u
+from filestate import FileStates
+
+
+def write(folder, files: dict):
+    for relative_path, content in files.items():
+        path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+
+
+def tree(folder) -> dict:
+    # relative path -> content, None for a directory
+    found = {}
+    for top, dirs, files in os.walk(folder):
+        for name in dirs:
+            found[os.path.relpath(os.path.join(top, name), folder)] = None
+        for name in files:
+            with open(os.path.join(top, name), 'rb') as file:
+                found[os.path.relpath(os.path.join(top, name), folder)] = file.read()
+    return found
+
+
+def replay(commands: list, folder: str, spool: str):
+    # what the server does with them, a MODIFY takes its source away so it gets a copy
+    for command in commands:
+        if command.cid == u.MODIFY:
+            source = os.path.join(spool, 'content')
+            shutil.copyfile(command.source, source)
+            command = command._replace(source=source)
+        u.execute_command(command, folder)
+
+
+@pytest.fixture
+def synced(tmp_path):
+    # a folder as the client last synced it, and a copy of it as the server has it
+    folder, remote = str(tmp_path / 'local'), str(tmp_path / 'remote')
+    write(folder, {'a.txt': b'a' * 100, 'b.txt': b'b' * 200, 'gone.txt': b'gone',
+                   os.path.join('dir', 'x.txt'): b'x', os.path.join('dir', 'sub', 'y.txt'): b'y',
+                   os.path.join('old', 'z.txt'): b'z', 'was_file': b'file'})
+    states = FileStates(folder, str(tmp_path / 'states.db'))
+    states.reset()
+    shutil.copytree(folder, remote)
+    os.makedirs(tmp_path / 'spool')
+    return folder, remote, states, str(tmp_path / 'spool')
+
+
+def moves(commands: list) -> set:
+    return {(command.path, command.new_path) for command in commands if command.cid == u.MOVE}
+
+
+def test_nothing_changed(synced):
+    _, _, states, _ = synced
+    assert states.changes() == []
+
+
+def test_renames_are_found_by_inode(synced):
+    folder, remote, states, spool = synced
+    os.rename(os.path.join(folder, 'a.txt'), os.path.join(folder, 'renamed.txt'))
+    os.rename(os.path.join(folder, 'dir'), os.path.join(folder, 'moved'))
+    # edited after the move, inside the moved directory
+    write(folder, {os.path.join('moved', 'sub', 'y.txt'): b'edited'})
+    commands = states.changes()
+    assert moves(commands) == {('a.txt', 'renamed.txt'), ('dir', 'moved')}
+    assert [command.path for command in commands if command.cid == u.MODIFY] == [os.path.join('moved', 'sub', 'y.txt')]
+    replay(commands, remote, spool)
+    assert tree(remote) == tree(folder)
+
+
+def test_a_copy_of_a_deleted_file_is_a_rename(synced):
+    folder, remote, states, spool = synced
+    shutil.copyfile(os.path.join(folder, 'b.txt'), os.path.join(folder, 'copy.txt'))
+    os.remove(os.path.join(folder, 'b.txt'))
+    commands = states.changes()
+    assert moves(commands) == {('b.txt', 'copy.txt')}
+    assert not [command for command in commands if command.cid == u.MODIFY]
+    replay(commands, remote, spool)
+    assert tree(remote) == tree(folder)
+
+
+def test_deletes_creates_and_type_changes(synced):
+    folder, remote, states, spool = synced
+    os.remove(os.path.join(folder, 'gone.txt'))
+    shutil.rmtree(os.path.join(folder, 'old'))
+    os.remove(os.path.join(folder, 'was_file'))
+    write(folder, {os.path.join('was_file', 'inner.txt'): b'inner', 'new.txt': b'new'})
+    os.makedirs(os.path.join(folder, 'empty'))
+    commands = states.changes()
+    # a deleted directory is one command
+    assert {command.path for command in commands if command.cid == u.DELETE} == {'gone.txt', 'old', 'was_file'}
+    assert u.Command(u.CREATE, 'empty', True) in commands
+    assert not moves(commands)
+    replay(commands, remote, spool)
+    assert tree(remote) == tree(folder)
@@ -0,0 +1,78 @@
+import os
+import socket
+import threading
+import pytest
+import chunkstore
+import merkle
+import utils as u
+from merkle import MerkleTree
+
+
+def write(folder, files: dict):
+    for relative_path, content in files.items():
+        path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+
+
+def read(folder) -> dict:
+    found = {}
+    for relative_path, path in u.scan_folder(folder):
+        with open(path, 'rb') as file:
+            found[relative_path] = file.read()
+    return found
+
+
+@pytest.fixture
+def remote(tmp_path):
+    folder = str(tmp_path / 'remote')
+    write(folder, {'same.txt': b'same', 'a.txt': b'a', os.path.join('d', 'b.txt'): b'new b',
+                   os.path.join('d', 'e', 'c.txt'): b'c', os.path.join('f', 'g.txt'): b'g'})
+    tree = MerkleTree(str(tmp_path / 'remote.db'))
+    tree.refresh('user', folder)
+    return tree, folder
+
+
+def test_same_content_same_hash(tmp_path, remote):
+    tree, folder = remote
+    other = MerkleTree(str(tmp_path / 'other.db'))
+    other.refresh(merkle.ROOT, folder)
+    assert other.hash(merkle.ROOT) == tree.hash('user')
+    write(folder, {os.path.join('d', 'e', 'c.txt'): b'changed'})
+    other.track(merkle.ROOT, folder, u.Command(u.MODIFY, os.path.join('d', 'e', 'c.txt')))
+    assert other.hash(merkle.ROOT) != tree.hash('user')
+    # only the directories above the change
+    assert other.listing(merkle.ROOT, 'f') == tree.listing('user', 'f')
+    assert other.listing(merkle.ROOT, 'd')[0] != tree.listing('user', 'd')[0]
+
+
+@pytest.mark.parametrize('resumable', [False, True])
+def test_reconcile_transfers_only_what_differs(tmp_path, remote, resumable):
+    tree, remote_folder = remote
+    folder = str(tmp_path / 'local')
+    # f is a file here and a directory there
+    write(folder, {'same.txt': b'same', os.path.join('d', 'b.txt'): b'old b', 'extra.txt': b'only here', 'f': b'f'})
+    local = MerkleTree(str(tmp_path / 'local.db'))
+    left, right = socket.socketpair()
+    with left, right:
+        server = threading.Thread(target=tree.serve_reconcile, args=('user', remote_folder, right, None, resumable))
+        server.start()
+        changed, extra = local.reconcile(merkle.ROOT, folder, left, resumable=resumable)
+        server.join()
+    assert read(folder) == {**read(remote_folder), 'extra.txt': b'only here'}
+    assert 'same.txt' not in changed and os.path.join('d', 'b.txt') in changed
+    assert extra == ['extra.txt']
+    local.track(merkle.ROOT, folder, u.Command(u.DELETE, 'extra.txt'))
+    assert local.hash(merkle.ROOT) == tree.hash('user')
+
+
+@pytest.mark.parametrize('path', [os.path.join('..', 'other', 'secret.txt'), '/etc/passwd'])
+def test_wanted_paths_stay_in_the_folder(remote, path):
+    tree, remote_folder = remote
+    left, right = socket.socketpair()
+    with left, right:
+        chunkstore.send_blob(left, merkle.encode_paths([]))
+        chunkstore.send_blob(left, merkle.encode_paths(['a.txt', path]))
+        with pytest.raises(ValueError):
+            tree.serve_reconcile('user', remote_folder, right)
@@ -0,0 +1,70 @@
+import pytest
+import utils as u
+import metastore
+from metastore import MetaStore
+
+
+@pytest.fixture
+def meta(tmp_path):
+    store = MetaStore(str(tmp_path / 'meta.db'))
+    assert store.add_user('user', str(tmp_path / 'user'))
+    return store
+
+
+def test_client_ids_fit_their_field(meta):
+    # the first client comes with the user
+    ids = [meta.add_client('user') for _ in range(u.MAX_CLIENT_ID)]
+    assert ids == list(range(1, u.MAX_CLIENT_ID + 1))
+    assert all(len(str(client_id)) <= u.CLIENT_ID_LENGTH for client_id in ids)
+    assert meta.add_client('user') is None
+    assert not meta.has_client('user', u.MAX_CLIENT_ID + 1)
+
+
+@pytest.fixture
+def clients(meta):
+    # clients 0, 1 and 2 of the user
+    meta.add_client('user')
+    meta.add_client('user')
+    return meta
+
+
+def batch(name: str) -> list:
+    return [u.Command(u.CREATE, name)]
+
+
+def test_entries_go_to_every_client_but_their_origin(clients):
+    clients.append('user', batch('a'), origin=0)
+    clients.append('user', batch('b'), target=2)
+    assert clients.pending('user', 0) == []
+    assert clients.pending('user', 1) == [(1, batch('a'))]
+    assert clients.pending('user', 2) == [(1, batch('a')), (2, batch('b'))]
+
+
+def test_journal_is_collected_behind_the_slowest_cursor(clients):
+    clients.append('user', batch('a'), origin=0)
+    clients.append('user', batch('b'), origin=1)
+    # the origin of an entry does not hold it back, nor does a client it is not for once it acknowledges
+    clients.acknowledge('user', 1, 1)
+    clients.acknowledge('user', 2, 2)
+    assert clients.collect_garbage('user') == batch('a')
+    assert clients.pending('user', 0) == [(2, batch('b'))]
+    clients.acknowledge('user', 0, 2)
+    assert clients.collect_garbage('user') == batch('b')
+    assert clients.collect_garbage('user') == []
+
+
+def test_a_client_far_behind_gets_a_snapshot(clients, monkeypatch):
+    monkeypatch.setattr(metastore, 'JOURNAL_SEGMENT', 4)
+    monkeypatch.setattr(metastore, 'MAX_LAG', 8)
+    for index in range(12):
+        clients.append('user', batch(f'f{index}'), origin=0)
+        if index < 10:
+            # client 2 keeps up, client 1 is gone
+            clients.acknowledge('user', 2, index + 1)
+    assert clients.needs_snapshot('user', 1) and not clients.needs_snapshot('user', 2)
+    # the snapshot replaces what it missed, the journal does not keep it
+    assert clients.pending('user', 1) == []
+    assert [seq for seq, _ in clients.pending('user', 2)] == [11, 12]
+    assert len(clients.collect_garbage('user')) == 10
+    clients.snapshot_sent('user', 1)
+    assert not clients.needs_snapshot('user', 1)
@@ -0,0 +1,25 @@
+import os
+import socket
+import pytest
+import utils as u
+
+
+@pytest.mark.parametrize('path', ['a', 'a/b.txt', 'a/./b', 'a/c/../b', '.syncignore', '..a/b'])
+def test_paths_inside_the_folder(path):
+    assert u.checked_path(path) == os.path.normpath(path)
+
+
+@pytest.mark.parametrize('path', ['', '.', '..', '../other', 'a/../../other', '/etc/passwd', 'a/b/../../..', 'a\0b'])
+def test_paths_outside_the_folder(path):
+    with pytest.raises(ValueError):
+        u.checked_path(path)
+
+
+def test_batch_leaving_the_folder_is_refused(tmp_path):
+    left, right = socket.socketpair()
+    with left, right:
+        right.settimeout(1)
+        sender, receiver = u.Session(left, str(tmp_path)), u.Session(right, str(tmp_path))
+        sender.send_commands(1, [u.Command(u.CREATE, 'a', True), u.Command(u.MOVE, 'a', new_path='../other/a')])
+        with pytest.raises(ValueError):
+            receiver.read_frame()
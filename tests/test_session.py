@@ -0,0 +1,50 @@
+import socket
+import pytest
+import utils as u
+
+
+@pytest.fixture
+def pair(tmp_path):
+    left, right = socket.socketpair()
+    right.settimeout(0.2)
+    yield left, u.Session(right, str(tmp_path))
+    left.close()
+    right.close()
+
+
+def test_idle_wait_times_out(pair):
+    _, session = pair
+    with pytest.raises(socket.timeout):
+        session.read_frame()
+
+
+def test_stall_in_a_frame_is_a_lost_connection(pair):
+    left, session = pair
+    # an acknowledgement cut off after half of its sequence number
+    left.sendall(u.FRAME_ACK.encode() + u.SEQ.pack(7)[:4])
+    with pytest.raises(OSError) as raised:
+        session.read_frame()
+    assert not isinstance(raised.value, socket.timeout)
+
+
+def test_frames_after_an_idle_wait(pair):
+    left, session = pair
+    with pytest.raises(socket.timeout):
+        session.read_frame()
+    left.sendall(u.FRAME_ACK.encode() + u.SEQ.pack(7))
+    assert session.read_frame() == (u.FRAME_ACK, 7, [])
+
+
+@pytest.mark.parametrize('proposed, version', [(b'2', 2), (b'7', 7), (b'9', 9)])
+def test_protocol_version(pair, proposed, version):
+    left, session = pair
+    left.sendall(proposed)
+    assert u.read_protocol_version(session.sock) == version
+
+
+@pytest.mark.parametrize('proposed', [b'0', b'1', b'x', b' ', b'\xff'])
+def test_unsupported_protocol_version(pair, proposed):
+    left, session = pair
+    left.sendall(proposed)
+    with pytest.raises(ValueError):
+        u.read_protocol_version(session.sock)
@@ -0,0 +1,47 @@
+import pytest
+import syncignore
+
+
+@pytest.mark.parametrize('rules, path, is_dir, ignored', [
+    ('*.o', 'build/x.o', False, True),
+    ('*.o', 'x.c', False, False),
+    ('/build/', 'build', True, True),
+    ('/build/', 'src/build', True, False),
+    ('build/', 'build', False, False),
+    ('node_modules/', 'a/node_modules/b/c.js', False, True),
+    ('docs/**', 'docs', True, False),
+    ('docs/**', 'docs/a/b', False, True),
+    ('**/cache', 'a/b/cache', True, True),
+    ('*.log\n!keep.log', 'keep.log', False, False),
+    ('*.log\n!keep.log', 'other.log', False, True),
+    ('out/\n!out/keep', 'out/keep', False, True),
+    ('[ab]c', 'ac', False, True),
+    ('[!a]c', 'ac', False, False),
+    ('\\#x', '#x', False, True),
+    ('# comment', '# comment', False, False),
+])
+def test_rules(rules, path, is_dir, ignored):
+    assert syncignore.Matcher(rules).ignored(path, is_dir) == ignored
+
+
+@pytest.mark.parametrize('bad', ['[z-a]', '[!]', '[]', '[\\]', 'a[', '[a-'])
+def test_bad_patterns(bad):
+    # a broken rule must not stop the others from applying, nor raise
+    matcher = syncignore.Matcher(f'{bad}\n*.o\n')
+    assert matcher.ignored('x.o')
+    assert not matcher.ignored('x.c')
+    matcher.ignored(bad)
+
+
+def test_bad_set_is_literal():
+    assert syncignore.Matcher('[z-a]').ignored('[z-a]')
+
+
+def test_load(tmp_path):
+    folder, state = tmp_path / 'folder', tmp_path / 'state'
+    folder.mkdir()
+    state.mkdir()
+    (folder / syncignore.IGNORE_FILE).write_text('[z-a]\n*.tmp\n')
+    (state / syncignore.SELECTIVE_FILE).write_text('big/\n')
+    matcher = syncignore.load(str(folder), str(state))
+    assert matcher.ignored('a.tmp') and matcher.ignored('big', True) and not matcher.ignored('a.txt')
@@ -1,27 +1,490 @@
+import hashlib
 import socket
 import os
+import shutil
+import struct
+import threading
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import compression
+import delta
+import metrics
 
 USER_ID_LENGTH = 128
-COMMAND_LEN_SIZE = 8
-COMMAND_ID_LEN = 1
+# client ids are sent in this many digits, a user has at most MAX_CLIENT_ID + 1 clients
+CLIENT_ID_LENGTH = 2
+MAX_CLIENT_ID = 10 ** CLIENT_ID_LENGTH - 1
 PATH_LEN_SIZE = 3
 DEFAULT_USER_ID = '0' * USER_ID_LENGTH
 DEFAULT_CLIENT_ID = '-1'
-MAX_CHUNK_SIZE = 1000
 CONNECTION_TIMEOUT_VAL = 3
 SPECIAL_TIMEOUT = 30
+# the client sends a heartbeat after this many idle seconds
+HEARTBEAT_INTERVAL = 5
+# the server drops a session that was silent for this long
+SESSION_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# every message on a session starts with one of these characters
+# a batch of commands and its acknowledgement carry the batch's sequence number
+FRAME_COMMANDS = 'C'
+FRAME_ACK = 'A'
+FRAME_HEARTBEAT = 'H'
+# these frames carry a payload: 4 bytes length + bytes
+# ask for the delta signatures of a path, and the answer
+FRAME_SIGNATURES_REQUEST = 'S'
+FRAME_SIGNATURES = 'G'
+# ask the other side to send the whole content of a path again
+FRAME_RESEND = 'R'
+# what a side kept of a batch that was cut off, sent once right after its first acknowledgement, see Session
+FRAME_RESUME = 'P'
+# the client's rules of what it does not sync, sent when the session opens (see syncignore)
+FRAME_RULES = 'I'
+PAYLOAD_FRAMES = (FRAME_SIGNATURES_REQUEST, FRAME_SIGNATURES, FRAME_RESEND, FRAME_RESUME, FRAME_RULES)
+PAYLOAD_LEN = struct.Struct('!I')
+SEQ = struct.Struct('!Q')
+# a folder transfer sends the size of every file in a fixed size field
+FILE_SIZE_LEN = 16
+# command ids
+CREATE = '1'
+DELETE = '2'
+MODIFY = '3'
+MOVE = '4'
+# a MODIFY whose source holds a delta against the receiver's copy instead of the whole content
+DELTA = '5'
+# commands that stream the content of their source
+CONTENT_COMMANDS = (MODIFY, DELTA)
+# the histogram of the time every kind of command takes to execute, see metrics
+EXECUTE_METRICS = {CREATE: 'execute.create', DELETE: 'execute.delete', MODIFY: 'execute.modify',
+                   MOVE: 'execute.move', DELTA: 'execute.delta'}
+# wire formats of command batches, the client proposes one when the session opens and the server may downgrade it
+# 1 was a text format, no client that opens sessions ever proposed it
+# binary: header(version, length of the commands) + varint count + commands with varint lengths + file contents
+PROTOCOL_BINARY = 2
+# binary, and the two sides agree on a compression codec for file contents right after the version, see compression
+PROTOCOL_CODECS = 3
+# a new client downloads only the files that differ from what it has, found by comparing merkle trees, see merkle
+PROTOCOL_MERKLE = 4
+# a transfer that was cut off continues from the last byte the receiver kept of every file, instead of from zero
+# batches then carry the offset every content is sent from, right after its size
+PROTOCOL_RESUME = 5
+# after the codec the server tells whether it takes the connection now, or how long to wait before trying again
+PROTOCOL_ADMISSION = 6
+# the client tells what it does not sync when the session opens, the server pushes none of it
+PROTOCOL_SELECTIVE = 7
+PROTOCOL_VERSION = PROTOCOL_SELECTIVE
+# a client that proposes an older version is turned away
+OLDEST_PROTOCOL = PROTOCOL_BINARY
+# the server's admission answer: milliseconds to wait before coming back, 0 if the connection was taken
+RETRY_AFTER = struct.Struct('!I')
+BATCH_HEADER = struct.Struct('!BQ')
+# file contents are streamed between the disk and the socket in pieces of this size
+# sending uses the kernel's sendfile when it can, it needs no pieces
+STREAM_CHUNK_SIZE = 1 << 16
+RECEIVE_CHUNK_SIZE = 1 << 18
+# a folder transfer reads (or writes) files on this many threads while the socket is busy with the others
+FOLDER_WORKERS = 8
+# how many files the workers may be ahead of (or behind) the socket
+FOLDER_WINDOW = 64
+# files up to this size are held in memory by the workers, bigger ones are streamed
+FOLDER_SMALL_FILE = 1 << 20
+# small files are sent together in buffers of about this size
+FOLDER_BUFFER_SIZE = 1 << 20
+# a kept part of a file is checked against the sender's copy with a hash of this size before it is continued
+CONTENT_DIGEST_SIZE = 20
 
+# a single change to a synced folder, paths are relative to the folder
+# is_dir is used by CREATE and DELETE (and by MOVE on the client only) and new_path by MOVE
+# source is the file holding the new content of a MODIFY (or the delta of a DELTA), it is read only when sent
+Command = namedtuple('Command', ['cid', 'path', 'is_dir', 'source', 'new_path'], defaults=(False, '', ''))
 
-def send_in_chunks(sock: socket.socket, message: str):
-    # large files are sent in chunks
-    chunks = [message[i:i + MAX_CHUNK_SIZE] for i in range(0, len(message), MAX_CHUNK_SIZE)]
-    for chunk in chunks:
-        sock.sendall(chunk.encode())
 
+class Outbox:
+    """
+    Numbered batches of commands that were sent, or will be, and are not acknowledged yet
+    Sequence numbers keep growing across sessions, so a batch sent again after a reconnect keeps its number
+    and the other side can tell it already applied it
+    One thread adds batches and another acknowledges them, a deque needs no lock for that
+    """
 
-def read_x_bytes(sock: socket.socket, x: int) -> str:
+    def __init__(self, last_seq: int = 0):
+        # (sequence number, commands), oldest first
+        self.batches = deque()
+        self.last_seq = last_seq
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def add(self, commands: list) -> int:
+        self.last_seq += 1
+        self.batches.append((self.last_seq, commands))
+        return self.last_seq
+
+    def acknowledge(self, seq: int) -> list:
+        """
+        Drop every batch up to seq, returns their commands
+        """
+        acknowledged = []
+        while self.batches and self.batches[0][0] <= seq:
+            acknowledged.extend(self.batches.popleft()[1])
+        return acknowledged
+
+    def pending(self) -> list:
+        # a copy, the other thread may acknowledge meanwhile
+        return list(self.batches)
+
+
+class Session:
     """
-    Reads x bytes from tcp socket, and converts to string
+    A long lived connection between a client and the server
+    Both sides may send frames at any time, the send lock keeps frames from interleaving
+    Both sides keep what they sent in an Outbox until it is acknowledged, see Outbox
+    The contents of a batch that was cut off are kept in the partial directory as {seq}-{index}, after the first
+    acknowledgement each side tells the other what it kept (see send_resume), and a batch sent again continues
+    every content from there
+    """
+
+    def __init__(self, sock: socket.socket, spool: str, version: int = PROTOCOL_VERSION, codec=None,
+                 partial: str = None):
+        self.sock = sock
+        # received file contents wait here until the commands are executed
+        self.spool = spool
+        self.version = version
+        # the compression codec agreed on for file contents, None for none
+        self.codec = codec
+        # where what came of a batch that was cut off is kept, None to keep nothing
+        self.partial = partial
+        # what the other side kept of one of our batches: its number, and index -> (offset, hash of the kept bytes)
+        self.peer_partial = (0, {})
+        # what the other side does not sync (a syncignore.Matcher), None if it syncs everything
+        self.excluded = None
+        self.closed = False
+        self.__send_lock = threading.Lock()
+
+    def send_frame(self, frame_type: str, payload: bytes = None):
+        with self.__send_lock:
+            if self.closed:
+                raise ConnectionError('session is closed')
+            if payload is None:
+                self.sock.sendall(frame_type.encode())
+            else:
+                self.sock.sendall(frame_type.encode() + PAYLOAD_LEN.pack(len(payload)) + payload)
+
+    def send_commands(self, seq: int, commands: list) -> list:
+        # returns the commands that were left out, see send_requests
+        with self.__send_lock:
+            if self.closed:
+                raise ConnectionError('session is closed')
+            self.sock.sendall(FRAME_COMMANDS.encode() + SEQ.pack(seq))
+            kept_seq, kept = self.peer_partial
+            with metrics.Timed('batch.send'):
+                return send_requests(self.sock, commands, self.version, self.codec, kept if kept_seq == seq else None)
+
+    def send_ack(self, seq: int):
+        # acknowledges every batch up to seq
+        with self.__send_lock:
+            if self.closed:
+                raise ConnectionError('session is closed')
+            self.sock.sendall(FRAME_ACK.encode() + SEQ.pack(seq))
+
+    def send_resume(self):
+        """
+        Tell the other side what we kept of its batch that was cut off
+        seq + varint count + for every kept content: varint index + varint size + hash of the kept bytes
+        """
+        seq, kept = self.__kept()
+        parts = [SEQ.pack(seq), encode_varint(len(kept))]
+        for index, path in kept.items():
+            with open(path, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                parts.append(encode_varint(index) + encode_varint(size) + content_digest(file, size))
+        self.send_frame(FRAME_RESUME, b''.join(parts))
+
+    def resume_from(self, payload: bytes):
+        # the other side's send_resume, our batch with this number continues from there when it is sent again
+        view = memoryview(payload)
+        seq, = SEQ.unpack(view[:SEQ.size])
+        count, pos = decode_varint(view, SEQ.size)
+        kept = {}
+        for _ in range(count):
+            index, pos = decode_varint(view, pos)
+            offset, pos = decode_varint(view, pos)
+            kept[index] = (offset, bytes(view[pos:pos + CONTENT_DIGEST_SIZE]))
+            pos += CONTENT_DIGEST_SIZE
+        self.peer_partial = (seq, kept)
+
+    def expect_frame(self, expected: str) -> (int, object):
+        # the next frame must be of this type, returns its sequence number and what it carried
+        frame_type, seq, carried = self.read_frame()
+        if frame_type != expected:
+            raise ValueError(f'Error: expected a {expected} frame, got {frame_type}')
+        return seq, carried
+
+    def read_frame(self) -> (str, int, object):
+        """
+        Wait for the next frame
+        Returns its type, its sequence number (0 if it has none) and the commands (or the payload) it carried
+        Only the wait for a frame raises socket.timeout, a peer that stalls in the middle of one is a lost connection
+        """
+        frame_type = read_x_bytes(self.sock, 1)
+        try:
+            return self.__read_body(frame_type)
+        except socket.timeout as error:
+            # what is left of the frame would be taken for the next one
+            raise ConnectionError(f'timed out in the middle of a {frame_type} frame') from error
+
+    def __read_body(self, frame_type: str) -> (str, int, object):
+        if frame_type in (FRAME_COMMANDS, FRAME_ACK):
+            seq, = SEQ.unpack(receive_exactly(self.sock, SEQ.size))
+            if frame_type == FRAME_ACK:
+                return frame_type, seq, []
+            with metrics.Timed('batch.receive'):
+                return frame_type, seq, self.__receive_batch(seq)
+        if frame_type == FRAME_HEARTBEAT:
+            return frame_type, 0, []
+        if frame_type in PAYLOAD_FRAMES:
+            length, = PAYLOAD_LEN.unpack(receive_exactly(self.sock, PAYLOAD_LEN.size))
+            return frame_type, 0, bytes(receive_exactly(self.sock, length))
+        raise ValueError(f'Error: {frame_type} is not a valid frame type')
+
+    def __kept(self) -> (int, dict):
+        # the number of the batch we kept contents of, and index -> path of every kept content
+        kept_seq, kept = 0, {}
+        if self.partial is None:
+            return kept_seq, kept
+        for name in os.listdir(self.partial):
+            kept_seq, index = map(int, name.split('-'))
+            kept[index] = os.path.join(self.partial, name)
+        return kept_seq, kept
+
+    def __receive_batch(self, seq: int) -> list:
+        if self.partial is None:
+            return receive_requests(self.sock, self.spool, self.version, self.codec)
+        kept_seq, kept = self.__kept()
+        # index -> file of every content that started to arrive, complete or not
+        received = {}
+        try:
+            commands = receive_requests(self.sock, self.spool, self.version, self.codec,
+                                        kept if kept_seq == seq else {}, received)
+        except (OSError, EOFError):
+            if kept_seq > seq:
+                # an older batch sent again, what we kept of the newer one is what matters
+                for path in received.values():
+                    os.remove(path)
+                raise
+            # what came of this batch is kept for when it is sent again, what we kept of an older one is not needed
+            for path in kept.values():
+                if path not in received.values():
+                    os.remove(path)
+            for index, path in received.items():
+                os.replace(path, os.path.join(self.partial, f'{seq}-{index}'))
+            raise
+        if kept_seq > seq:
+            return commands
+        # the continued contents are complete, they wait in the spool like the others
+        for index, command in enumerate(commands):
+            if command.cid in CONTENT_COMMANDS and command.source == kept.get(index):
+                commands[index] = command._replace(source=new_spool_path(self.spool))
+                os.replace(command.source, commands[index].source)
+        for path in kept.values():
+            if os.path.lexists(path):
+                os.remove(path)
+        return commands
+
+    def close(self):
+        # once closed nothing can be sent anymore
+        with self.__send_lock:
+            self.closed = True
+        try:
+            # wake up a thread blocked on reading from the socket
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def encode_varint(value: int) -> bytes:
+    # 7 bits in every byte, the high bit says more bytes follow
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(view: memoryview, pos: int) -> (int, int):
+    """
+    Returns the value and the position right after it
+    """
+    value = shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def state_dir(folder: str, *parts) -> str:
+    """
+    The directory next to a synced folder where we keep our own files
+    It is outside of the folder so nothing in it is ever watched or synced, and on the same disk so renames are atomic
+    """
+    folder = os.path.abspath(folder)
+    path = os.path.join(os.path.dirname(folder), f'.{os.path.basename(folder)}.sync', *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def read_blocks(file, size: int):
+    # size bytes of an open file in compression blocks, padded with zeros if the file got shorter
+    while size > 0:
+        block = file.read(min(compression.BLOCK_SIZE, size)) or bytes(min(compression.BLOCK_SIZE, size))
+        size -= len(block)
+        yield block
+
+
+def content_digest(file, size: int) -> bytes:
+    # hash of the first size bytes of an open file, the file's hash if size is its size (see merkle.file_hash)
+    file_digest = hashlib.blake2b(digest_size=CONTENT_DIGEST_SIZE)
+    file.seek(0)
+    while size > 0:
+        block = file.read(min(RECEIVE_CHUNK_SIZE, size))
+        if not block:
+            break
+        file_digest.update(block)
+        size -= len(block)
+    return file_digest.digest()
+
+
+def resume_offset(file, size: int, kept) -> int:
+    """
+    Where to continue sending an open file the receiver kept (offset, hash) of, 0 to send it whole
+    What it kept must be the start of our copy
+    """
+    if kept is None or not 0 < kept[0] <= size:
+        return 0
+    offset, kept_digest = kept
+    return offset if content_digest(file, offset) == kept_digest else 0
+
+
+def send_file_content(sock: socket.socket, file, size: int, codec=None, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Send exactly size bytes of an open file, from its current position
+    The kernel copies the file to the socket (sendfile) where it can, python's socket falls back to reading pieces
+    With a codec the file is read and sent as compression blocks instead
+    A file that got shorter meanwhile is padded with zeros, a file that changes while it is sent gets another
+    modify event anyway
+    """
+    if codec is not None:
+        for block in compression.encode_blocks(read_blocks(file, size), codec):
+            sock.sendall(block)
+        return
+    if size > 0:
+        offset = file.tell()
+        sent = sock.sendfile(file, offset, size)
+        file.seek(offset + sent)
+        size -= sent
+    while size > 0:
+        padding = bytes(min(chunk_size, size))
+        sock.sendall(padding)
+        size -= len(padding)
+
+
+# every thread receives into its own buffer, allocated once
+receive_buffers = threading.local()
+
+
+def receive_buffer(size: int) -> memoryview:
+    buff = getattr(receive_buffers, 'buff', None)
+    if buff is None or len(buff) < size:
+        buff = receive_buffers.buff = bytearray(size)
+    return memoryview(buff)[:size]
+
+
+def receive_blocks(sock: socket.socket, size: int):
+    # yields the content of compression blocks until size bytes came
+    while size > 0:
+        cid, length = compression.BLOCK_HEADER.unpack(receive_exactly(sock, compression.BLOCK_HEADER.size))
+        # the peer sets the length, nothing longer than a block can be is read or inflated
+        if length > compression.MAX_BLOCK_LENGTH:
+            raise ValueError('Error: a compression block is too long')
+        data = compression.decode_block(cid, receive_exactly(sock, length), min(size, compression.BLOCK_SIZE))
+        size -= len(data)
+        yield data
+
+
+def receive_content(sock: socket.socket, size: int, codec=None) -> bytearray:
+    # a content small enough to be held in memory
+    if codec is None:
+        return receive_exactly(sock, size)
+    return bytearray().join(receive_blocks(sock, size))
+
+
+def receive_file_content(sock: socket.socket, file, size: int, codec=None, chunk_size: int = RECEIVE_CHUNK_SIZE):
+    # stream exactly size bytes from the socket into an open file, memory use does not depend on the size
+    if codec is not None:
+        for data in receive_blocks(sock, size):
+            file.write(data)
+        return
+    view = receive_buffer(chunk_size)
+    while size > 0:
+        received = sock.recv_into(view, min(chunk_size, size))
+        if received == 0:
+            raise EOFError
+        file.write(view[:received])
+        size -= received
+
+
+def receive_to_spool(sock: socket.socket, size: int, spool: str, codec=None) -> str:
+    """
+    Stream size bytes from the socket into a new file in the spool directory, returns the file's path
+    """
+    path = new_spool_path(spool)
+    with open(path, 'xb') as file:
+        receive_file_content(sock, file, size, codec)
+    return path
+
+
+def new_spool_path(spool: str) -> str:
+    return os.path.join(spool, uuid.uuid4().hex)
+
+
+def fsync_path(path: str):
+    # flush a file, or the entries of a directory, to the disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_paths(paths, pool=None):
+    """
+    Flush many files or directories to the disk at once, paths that are gone are skipped
+    The fsyncs are issued together on a pool, the filesystem commits them in one go instead of one by one
+    """
+    def sync(path: str):
+        try:
+            fsync_path(path)
+        except FileNotFoundError:
+            pass
+
+    paths = list(paths)
+    if len(paths) <= 1 or pool is None and len(paths) <= FOLDER_WORKERS:
+        for path in paths:
+            sync(path)
+    elif pool is None:
+        with ThreadPoolExecutor(FOLDER_WORKERS) as own_pool:
+            list(own_pool.map(sync, paths))
+    else:
+        list(pool.map(sync, paths))
+
+
+def receive_exactly(sock: socket.socket, x: int) -> bytearray:
+    """
+    Reads exactly x bytes from tcp socket into a new buffer
     """
     buff = bytearray(x)
     pos = 0
@@ -30,72 +493,262 @@ def read_x_bytes(sock: socket.socket, x: int) -> str:
         if cr == 0:
             raise EOFError
         pos += cr
-    return buff.decode()
+    return buff
+
+
+def read_x_bytes(sock: socket.socket, x: int) -> str:
+    """
+    Reads x bytes from tcp socket, and converts to string
+    """
+    return receive_exactly(sock, x).decode()
+
+
+def read_protocol_version(sock: socket.socket) -> int:
+    """
+    Read the one digit version of the wire format the other side proposes (or agreed to)
+    Raises ValueError if it is not a digit or older than OLDEST_PROTOCOL
+    """
+    version = receive_exactly(sock, 1)
+    if not version.isdigit() or int(version) < OLDEST_PROTOCOL:
+        raise ValueError(f'Error: unsupported protocol version {version!r}')
+    return int(version)
+
+
+def offer_codecs(sock: socket.socket, codecs: list = None):
+    """
+    Client side: send the ids of the codecs we know (1 byte count + 1 byte each), most preferred first
+    Returns the codec the server picked, None for no compression
+    """
+    codecs = list(compression.CODECS) if codecs is None else codecs
+    sock.sendall(bytes([len(codecs)] + codecs))
+    cid = receive_exactly(sock, 1)[0]
+    return compression.CODECS[cid] if cid != compression.RAW else None
+
+
+def choose_codec(sock: socket.socket):
+    """
+    Server side: pick the first codec the client offered that we know too
+    """
+    count = receive_exactly(sock, 1)[0]
+    offered = receive_exactly(sock, count)
+    cid = next((cid for cid in offered if cid in compression.CODECS), compression.RAW)
+    sock.sendall(bytes([cid]))
+    return compression.CODECS.get(cid)
+
+
+def send_admission(sock: socket.socket, retry_after: float = 0):
+    # server side: 0 takes the connection, anything else turns it away for that many seconds
+    sock.sendall(RETRY_AFTER.pack(int(retry_after * 1000)))
+
+
+def receive_admission(sock: socket.socket) -> float:
+    # client side: how many seconds the server wants us to wait, 0 if it took the connection
+    retry_after, = RETRY_AFTER.unpack(receive_exactly(sock, RETRY_AFTER.size))
+    return retry_after / 1000
+
+
+def scan_folder(folder: str):
+    """
+    Yields the relative path and the full path of every file in a folder
+    One scandir per directory, the file types come with the directory entries
+    """
+    folders = ['']
+    while folders:
+        relative_folder = folders.pop()
+        with os.scandir(os.path.join(folder, relative_folder)) as entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_folder, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(relative_path)
+                elif entry.is_file():
+                    yield relative_path, entry.path
 
 
-def send_folder(folder: str, sender_sock: socket.socket):
+def open_for_send(path: str):
     """
-    Send a folder at a given path through the sender socket
-    using the os. Walk method
+    Runs on a worker: returns the size and the content of a small file, or the size and the open file if it is big
+    None if the file is gone
+    """
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    size = os.fstat(file.fileno()).st_size
+    if size > FOLDER_SMALL_FILE:
+        return size, file
+    with file:
+        data = file.read(size)
+    # a file that changed meanwhile is sent as read, a modify event follows anyway
+    return len(data), data
+
+
+def send_folder(folder: str, sender_sock: socket.socket, codec=None, files=None, offsets: dict = None):
+    """
+    Send a folder at a given path through the sender socket, or only some of its files: (relative path, path)
+    Every file is sent as: path_len + path + file_size + file, an empty path ends the folder
+    Workers open and read the next files while the socket sends, small files leave in big buffers
+    offsets may give relative path -> how much of the file the receiver kept, only the rest of it is sent
     """
     # if the folder does not exist, create an empty folder
-    if os.path.isdir(folder):
+    if not os.path.isdir(folder):
         os.makedirs(folder, exist_ok=True)
-    # send folder using the walk method
-    for parent_path, _, files_list in os.walk(folder):
-        # iterate over all files in current folder
-        for file in files_list:
-            file_name_path = os.path.join(parent_path, file)
-            # get relative path to file
-            relative_path = os.path.relpath(file_name_path, folder)
-            # open with binary encoding
-            with open(file_name_path, 'rb') as file_to_send:
-                # the sendall method throws an error if the message was not sent entirely
-                sender_sock.sendall(f'{relative_path}\n{str(os.path.getsize(file_name_path))}\n'.encode())
-                # sending in sub_packet sizes of 1000 bytes each
-                while True:
-                    data_chunk = file_to_send.read(MAX_CHUNK_SIZE)
-                    # stop sending when finished
-                    if not data_chunk:
-                        break
-                    # sending current chunk
-                    sender_sock.sendall(data_chunk)
-
-
-def receive_folder(receiver_folder: str, receiver: socket.socket):
+    out = bytearray()
+
+    def send_next(relative_path: str, opened):
+        opened = opened.result()
+        if opened is None:
+            return
+        size, content = opened
+        offset = min(offsets.get(relative_path, 0), size) if offsets else 0
+        metrics.count('folder.sent_files')
+        metrics.count('folder.sent_bytes', size - offset)
+        relative_path = relative_path.encode()
+        out.extend(f'{str(len(relative_path)).zfill(PATH_LEN_SIZE)}'.encode() + relative_path +
+                   str(size - offset).zfill(FILE_SIZE_LEN).encode())
+        if isinstance(content, bytes):
+            content = content[offset:]
+            out.extend(content if codec is None else compression.encode(content, codec))
+            if len(out) >= FOLDER_BUFFER_SIZE:
+                sender_sock.sendall(out)
+                out.clear()
+            return
+        # a big file is streamed right after everything before it
+        sender_sock.sendall(out)
+        out.clear()
+        with content:
+            content.seek(offset)
+            send_file_content(sender_sock, content, size - offset, codec)
+
+    with metrics.Timed('folder.send'), ThreadPoolExecutor(FOLDER_WORKERS) as pool:
+        ahead = deque()
+        for relative_path, path in scan_folder(folder) if files is None else files:
+            ahead.append((relative_path, pool.submit(open_for_send, path)))
+            if len(ahead) >= FOLDER_WINDOW:
+                send_next(*ahead.popleft())
+        while ahead:
+            send_next(*ahead.popleft())
+    # an empty path marks the end of the folder, the connection stays open
+    sender_sock.sendall(out + '0'.zfill(PATH_LEN_SIZE).encode())
+
+
+def write_file(path: str, data: bytearray, spool: str):
+    # written aside and renamed into place, a crash never leaves half a file, see receive_folder
+    temp = new_spool_path(spool)
+    with open(temp, 'xb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+
+def receive_download(sock: socket.socket, path: str, download: str, expected: tuple, size: int, codec=None):
+    """
+    Receive a file of a folder into the download directory, named by the hash it must have: (hash, offset)
+    If the connection drops it stays there, and the next attempt asks for the rest of it (see merkle.reconcile)
+    Once complete it is renamed into place only if its hash matches
+    """
+    hashed, offset = expected
+    partial = os.path.join(download, hashed)
+    with open(partial, 'r+b' if offset else 'w+b') as file:
+        file.truncate(offset)
+        file.seek(offset)
+        receive_file_content(sock, file, size, codec)
+        file.flush()
+        complete = content_digest(file, file.tell()).hex() == hashed
+        if complete:
+            os.fsync(file.fileno())
+    if not complete:
+        print(f'Error: {path} does not match the hash it was sent for, it is left out')
+        os.remove(partial)
+        return
+    os.replace(partial, path)
+
+
+def checked_path(path: str) -> str:
+    """
+    A path the other side sent, relative to the synced folder, normalized
+    Raises ValueError if it could lead out of the folder: empty, absolute, or with a .. part
+    """
+    normal = os.path.normpath(path) if path else ''
+    if not normal or normal == '.' or os.path.isabs(normal) or '\0' in normal or '..' in normal.split(os.sep):
+        raise ValueError(f'Error: {path!r} is not a path inside the folder')
+    return normal
+
+
+def checked_command(command: Command) -> Command:
+    # a received command, with its paths checked, see checked_path
+    if command.cid == MOVE:
+        return command._replace(path=checked_path(command.path), new_path=checked_path(command.new_path))
+    return command._replace(path=checked_path(command.path))
+
+
+def receive_folder(receiver_folder: str, receiver: socket.socket, codec=None, expected: dict = None):
+    """
+    Receive a folder sent by send_folder, reads exactly the folder and nothing after it
+    Small files are written by workers while the next ones arrive, big files are streamed to the disk
+    Every file is written next to the folder and renamed into place once it is complete and on the disk,
+    the workers flush theirs at the same time, the directories are flushed once at the end
+    expected may give relative path -> (hash, offset we asked from) of files that can be continued if the
+    connection drops, see receive_download
+    Raises EOFError if the connection was closed in the middle
+    """
     # creating the folder
     os.makedirs(receiver_folder, exist_ok=True)
-    # reading from the socket as a file, with 'b' encoding
-    with receiver, receiver.makefile('rb') as client_socket_file:
-        for data_line in client_socket_file:
-            # the file's size in bytes
-            bytes_remaining = int(client_socket_file.readline())
-            file_name = data_line.strip().decode()
-            # calculate path to currently downloaded file
-            file_path = os.path.join(receiver_folder, file_name)
+    spool = state_dir(receiver_folder, 'spool')
+    download = state_dir(receiver_folder, 'download') if expected is not None else None
+    # the directories we already created
+    created = {os.path.normpath(receiver_folder)}
+    with metrics.Timed('folder.receive'), ThreadPoolExecutor(FOLDER_WORKERS) as pool:
+        behind = deque()
+        path_length = int(read_x_bytes(receiver, PATH_LEN_SIZE))
+        # an empty path marks the end of the folder
+        while path_length:
+            # the path and the file's size in bytes
+            head = receive_exactly(receiver, path_length + FILE_SIZE_LEN)
+            relative_path = checked_path(head[:path_length].decode())
+            file_path = os.path.join(receiver_folder, relative_path)
+            size = int(head[path_length:])
+            metrics.count('folder.received_files')
+            metrics.count('folder.received_bytes', size)
             # create necessary directories if they do not exist yet
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            # receiving in chunks of 1000 bytes each
-            # opening a new file and copying from remote
-            with open(file_path, 'wb') as file_downloaded:
-                while bytes_remaining > 0:
-                    # chunk = min{chunk_size, remaining_bytes}
-                    chunk_to_read = bytes_remaining if bytes_remaining <= MAX_CHUNK_SIZE else MAX_CHUNK_SIZE
-                    data_chunk = client_socket_file.read(chunk_to_read)
-                    # break if we could not read completely for some reason
-                    if not data_chunk:
-                        break
-                    # writing the data downloaded to the file opened
-                    file_downloaded.write(data_chunk)
-                    # subtract to update how many bytes are remaining
-                    bytes_remaining -= len(data_chunk)
-                # this will run only if we exited the loop without breaking out due to an error
-                else:
-                    # wrote successfully
-                    continue
-            # if we reached here it means that the socket was closed due to an error
-            print('Error: could not receive data correctly')
-            exit(-1)
+            parent = os.path.dirname(os.path.normpath(file_path))
+            if parent not in created:
+                os.makedirs(parent, exist_ok=True)
+                created.add(parent)
+            resumable = expected.get(relative_path) if expected else None
+            if resumable is not None and (resumable[1] or size > FOLDER_SMALL_FILE):
+                # losing a small file costs little, a big one is kept to be continued
+                receive_download(receiver, file_path, download, resumable, size, codec)
+                path_length = int(read_x_bytes(receiver, PATH_LEN_SIZE))
+                continue
+            if size > FOLDER_SMALL_FILE:
+                temp = new_spool_path(spool)
+                with open(temp, 'xb') as file_downloaded:
+                    receive_file_content(receiver, file_downloaded, size, codec)
+                    file_downloaded.flush()
+                    os.fsync(file_downloaded.fileno())
+                os.replace(temp, file_path)
+                path_length = int(read_x_bytes(receiver, PATH_LEN_SIZE))
+                continue
+            if codec is None:
+                # the content and the next path's length in one read
+                data = receive_exactly(receiver, size + PATH_LEN_SIZE)
+                path_length = int(data[size:])
+                del data[size:]
+            else:
+                data = receive_content(receiver, size, codec)
+                path_length = int(read_x_bytes(receiver, PATH_LEN_SIZE))
+            behind.append(pool.submit(write_file, file_path, data, spool))
+            if len(behind) >= FOLDER_WINDOW:
+                behind.popleft().result()
+        # raise the errors of the workers, if any
+        for written in behind:
+            written.result()
+        # the renames are on the disk too
+        sync_paths(created, pool)
+    if download is not None:
+        # parts of files the sender does not have anymore
+        shutil.rmtree(download, ignore_errors=True)
 
 
 def remove_folder(folder_path: str):
@@ -110,36 +763,162 @@ def remove_folder(folder_path: str):
             os.rmdir(os.path.join(root_dir, empty_folder))
 
 
-def send_requests(sock: socket.socket, reqs: list):
-    # first 2 characters = number of requests
-    sock.sendall(str(len(reqs)).zfill(2).encode())
-    for req in reqs:
-        send_in_chunks(sock, req)
+def discard_folder(folder_path: str, trash: str):
+    """
+    Remove a folder at once: it is renamed into the trash, which is emptied on another thread
+    The trash must be on the same disk, see state_dir
+    """
+    discarded = new_spool_path(trash)
+    try:
+        os.rename(folder_path, discarded)
+    except FileNotFoundError:
+        # it was deleted before
+        return
+    threading.Thread(target=shutil.rmtree, args=(discarded,), kwargs={'ignore_errors': True}, daemon=True).start()
+
+
+def empty_trash(trash: str):
+    # what a process that stopped before its trash was emptied left in it, see discard_folder
+    for name in os.listdir(trash):
+        shutil.rmtree(os.path.join(trash, name), ignore_errors=True)
+
+
+def encode_binary_command(cmd: Command, content_size: int = 0, offset: int = None) -> bytes:
+    """
+    Encode everything but the content of a MODIFY or a DELTA, which follows the whole batch
+    A resumable batch gives the offset the content is sent from after its size
+    """
+    path = cmd.path.encode()
+    head = cmd.cid.encode()
+    if cmd.cid in (CREATE, DELETE):
+        # command_id + is_folder + path_len + path
+        return head + bytes([cmd.is_dir]) + encode_varint(len(path)) + path
+    if cmd.cid in CONTENT_COMMANDS:
+        # command_id + path_len + path + content_len
+        head += encode_varint(len(path)) + path + encode_varint(content_size)
+        return head if offset is None else head + encode_varint(offset)
+    # command_id + old_path_len + old_path + new_path_len + new_path
+    new_path = cmd.new_path.encode()
+    return head + encode_varint(len(path)) + path + encode_varint(len(new_path)) + new_path
+
+
+def decode_binary_command(view: memoryview, pos: int, resumable: bool = False) -> (Command, int, int, int):
+    """
+    Parse the command starting at pos
+    Returns it, the size of its content and the offset it is sent from (MODIFY and DELTA only)
+    and the position right after it
+    """
+    cid = chr(view[pos])
+    pos += 1
+    if cid in (CREATE, DELETE):
+        is_dir = view[pos] == 1
+        path_len, pos = decode_varint(view, pos + 1)
+        return Command(cid, bytes(view[pos:pos + path_len]).decode(), is_dir), 0, 0, pos + path_len
+    path_len, pos = decode_varint(view, pos)
+    path = bytes(view[pos:pos + path_len]).decode()
+    other_len, pos = decode_varint(view, pos + path_len)
+    if cid in CONTENT_COMMANDS:
+        offset, pos = decode_varint(view, pos) if resumable else (0, pos)
+        return Command(cid, path), other_len, offset, pos
+    if cid == MOVE:
+        return Command(cid, path, new_path=bytes(view[pos:pos + other_len]).decode()), 0, 0, pos + other_len
+    raise ValueError(f'Error: {cid} is not a valid command id')
+
+
+def send_requests(sock: socket.socket, reqs: list, version: int = PROTOCOL_VERSION, codec=None,
+                  kept: dict = None) -> list:
+    """
+    Send a batch of commands, the content of a MODIFY is read from its source file only now
+    A MODIFY whose file is gone is left out, returns the commands that were left out
+    kept is what the receiver kept of this batch when it was cut off: index -> (offset, hash), see Session
+    """
+    skipped = []
+    resumable = version >= PROTOCOL_RESUME
+    kept = kept or {}
+    files, sizes, offsets, meta = [], [], [], []
+    try:
+        for req in reqs:
+            if req.cid not in CONTENT_COMMANDS:
+                meta.append(encode_binary_command(req))
+                continue
+            try:
+                files.append(open(req.source, 'rb'))
+            except FileNotFoundError:
+                skipped.append(req)
+                continue
+            sizes.append(os.fstat(files[-1].fileno()).st_size)
+            # the receiver numbers the contents by their place in the batch as it was sent
+            offsets.append(resume_offset(files[-1], sizes[-1], kept.get(len(meta))) if resumable else 0)
+            meta.append(encode_binary_command(req, sizes[-1], offsets[-1] if resumable else None))
+        metrics.observe('batch.sent_commands', len(meta))
+        meta = encode_varint(len(meta)) + b''.join(meta)
+        sock.sendall(BATCH_HEADER.pack(PROTOCOL_RESUME if resumable else PROTOCOL_BINARY, len(meta)) + meta)
+        # the contents follow the commands in the same order, streamed from the disk
+        for file, size, offset in zip(files, sizes, offsets):
+            file.seek(offset)
+            send_file_content(sock, file, size - offset, codec)
+        # before compression
+        metrics.observe('batch.sent_bytes', len(meta) + sum(sizes) - sum(offsets))
+    finally:
+        for file in files:
+            file.close()
+    return skipped
 
 
-def receive_requests(sock: socket.socket) -> list:
+def receive_requests(sock: socket.socket, spool: str, version: int = PROTOCOL_VERSION, codec=None,
+                     kept: dict = None, received: dict = None) -> list:
     """
     Parse the message sent to a list of commands according to the sending protocol
-    THE PROTOCOL: "user_id" + "client_id" + "number_of_commands(2 bytes) + commands"
-    Each command contains : "command_length + command_id + other info (e.g. file path)"
+    THE PROTOCOL: "version + length + varint number_of_commands + commands + contents"
+    see encode_binary_command
+    The content of every MODIFY and DELTA is written to a new file in the spool directory, it becomes the command's source
     :param sock: the socket we will read from
+    :param spool: a directory on the same disk as the synced folder
+    :param version: the wire format negotiated for this connection
+    :param codec: the compression codec negotiated for this connection, None for none
+    :param kept: index -> file we kept of this batch when it was cut off, a content sent from an offset is appended
+    :param received: filled with index -> file of every content as soon as it starts to arrive
     :return: a list of commands
     """
     commands = []
-    # the first 2 bytes are the amount of commands
-    size = int(read_x_bytes(sock, 2))
+    batch_version, length = BATCH_HEADER.unpack(receive_exactly(sock, BATCH_HEADER.size))
+    if batch_version not in (PROTOCOL_BINARY, PROTOCOL_RESUME):
+        raise ValueError(f'Error: unsupported protocol version {batch_version}')
+    kept = kept or {}
+    received = {} if received is None else received
+    # all the commands are read at once and parsed from the buffer
+    view = memoryview(receive_exactly(sock, length))
+    size, pos = decode_varint(view, 0)
+    content_sizes, offsets = [], []
     for _ in range(size):
-        # read the command's length, fixed to 8 bytes
-        length = int(read_x_bytes(sock, COMMAND_LEN_SIZE))
-        # get the command
-        commands.append(read_x_bytes(sock, length - COMMAND_LEN_SIZE))
+        command, content_size, offset, pos = decode_binary_command(view, pos, batch_version == PROTOCOL_RESUME)
+        command = checked_command(command)
+        if offset and (len(commands) not in kept or os.path.getsize(kept[len(commands)]) < offset):
+            raise ValueError(f'Error: {command.path} is continued from a part we do not have')
+        commands.append(command)
+        content_sizes.append(content_size)
+        offsets.append(offset)
+    # then the contents, straight from the socket to the disk
+    for index, command in enumerate(commands):
+        if command.cid not in CONTENT_COMMANDS:
+            continue
+        offset = offsets[index]
+        path = received[index] = kept[index] if offset else new_spool_path(spool)
+        with open(path, 'r+b' if offset else 'xb') as file:
+            # what we kept beyond the offset is not what the sender has
+            file.truncate(offset)
+            file.seek(offset)
+            receive_file_content(sock, file, content_sizes[index] - offset, codec)
+        commands[index] = command._replace(source=path)
+    metrics.observe('batch.received_commands', len(commands))
+    metrics.observe('batch.received_bytes', length + sum(content_sizes) - sum(offsets))
     return commands
 
 
-def create_cmd(command: str, folder: str):
+def create_cmd(command: Command, folder: str):
     # if file => create at path
-    rel_path = os.path.join(folder, command[2::])
-    if command[1] == '0':
+    rel_path = os.path.join(folder, command.path)
+    if not command.is_dir:
         # create necessary folders
         os.makedirs(os.path.dirname(os.path.abspath(rel_path)), exist_ok=True)
         # create file at path
@@ -151,30 +930,39 @@ def create_cmd(command: str, folder: str):
         os.makedirs(rel_path, exist_ok=True)
 
 
-def delete_cmd(command: str, folder: str):
-    path = os.path.join(folder, command[2::])
-    if command[1] == '0':
-        # delete file at path
-        os.remove(path)
+def delete_cmd(command: Command, folder: str):
+    path = os.path.join(folder, command.path)
+    if not command.is_dir:
+        # delete file at path, it might have been deleted before
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
     else:
-        # remove folder
-        remove_folder(path)
+        # remove folder, a rename no matter how big it is
+        discard_folder(path, state_dir(folder, 'trash'))
+
 
+def modify_cmd(command: Command, folder: str):
+    path = os.path.join(folder, command.path)
+    # the new content is complete in the spool, renaming it replaces the old content atomically
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    os.replace(command.source, path)
 
-def modify_cmd(command: str, folder: str):
-    path_len = int(command[1:1 + PATH_LEN_SIZE])
-    path = os.path.join(folder, command[4:4 + path_len])
-    new_content = command[4 + path_len::]
-    # opening the file to update with 'w' => erasing old data
-    with open(path, 'w') as file:
-        # replacing old content with new content
-        file.write(new_content)
 
+def delta_cmd(command: Command, folder: str):
+    path = os.path.join(folder, command.path)
+    # rebuild the new content next to the delta, then rename it into place like a MODIFY
+    patched = new_spool_path(os.path.dirname(command.source))
+    # raises delta.DeltaMismatch if our copy is not the one the delta was made against
+    delta.apply_delta(path, command.source, patched)
+    fsync_path(patched)
+    os.replace(patched, path)
 
-def move_cmd(command: str, folder: str):
-    old_path_len = int(command[1:1 + PATH_LEN_SIZE])
-    old_path = os.path.join(folder, command[4:4 + old_path_len])
-    new_path = os.path.join(folder, command[4 + old_path_len::])
+
+def move_cmd(command: Command, folder: str):
+    old_path = os.path.join(folder, command.path)
+    new_path = os.path.join(folder, command.new_path)
     # move the file at old_path to new_path
     # moving a file
     try:
@@ -185,20 +973,59 @@ def move_cmd(command: str, folder: str):
         pass
 
 
-def execute_command(command: str, folder: str):
-    # the first character is the command type
-    cid = command[0]
-    if cid == '1':
-        # CREATE: format = '1' + is_directory + path
+def command_paths(command: Command) -> list:
+    """
+    Returns the relative paths a command touches
+    """
+    if command.cid == MOVE:
+        return [command.path, command.new_path]
+    return [command.path]
+
+
+def follow_moves(path: str, commands: list):
+    """
+    Where the file at path ends up after the commands, None if they delete it
+    """
+    for command in commands:
+        inside = command.path == path or path.startswith(command.path + os.sep)
+        if command.cid == MOVE and inside:
+            path = command.new_path + path[len(command.path):]
+        elif command.cid == DELETE and inside:
+            return None
+    return path
+
+
+def as_reference(command: Command, folder: str) -> Command:
+    """
+    After a MODIFY was executed its content lives in the folder, point the command there so it can be sent on
+    A DELTA keeps pointing at its delta, it is sent on as is
+    """
+    if command.cid == MODIFY:
+        return command._replace(source=os.path.join(folder, command.path))
+    return command
+
+
+def discard_spooled(commands: list):
+    # the received contents of commands that will not be executed
+    for command in commands:
+        if command.cid in CONTENT_COMMANDS:
+            os.remove(command.source)
+
+
+def execute_command(command: Command, folder: str):
+    started = metrics.clock()
+    # the command id is the command type
+    cid = command.cid
+    if cid == CREATE:
         create_cmd(command, folder)
-    elif cid == '2':
-        # DELETE: format = '2' + is_directory + path
+    elif cid == DELETE:
         delete_cmd(command, folder)
-    elif cid == '3':
-        # MODIFIED: format = '3' + path_len + path + file
+    elif cid == MODIFY:
         modify_cmd(command, folder)
-    elif cid == '4':
-        # MOVED: format = '4' + old_path_len + old_path + new_path
+    elif cid == MOVE:
         move_cmd(command, folder)
+    elif cid == DELTA:
+        delta_cmd(command, folder)
     else:
         raise ValueError(f'Error: {cid} is not a valid command id')
+    metrics.since(EXECUTE_METRICS[cid], started)